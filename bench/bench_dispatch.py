@@ -0,0 +1,84 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Per-job overhead of reaching a BigIP entry point: rendering and
+parsing a command line, as the worker used to, versus building the
+arguments directly (dispatch.py). The BigIP entry points are replaced
+by no-ops so only the overhead is measured.
+"""
+
+import argparse
+import timeit
+
+import mock
+
+HOSTS = ['web%02d.example.com' % i for i in range(10)]
+
+
+def build_parser():
+    """
+    Return the baseline: a copy of the arg parser of the bigip script
+    (/bin/bigip) with unused bits removed, as the worker ran every
+    command through before dispatch.py.
+    """
+    import BigIP
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-v', action='count')
+    subparsers = parser.add_subparsers(title='Commands', dest='command')
+
+    parser_state = subparsers.add_parser('state')
+    parser_state.add_argument('-e', metavar='host', nargs='+', default=[],
+                              dest='enabled_hosts')
+    parser_state.add_argument('-d', metavar='host', nargs='+', default=[],
+                              dest='disabled_hosts')
+    parser_state.set_defaults(func=BigIP.state)
+
+    parser_show = subparsers.add_parser('show')
+    parser_show.add_argument('hosts', metavar='host', nargs='+')
+    parser_show.set_defaults(func=BigIP.show)
+    return parser
+
+
+def via_parser(parser):
+    for cmd in (['state', '-d'] + HOSTS, ['show'] + HOSTS):
+        args = parser.parse_args(cmd)
+        args.func(args)
+
+
+def via_dispatch(dispatch):
+    dispatch.call('state', disabled_hosts=HOSTS)
+    dispatch.call('show', hosts=HOSTS)
+
+
+def _noop(args):
+    pass
+
+
+def main(number=20000):
+    with mock.patch('BigIP.state', new=_noop), \
+            mock.patch('BigIP.show', new=_noop):
+        from replugin.bigipworker import dispatch
+        parser = build_parser()
+
+        for name, func, arg in [('argparse', via_parser, parser),
+                                ('dispatch', via_dispatch, dispatch)]:
+            best = min(timeit.repeat(
+                lambda: func(arg), number=number, repeat=3))
+            print "%-10s %8.2f usec/job" % (name, best / number * 1e6)
+
+
+if __name__ == '__main__':
+    main()
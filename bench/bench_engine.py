@@ -0,0 +1,126 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Per fan out threads against the shared executor engine.
+
+`--parallel` rotation jobs of `--hosts` hosts each are processed at the
+same time, over and over, against bench.fakebigip.FakeDevice, once
+with the default engine (fresh threads for every fan out) and once
+with the 'executor' engine. For each the member operations per
+second, the peak number of live threads and the threads started are
+reported.
+
+    python -m bench.bench_engine --hosts 500 --parallel 8 --concurrency 64
+"""
+
+import argparse
+import logging
+import sys
+import threading
+import time
+
+import mock
+
+from bench.bench_worker import _worker
+from bench.fakebigip import FakeDevice
+
+
+def run(engine, args):
+    """
+    Return a dict of results for running the jobs with `engine`.
+    """
+    worker = _worker({'engine': engine,
+                      'engine_workers': args.workers,
+                      'concurrency': args.concurrency})
+    output = logging.getLogger('bench.output')
+    properties = mock.MagicMock(correlation_id='bench', reply_to='bench')
+    started = [0]
+    thread_start = threading.Thread.start
+
+    def _counting_start(thread):
+        started[0] += 1
+        thread_start(thread)
+
+    peak = [threading.active_count()]
+    running = [True]
+
+    def _sample():
+        while running[0]:
+            peak[0] = max(peak[0], threading.active_count())
+            time.sleep(0.005)
+
+    def _client(client):
+        names = ['web%s-%04d.example.com' % (client, i)
+                 for i in range(args.hosts)]
+        body = {'parameters': {'subcommand': 'OutOfRotation',
+                               'hosts': names}}
+        for _ in range(args.rounds):
+            worker.process(mock.MagicMock(), mock.MagicMock(), properties,
+                           body, output)
+
+    sampler = threading.Thread(target=_sample)
+    sampler.daemon = True
+    sampler.start()
+    clients = [threading.Thread(target=_client, args=(i,))
+               for i in range(args.parallel)]
+    start = time.time()
+    with mock.patch.object(threading.Thread, 'start', _counting_start):
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+    elapsed = time.time() - start
+    running[0] = False
+
+    operations = args.parallel * args.rounds * args.hosts
+    return {
+        'engine': engine,
+        'ops_per_sec': operations / elapsed,
+        'peak_threads': peak[0],
+        'threads_started': started[0] - args.parallel,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--hosts', type=int, default=200,
+                        help='Hosts per job')
+    parser.add_argument('--parallel', type=int, default=8,
+                        help='Jobs processed at the same time')
+    parser.add_argument('--rounds', type=int, default=5,
+                        help='Jobs per parallel client')
+    parser.add_argument('--concurrency', type=int, default=32,
+                        help='Fan out concurrency per job')
+    parser.add_argument('--workers', type=int, default=128,
+                        help='Executor threads')
+    parser.add_argument('--latency', type=float, default=0.005,
+                        help='Seconds per simulated device call')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.CRITICAL)
+    device = FakeDevice(latency=args.latency, seed=0)
+    with device.installed():
+        results = [run(engine, args) for engine in ('threads', 'executor')]
+
+    print "%-9s %12s %13s %16s" % (
+        'engine', 'member ops/s', 'peak threads', 'threads started')
+    for result in results:
+        print "%(engine)-9s %(ops_per_sec)12.1f %(peak_threads)13d " \
+            "%(threads_started)16d" % result
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
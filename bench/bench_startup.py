@@ -0,0 +1,112 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Worker startup time, from process start to the first message consumed.
+
+Every run spawns a fresh interpreter which imports the worker, builds
+it and opens its (mocked) channel the way main() does, then processes
+one OutOfRotation message against bench.fakebigip.FakeDevice. The
+time to each of those points is reported, measured from just before
+the process was spawned:
+
+* import - Interpreter started and replugin.bigipworker imported
+  (after the mock library the harness itself needs).
+* connect - Worker built and channel open, including the warm up.
+* first message - First message processed, including loading the
+  BigIP library unless the warm up already did.
+
+    python -m bench.bench_startup --runs 10 --warm-up
+"""
+
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+
+
+def child(config):
+    """
+    Run in the spawned interpreter, print the time of each phase.
+    """
+    import mock
+    from bench.bench_worker import _worker
+    from bench.fakebigip import FakeDevice
+
+    marks = {}
+    __import__('replugin.bigipworker')
+    marks['import'] = time.time()
+
+    logging.basicConfig(level=logging.CRITICAL)
+    worker = _worker(config)
+    marks['connect'] = time.time()
+
+    properties = mock.MagicMock(correlation_id='bench', reply_to='bench')
+    body = {'parameters': {'subcommand': 'OutOfRotation',
+                           'hosts': ['web0001.example.com']}}
+    with FakeDevice(latency=0).installed():
+        worker.process(mock.MagicMock(), mock.MagicMock(), properties, body,
+                       logging.getLogger('bench.output'))
+    marks['first_message'] = time.time()
+
+    print json.dumps(marks)
+
+
+def run(config):
+    """
+    Spawn one worker process and return the seconds to each phase.
+    """
+    started = time.time()
+    output = subprocess.check_output([
+        sys.executable, '-m', 'bench.bench_startup', '--child',
+        '--config', json.dumps(config)],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    marks = json.loads(output.strip().splitlines()[-1])
+    return dict((phase, mark - started) for (phase, mark) in marks.items())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--warm-up', action='store_true',
+                        help='Enable the warm_up worker setting')
+    parser.add_argument('--config', default='{}',
+                        help='Worker settings as JSON')
+    parser.add_argument('--child', action='store_true',
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    config = json.loads(args.config)
+    if args.warm_up:
+        config['warm_up'] = True
+    if args.child:
+        child(config)
+        return 0
+
+    runs = [run(config) for _ in range(args.runs)]
+    print "%-14s %10s %10s %10s" % ('phase', 'min ms', 'median ms',
+                                    'max ms')
+    for phase in ('import', 'connect', 'first_message'):
+        times = sorted(r[phase] * 1000.0 for r in runs)
+        print "%-14s %10.1f %10.1f %10.1f" % (
+            phase.replace('_', ' '), times[0], times[len(times) // 2],
+            times[-1])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,162 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Throughput of BigipWorker.process against a simulated F5 device.
+
+No load balancer or RabbitMQ is needed: the BigIP entry points are
+replaced by bench.fakebigip.FakeDevice and the AMQP channel by a mock.
+For every host count jobs/sec, per-job latency percentiles, device
+calls per job and the number of failed jobs are reported.
+
+    python -m bench.bench_worker --latency 0.01 --hosts 1 10 100
+
+Results can be saved with --save and later runs checked against them
+with --compare, which exits non-zero when jobs/sec dropped by more
+than --tolerance.
+"""
+
+import argparse
+import json
+import logging
+import sys
+import time
+
+import mock
+
+from bench.fakebigip import FakeDevice
+
+
+def _percentile(values, q):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(q / 100.0 * (len(values) - 1))))
+    return values[index]
+
+
+def _worker(config):
+    from replugin.bigipworker import BigipWorker
+
+    with mock.patch('pika.SelectConnection'):
+        worker = BigipWorker(
+            {}, output_dir='/tmp/logs/',
+            logger=logging.getLogger('bench'))
+    worker._config = config
+    worker._configure()
+    worker._on_open(mock.MagicMock())
+    worker._on_channel_open(mock.MagicMock())
+    worker.send = mock.MagicMock()
+    worker.notify = mock.MagicMock()
+    return worker
+
+
+def run(hosts, jobs, subcommand, device, config):
+    """
+    Process `jobs` messages of `subcommand` for `hosts` hosts each and
+    return a dict of results.
+    """
+    worker = _worker(config)
+    output = logging.getLogger('bench.output')
+    names = ['web%04d.example.com' % i for i in range(hosts)]
+    properties = mock.MagicMock(correlation_id='bench', reply_to='bench')
+    body = {'parameters': {'subcommand': subcommand, 'hosts': names}}
+
+    latencies = []
+    crashed = 0
+    calls_before = device.calls
+    start = time.time()
+    for _ in range(jobs):
+        job_start = time.time()
+        try:
+            worker.process(mock.MagicMock(), mock.MagicMock(), properties,
+                           body, output)
+        except Exception:
+            crashed += 1
+        latencies.append((time.time() - job_start) * 1000.0)
+    elapsed = time.time() - start
+    failed = len([c for c in worker.send.call_args_list
+                  if c[0][2].get('status') == 'failed'])
+
+    return {
+        'hosts': hosts,
+        'jobs': jobs,
+        'jobs_per_sec': jobs / elapsed,
+        'p50_ms': _percentile(latencies, 50),
+        'p90_ms': _percentile(latencies, 90),
+        'p99_ms': _percentile(latencies, 99),
+        'calls_per_job': float(device.calls - calls_before) / jobs,
+        'failed': failed + crashed,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--hosts', type=int, nargs='+',
+                        default=[1, 10, 100, 1000])
+    parser.add_argument('--jobs', type=int, default=20,
+                        help='Jobs per host count')
+    parser.add_argument('--subcommand', default='OutOfRotation',
+                        choices=['InRotation', 'OutOfRotation'])
+    parser.add_argument('--latency', type=float, default=0.005,
+                        help='Seconds per simulated device call')
+    parser.add_argument('--failure-rate', type=float, default=0.0)
+    parser.add_argument('--pools', type=int, default=4)
+    parser.add_argument('--config', default='{}',
+                        help='Worker settings as JSON')
+    parser.add_argument('--save', metavar='FILE')
+    parser.add_argument('--compare', metavar='FILE')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.CRITICAL)
+    device = FakeDevice(latency=args.latency,
+                        failure_rate=args.failure_rate,
+                        pools=args.pools, seed=0)
+    results = []
+    with device.installed():
+        for hosts in args.hosts:
+            results.append(run(hosts, args.jobs, args.subcommand, device,
+                               json.loads(args.config)))
+
+    print "%6s %10s %10s %10s %10s %10s %7s" % (
+        'hosts', 'jobs/s', 'p50 ms', 'p90 ms', 'p99 ms', 'calls/job',
+        'failed')
+    for result in results:
+        print "%(hosts)6d %(jobs_per_sec)10.2f %(p50_ms)10.1f " \
+            "%(p90_ms)10.1f %(p99_ms)10.1f %(calls_per_job)10.1f " \
+            "%(failed)7d" % result
+
+    if args.save:
+        with open(args.save, 'w') as saved:
+            json.dump(results, saved, indent=4)
+
+    if args.compare:
+        with open(args.compare) as saved:
+            baseline = dict((r['hosts'], r) for r in json.load(saved))
+        regressed = False
+        for result in results:
+            before = baseline.get(result['hosts'])
+            if before is None:
+                continue
+            floor = before['jobs_per_sec'] * (1 - args.tolerance)
+            if result['jobs_per_sec'] < floor:
+                regressed = True
+                print "REGRESSION: %s hosts %.2f jobs/s < %.2f" % (
+                    result['hosts'], result['jobs_per_sec'], floor)
+        if regressed:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
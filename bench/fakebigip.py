@@ -0,0 +1,94 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+A simulated F5 device standing in for the BigIP library entry points.
+
+Every call sleeps `latency` seconds (one device round trip) and fails
+with probability `failure_rate`. Hosts are spread round-robin over
+`pools` pools. 'show' prints one line per pool member:
+
+    <host> <pool> <host>:80 <enabled|disabled> <available|offline> connections=<n>
+"""
+
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+import mock
+
+
+class SimulatedFault(Exception):
+    """
+    Raised by the fake device for a failed call.
+    """
+    pass
+
+
+class FakeDevice(object):
+    """
+    In-memory F5 pair with configurable latency and failure rate.
+    """
+
+    def __init__(self, latency=0.005, failure_rate=0.0, pools=4, seed=None):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.pools = pools
+        self.random = random.Random(seed)
+        self.enabled = {}
+        self.connections = {}
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def _round_trip(self):
+        with self._lock:
+            self.calls += 1
+            failed = self.random.random() < self.failure_rate
+        time.sleep(self.latency)
+        if failed:
+            raise SimulatedFault('simulated SOAP fault')
+
+    def pool_of(self, host):
+        return 'pool_%s' % (hash(host) % self.pools)
+
+    def state(self, args):
+        self._round_trip()
+        with self._lock:
+            for host in args.enabled_hosts:
+                self.enabled[host] = True
+            for host in args.disabled_hosts:
+                self.enabled[host] = False
+                self.connections[host] = 0
+
+    def sync(self, args):
+        self._round_trip()
+
+    def show(self, args):
+        self._round_trip()
+        for host in args.hosts:
+            print "%s %s %s:80 %s %s connections=%s" % (
+                host, self.pool_of(host), host,
+                'enabled' if self.enabled.get(host, True) else 'disabled',
+                'available', self.connections.get(host, 0))
+
+    @contextmanager
+    def installed(self):
+        """
+        Replace the BigIP entry points with this device while the
+        block runs.
+        """
+        with mock.patch.multiple(
+                'BigIP', state=self.state, sync=self.sync, show=self.show):
+            yield self
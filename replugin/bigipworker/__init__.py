@@ -17,9 +17,30 @@ F5 BigIP Load balancer
 """
 
 from reworker.worker import Worker
-import replugin.bigipworker.parser
-import cStringIO
-import sys
+from replugin.bigipworker import capture
+from replugin.bigipworker import coalesce
+from replugin.bigipworker import dispatch
+from replugin.bigipworker import engine
+from replugin.bigipworker import fanout
+from replugin.bigipworker import journal
+from replugin.bigipworker import metrics
+from replugin.bigipworker import polling
+from replugin.bigipworker import progress
+from replugin.bigipworker import ratelimit
+from replugin.bigipworker import results
+from replugin.bigipworker import retry
+from replugin.bigipworker import scheduler
+import copy
+import Queue
+import threading
+import time
+from collections import namedtuple
+
+# Seconds between checks for acks/replies queued by job threads
+OUTBOX_INTERVAL = 0.05
+
+# Stands in for the message properties of a job resumed from the journal
+_Resumed = namedtuple('_Resumed', 'correlation_id reply_to')
 
 
 def mute(returns_output=False):
@@ -28,6 +49,9 @@ def mute(returns_output=False):
 
     Capture or ignore all print output generated by a function.
 
+    Only output printed by the calling thread is captured, so this is
+    safe to use from concurrent jobs (see capture.capturing).
+
     Usage:
 
     output = mute(returns_output=True)(module.my_func)(args)
@@ -35,14 +59,9 @@ def mute(returns_output=False):
     """
     def decorator(func):
         def wrapper(*args, **kwargs):
-            saved_stdout = sys.stdout
-            sys.stdout = cStringIO.StringIO()
-            try:
-                out = func(*args, **kwargs)
-                if returns_output:
-                    out = sys.stdout.getvalue().strip()
-            finally:
-                sys.stdout = saved_stdout
+            out, printed = capture.capture_output(func, *args, **kwargs)
+            if returns_output:
+                out = printed
             return out
         return wrapper
     return decorator
@@ -55,68 +74,484 @@ class BigipWorkerError(Exception):
     pass
 
 
+def _job_attribute(name, *default):
+    """
+    Property keeping `name` per thread, so jobs running concurrently
+    on the job pool do not overwrite each others arguments.
+
+    `default` - Optional value returned while `name` is unset in the
+    current thread.
+    """
+    return property(
+        lambda self: getattr(self._job, name, *default),
+        lambda self, value: setattr(self._job, name, value))
+
+
 class BigipWorker(Worker):
     """
     Worker to manipulate nodes and balancers in F5 BigIP devices.
     """
 
-    subcommands = ('InRotation', 'OutOfRotation', 'ConfigSync')
+    subcommands = ('InRotation', 'OutOfRotation', 'ConfigSync', 'Batch')
+
+    subcommand = _job_attribute('subcommand')
+    hosts = _job_attribute('hosts')
+    envs = _job_attribute('envs')
+    operations = _job_attribute('operations')
+    progress = _job_attribute('progress', None)
+    drain = _job_attribute('drain', None)
+    healthy = _job_attribute('healthy', None)
+    result = _job_attribute('result', None)
+    deadline = _job_attribute('deadline', None)
+    job_id = _job_attribute('job_id', None)
+    before = _job_attribute('before', None)
+    verbose = _job_attribute('verbose', False)
+    _cmd_repr = _job_attribute('_cmd_repr')
+
+    def __init__(self, *args, **kwargs):
+        self._job = threading.local()
+        self._jobs = None
+        self._jobs_lock = threading.Lock()
+        self._result_lock = threading.Lock()
+        self._outbox = Queue.Queue()
+        self._io_thread = None
+        self.journal = None
+        self.executor = None
+        self.scheduler = None
+        self._resumed = False
+        super(BigipWorker, self).__init__(*args, **kwargs)
+        self._configure()
+
+    def _configure(self):
+        """
+        Set up the helpers driven by the worker configuration. Call
+        again after changing self._config.
+        """
+        self._stop_helpers()
+        self.coalescer = coalesce.Coalescer(
+            self._config_get('coalesce_window', 0))
+        self.syncs = coalesce.SingleFlight()
+        self.metrics = metrics.Metrics(self._metrics_sink())
+        path = self._config_get('journal')
+        if self.journal is not None and self.journal.path != path:
+            self.journal.close()
+            self.journal = None
+        if path and self.journal is None:
+            self.journal = journal.Journal(path)
+            self.journal.start_background(
+                sync_interval=self._config_get('journal_sync', 0.1),
+                compact_interval=self._config_get('journal_compact', 3600))
+        self.executor = None
+        if self._config_get('engine', 'threads') == 'executor':
+            self.executor = engine.Executor(
+                self._config_get('engine_workers', 64))
+        self.limiter = None
+        if (self._config_get('rate_limit', 0) or
+                self._config_get('device_concurrency', 0)):
+            self.limiter = ratelimit.DeviceLimiter(
+                rate=self._config_get('rate_limit', 0),
+                burst=self._config_get('rate_burst', None),
+                concurrency=self._config_get('device_concurrency', 0),
+                minimum=self._config_get('device_concurrency_min', 1),
+                latency_target=self._config_get(
+                    'device_latency_target', 1000) / 1000.0)
+        self.scheduler = None
+        if self._config_get('lanes'):
+            self.scheduler = scheduler.Scheduler(
+                self._config_get('lanes'), self._run_scheduled_job)
+            self.scheduler.start()
+
+    def _stop_helpers(self):
+        """
+        Stop the threads of the helpers set up by a previous
+        _configure. Jobs they already hold are still finished.
+        """
+        if self.scheduler is not None:
+            self.scheduler.stop()
+        if self.executor is not None:
+            self.executor.shutdown()
+
+    ##################################################################
+    # Concurrent jobs
+    #
+    # pika connections are not thread safe. Job threads never touch
+    # the channel themselves, acks and replies they make are queued
+    # and sent from the connection ioloop by _drain_outbox.
+    def _concurrent_jobs(self):
+        return self._config_get('jobs', 1)
+
+    def _inline_jobs(self):
+        """
+        Return True when jobs run on the connection thread itself, which
+        is then blocked until the job is done.
+        """
+        return self.scheduler is None and self._concurrent_jobs() <= 1
+
+    def _job_pool(self):
+        with self._jobs_lock:
+            if self._jobs is None:
+                # Imported here, only workers running jobs concurrently
+                # need it
+                from multiprocessing.pool import ThreadPool
+                self._jobs = ThreadPool(self._concurrent_jobs())
+            return self._jobs
+
+    def _on_channel_open(self, channel):
+        self._io_thread = threading.current_thread()
+        if self.scheduler is not None:
+            # Lanes turn away what they cannot hold themselves, so the
+            # broker may deliver as much as all of them hold
+            channel.basic_qos(prefetch_count=self._config_get(
+                'prefetch', self.scheduler.capacity()))
+        elif self._concurrent_jobs() > 1:
+            channel.basic_qos(prefetch_count=self._config_get(
+                'prefetch', self._concurrent_jobs()))
+        # Whatever a thread other than this one sends goes through the
+        # outbox, whichever way jobs are run
+        channel.connection.add_timeout(OUTBOX_INTERVAL, self._drain_outbox)
+        if self._config_get('warm_up', False):
+            self._warm_up()
+        super(BigipWorker, self)._on_channel_open(channel)
+        if self.journal is not None and not self._resumed:
+            self._resumed = True
+            self._resume()
 
+    def _resume(self):
+        """
+        Run the jobs the journal holds as started but never finished
+        again, as a worker died while running them.
+
+        Only jobs whose message was acked before they ran are run from
+        the journal, the broker redelivers the others by itself and
+        process() takes them up from where they were (see _unfinished).
+        Their message may be redelivered to another worker though, so
+        those not back within 'journal_redelivery_timeout' seconds
+        (default 300) are dropped from the journal.
+        """
+        unacked = {}
+        for job_id, entry in self.journal.pending().items():
+            if not entry['job'].get('acked'):
+                unacked[job_id] = entry['job'].get('started')
+                continue
+            properties = _Resumed(str(job_id), str(entry['job']['reply_to']))
+            body = self._unfinished(properties, entry['job']['body'],
+                                    entry['done'])
+            if body is None:
+                continue
+
+            self.app_logger.info(
+                'bigip: Resuming journaled job %s (%s host(s) done)' % (
+                    job_id, len(entry['done'])))
+            if self.scheduler is not None:
+                self._schedule(
+                    self._channel, None, properties, body, self.app_logger)
+            elif self._concurrent_jobs() > 1:
+                self._job_pool().apply_async(
+                    self._run_pooled_job,
+                    (None, properties, body, self.app_logger))
+            else:
+                self._run_pooled_job(None, properties, body, self.app_logger)
+        if unacked:
+            self._channel.connection.add_timeout(
+                self._config_get('journal_redelivery_timeout', 300),
+                lambda: self._expire_unacked(unacked))
+
+    def _expire_unacked(self, unacked):
+        """
+        Finish the journaled jobs in `unacked` (job id -> when it was
+        started) which were not started again since, as their message
+        went to another worker.
+        """
+        for job_id, started in unacked.items():
+            entry = self.journal.entry(job_id)
+            if entry is None or entry['job'].get('started') != started:
+                continue
+            self.app_logger.info(
+                'bigip: Journaled job %s was not redelivered here, '
+                'dropping it' % job_id)
+            self.journal.finish(job_id)
+
+    def _unfinished(self, properties, body, done):
+        """
+        Return `body` without the hosts which its journaled job already
+        put in the requested state (`done`). A rotation left with none
+        is replied to as completed, finished in the journal and None is
+        returned. ConfigSync and Batch jobs are run again in full.
+        """
+        body = copy.deepcopy(body)
+        params = body.get('parameters') if isinstance(body, dict) else None
+        if not isinstance(params, dict):
+            return body
+        state = {'InRotation': 'enabled',
+                 'OutOfRotation': 'disabled'}.get(params.get('subcommand'))
+        if state is None or not isinstance(params.get('hosts'), list):
+            return body
+        params['hosts'] = [host for host in params['hosts']
+                           if done.get(host) != state]
+        if params['hosts']:
+            return body
+        self.app_logger.info(
+            'bigip: Journaled job %s had finished' % (
+                properties.correlation_id))
+        self.send(properties.reply_to, str(properties.correlation_id),
+                  {'status': 'completed'}, exchange='')
+        self.journal.finish(str(properties.correlation_id))
+        return None
+
+    def _warm_up(self):
+        """
+        Load the BigIP library before consuming, so the first job does
+        not pay for it. A failure is logged and left for the first job
+        to run into.
+        """
+        started = time.time()
+        try:
+            dispatch.load()
+        except Exception, e:
+            self.app_logger.warn('bigip: Warm up failed: %s' % e)
+        self.metrics.record('warm_up', (time.time() - started) * 1000.0)
+
+    def _drain_outbox(self):
+        while True:
+            try:
+                func, args, kwargs = self._outbox.get_nowait()
+            except Queue.Empty:
+                break
+            try:
+                func(*args, **kwargs)
+            except Exception, e:
+                self.app_logger.error(
+                    'bigip: Queued %s failed: %s' % (func.__name__, e))
+        self._channel.connection.add_timeout(
+            OUTBOX_INTERVAL, self._drain_outbox)
+
+    def _io_call(self, func, *args, **kwargs):
+        if self._io_thread in (None, threading.current_thread()):
+            return func(*args, **kwargs)
+        self._outbox.put((func, args, kwargs))
+
+    def ack(self, *args, **kwargs):
+        self._io_call(super(BigipWorker, self).ack, *args, **kwargs)
+
+    def send(self, *args, **kwargs):
+        self._io_call(super(BigipWorker, self).send, *args, **kwargs)
+
+    def notify(self, *args, **kwargs):
+        self._io_call(super(BigipWorker, self).notify, *args, **kwargs)
+
+    ##################################################################
     def process(self, channel, basic_deliver, properties, body, output):
         """
         Frob the things
 
         `Params Required`:
             * foo: bar
+
+        With the 'jobs' worker setting above 1 the delivery is handed
+        to a pool of that many threads and this returns right away. The
+        message is then acked when its job finishes, so together with
+        the channel prefetch ('prefetch', defaults to 'jobs') no more
+        than that many jobs are in flight at once.
+
+        With the 'lanes' worker setting jobs are queued in the lane for
+        their subcommand instead, ordered by their 'priority'
+        parameter, and run by that lane's threads (see
+        replugin.bigipworker.scheduler). A job arriving at a full lane
+        is failed right away, or with the lane's 'defer' overflow
+        policy handed back to the broker after 'defer_delay' seconds.
         """
-        # Ack the original message
-        self.ack(basic_deliver)
+        if self.journal is not None:
+            corr_id = str(properties.correlation_id)
+            # Journaled already when the broker redelivers the message
+            # of a job a worker died running
+            entry = self.journal.entry(corr_id)
+            # Recorded before the message is acked, so a job is never
+            # acked without being on disk. Only jobs acked before they
+            # run are run again from the journal after a restart.
+            self.journal.start(corr_id, {
+                'reply_to': str(properties.reply_to), 'body': body,
+                'acked': self._inline_jobs(), 'started': time.time()})
+            if entry is not None:
+                body = self._unfinished(properties, body, entry['done'])
+                if body is None:
+                    self.ack(basic_deliver)
+                    return
+        if self.scheduler is not None:
+            self._schedule(channel, basic_deliver, properties, body, output)
+        elif self._concurrent_jobs() > 1:
+            self._job_pool().apply_async(
+                self._run_pooled_job,
+                (basic_deliver, properties, body, output))
+        else:
+            # Ack the original message
+            self.ack(basic_deliver)
+            self._run_job(properties, body, output)
+
+    def _run_pooled_job(self, basic_deliver, properties, body, output):
+        try:
+            self._run_job(properties, body, output)
+        except Exception, e:
+            self.app_logger.error('bigip: Unhandled job error: %s' % e)
+        finally:
+            # Resumed jobs have no message
+            if basic_deliver is not None:
+                self.ack(basic_deliver)
+
+    def _schedule(self, channel, basic_deliver, properties, body, output):
+        params = {}
+        if isinstance(body, dict) and isinstance(
+                body.get('parameters'), dict):
+            params = body['parameters']
+        try:
+            priority = int(params.get('priority', 0))
+        except (TypeError, ValueError):
+            priority = 0
+        lane = self.scheduler.lane_for(params.get('subcommand'))
+        admitted = self.scheduler.submit(
+            lane, (basic_deliver, properties, body, output), priority)
+        if admitted == 'queued':
+            return
+
+        corr_id = str(properties.correlation_id)
+        self.metrics.record('lane.%s.%s' % (lane, admitted), 0)
+        # A resumed job has no message to hand back, it is rejected
+        if admitted == 'defer' and basic_deliver is not None:
+            delay = self._config_get('defer_delay', 5)
+            self.app_logger.warn(
+                'bigip: Lane %s is full, deferring job %s for %ss' % (
+                    lane, corr_id, delay))
+            channel.connection.add_timeout(
+                delay, lambda: channel.basic_nack(
+                    delivery_tag=basic_deliver.delivery_tag, requeue=True))
+        else:
+            message = 'bigip: Lane %s is full, rejecting job %s' % (
+                lane, corr_id)
+            self.app_logger.error(message)
+            if basic_deliver is not None:
+                self.ack(basic_deliver)
+            self.send(properties.reply_to, corr_id,
+                      {'status': 'failed', 'lane': lane}, exchange='')
+            self.notify('BigipWorker Failed', message, 'failed', corr_id)
+        if self.journal is not None:
+            # A deferred job is journaled again when it comes back
+            self.journal.finish(corr_id)
+
+    def _run_scheduled_job(self, job, lane, waited):
+        basic_deliver, properties, body, output = job
+        self.metrics.record('lane.%s.wait' % lane, waited * 1000.0)
+        try:
+            self._run_job(properties, body, output, result={
+                'lane': {'name': lane, 'wait': round(waited, 3)}})
+        except Exception, e:
+            self.app_logger.error('bigip: Unhandled job error: %s' % e)
+        finally:
+            if basic_deliver is not None:
+                self.ack(basic_deliver)
+            self.app_logger.debug(
+                'bigip: Lanes %s' % self.scheduler.stats())
+
+    def _run_job(self, properties, body, output, result=None):
+        started = time.time()
+        # Pool and lane threads are reused, nothing of the job they ran
+        # before may leak into this one
+        vars(self._job).clear()
+        self.subcommand = None
+        self.result = result or {}
+        self.job_id = str(properties.correlation_id)
+        try:
+            self._handle_job(properties, body, output)
+        finally:
+            if self.journal is not None:
+                self.journal.finish(self.job_id)
+            self.metrics.record(
+                'job.%s' % (self.subcommand or 'invalid'),
+                (time.time() - started) * 1000.0)
+            self.app_logger.debug(
+                'bigip: Timings %s' % self.metrics.snapshot())
+
+    def _handle_job(self, properties, body, output):
         corr_id = str(properties.correlation_id)
         # Notify we are starting
         self.send(
             properties.reply_to, corr_id, {'status': 'started'}, exchange='')
 
         try:
-            try:
-                params = body['parameters']
-            except KeyError:
-                output.debug("Aborting bigip run, no parameters passed")
-                raise BigipWorkerError(
-                    'Parameters dictionary not passed to BigIPWorker.'
-                    ' Nothing to do!')
+            with self.metrics.timer('phase.validate'):
+                try:
+                    params = body['parameters']
+                except KeyError:
+                    output.debug("Aborting bigip run, no parameters passed")
+                    raise BigipWorkerError(
+                        'Parameters dictionary not passed to BigIPWorker.'
+                        ' Nothing to do!')
 
-            ##########################################################
-            # This will either return True or raise a BigipWorkerError
-            self.validate_inputs(params)
-            parser = replugin.bigipworker.parser.parser
+                ######################################################
+                # This will either return True or raise a
+                # BigipWorkerError
+                self.validate_inputs(params)
+                self.deadline = self._deadline(params)
+                self.verbose = bool(params.get(
+                    'verbose', self._config_get('verbose', False)))
+
+            streaming = params.get(
+                'progress', self._config_get('progress', False))
+            if streaming and self._inline_jobs():
+                # Progress is published from the fan out threads, and
+                # their messages only leave once the connection thread
+                # is free again: after the final reply
+                self.app_logger.warn(
+                    'bigip: Progress needs jobs off the connection thread '
+                    '("jobs" above 1 or "lanes"), not streaming it')
+                streaming = False
+            if streaming:
+                self.progress = progress.ProgressPublisher(
+                    lambda message: self.send(
+                        properties.reply_to, corr_id, message, exchange=''),
+                    interval=self._config_get('progress_interval', 1.0),
+                    batch_size=self._config_get('progress_batch', 50))
 
             ##########################################################
             output.debug("bigip: About to run %s" % self._cmd_repr)
 
-            if self.subcommand == 'ConfigSync':
-                self.config_sync(parser)
-                output.info("Sync'd environment(s)")
-            elif self.subcommand == 'InRotation':
-                output.info(self.in_rotation(parser))
-            elif self.subcommand == 'OutOfRotation':
-                output.info(self.out_of_rotation(parser))
+            with self.metrics.timer('phase.run'):
+                try:
+                    self._log_output(self._run_subcommand(), output)
+                except retry.DeadlineExceeded:
+                    raise BigipWorkerError(
+                        '%s: deadline exceeded' % self._cmd_repr)
+                finally:
+                    if self.progress is not None:
+                        self.progress.flush()
 
             ##########################################################
             self.app_logger.info('bigip: Success for %s' % self._cmd_repr)
-            self.send(
-                properties.reply_to,
-                corr_id,
-                {'status': 'completed'},
-                exchange=''
-            )
-            # Notify on result. Not required but nice to do.
-            self.notify(
-                'BigipWorker Executed Successfully',
-                'BigipWorker successfully executed %s. See logs.' % (
-                    self._cmd_repr),
-                'completed',
-                corr_id)
-        except BigipWorkerError, fwe:
+            if self.limiter is not None:
+                self.app_logger.debug(
+                    'bigip: Limits %s' % self.limiter.stats())
+            if self.executor is not None:
+                self.app_logger.debug(
+                    'bigip: Executor %s' % self.executor.stats())
+            with self.metrics.timer('phase.reply'):
+                self.send(
+                    properties.reply_to,
+                    corr_id,
+                    self._reply('completed'),
+                    exchange=''
+                )
+                # Notify on result. Not required but nice to do.
+                self.notify(
+                    'BigipWorker Executed Successfully',
+                    'BigipWorker successfully executed %s. See logs.' % (
+                        self._cmd_repr),
+                    'completed',
+                    corr_id)
+        except Exception, fwe:
+            if not isinstance(fwe, BigipWorkerError):
+                # A device error that was fatal or ran out of retries.
+                # The message is acked already, so it has to be failed
+                # like any other error or the FSM never hears back.
+                fwe = BigipWorkerError('%s: %s' % (
+                    getattr(self._job, '_cmd_repr', 'bigip'), fwe))
             # If a BigipWorkerError happens send a failure, notify and log
             # the info for review.
             output.debug("Unknown BigIP Error: %s" % fwe)
@@ -126,7 +561,7 @@ class BigipWorker(Worker):
             self.send(
                 properties.reply_to,
                 corr_id,
-                {'status': 'failed'},
+                self._reply('failed'),
                 exchange=''
             )
             self.notify(
@@ -136,12 +571,126 @@ class BigipWorker(Worker):
                 corr_id)
             output.error(str(fwe))
 
+    def _in_job(self, func):
+        """
+        Return `func` wrapped to run with the job attributes of the
+        calling thread, for handing to fan_out threads. Executor
+        threads are reused, so whatever an earlier job left in them is
+        dropped first.
+        """
+        job = dict(vars(self._job))
+
+        def _run(*args):
+            return self._as_job(job, func, *args)
+        return _run
+
+    def _as_job(self, job, func, *args):
+        """
+        Return `func(*args)`, run with the job attributes `job` (a dict
+        as taken from vars(self._job)) in place of the thread's own.
+        """
+        vars(self._job).clear()
+        vars(self._job).update(job)
+        return func(*args)
+
+    def _reply(self, status):
+        """
+        Return the final reply body for `status`, including whatever
+        the job reported into self.result.
+        """
+        reply = dict(self.result or {})
+        reply['status'] = status
+        return reply
+
+    def _log_output(self, shown, output):
+        """
+        Log what the subcommand printed.
+
+        With the 'results' worker setting at 'structured' the 'show'
+        output is parsed into pool members (see results.parse_show),
+        which go into the reply as 'members'; only a summary is logged
+        at info level. With 'diff' only the members whose state differs
+        from the snapshot _rotate took before changing them go into the
+        reply, as 'changes' (see results.diff), and are logged. The
+        default, 'text', logs the output as is.
+
+        Unless the job is verbose (the 'verbose' parameter, defaulting
+        to the 'verbose' worker setting) the full output of the
+        structured and diff modes is only logged at debug level.
+        """
+        mode = self._config_get('results', 'text')
+        if mode not in ('structured', 'diff') or (
+                self.subcommand == 'ConfigSync'):
+            output.info(shown)
+            return
+
+        if self.subcommand == 'Batch':
+            hosts = []
+            for operation in self.operations:
+                for host in operation.get('hosts') or []:
+                    if host not in hosts:
+                        hosts.append(host)
+        else:
+            hosts = self.hosts
+        members = results.parse_show(shown, hosts)
+        if self.verbose:
+            output.info(shown)
+        else:
+            output.debug(shown)
+        if mode == 'structured':
+            self.result['members'] = [member.to_dict() for member in members]
+            output.info(results.summary(members))
+            return
+
+        before = self.before or {}
+        hosts = [host for host in hosts if host in before]
+        changes = results.diff(
+            results.parse_show(
+                "\n".join(line for host in hosts for line in before[host]),
+                hosts),
+            [member for member in members if member.host in before])
+        self.result['changes'] = changes
+        output.info(results.format_diff(changes, len(members)))
+
+    def _deadline(self, params):
+        """
+        Return a retry.Deadline for the optional 'deadline' parameter,
+        a UNIX timestamp the whole job has to be done by, or None.
+        """
+        if params.get('deadline') is None:
+            return None
+        try:
+            deadline = retry.Deadline(float(params['deadline']))
+        except (TypeError, ValueError):
+            raise BigipWorkerError(
+                '"deadline" must be a UNIX timestamp')
+        if deadline.expired():
+            raise BigipWorkerError(
+                '%s: deadline passed %.1fs before the job started' % (
+                    self._cmd_repr, -deadline.remaining()))
+        return deadline
+
+    def _time_left(self, timeout):
+        """
+        Return `timeout` cut down to what is left of the job deadline.
+        """
+        if self.deadline is None:
+            return timeout
+        return max(0, min(timeout, self.deadline.remaining()))
+
+    def _report(self, key, hosts):
+        """
+        Add `hosts` to the `key` list of the job result.
+        """
+        if self.result is not None:
+            self.result.setdefault(key, []).extend(hosts)
+
     def validate_inputs(self, params):
         """Validate the inputs provided by the FSM.
 
 Side effects: Validated arguments are assigned to self.ARG. Such as
-self.envs for ConfigSync, and self.hosts for
-In/OutOfRotation. Invalidation raises BigipWorkerError, while
+self.envs for ConfigSync, self.hosts for In/OutOfRotation and
+self.operations for Batch. Invalidation raises BigipWorkerError, while
 validation returns True.
         """
 
@@ -170,48 +719,629 @@ validation returns True.
                 self._cmd_repr = "bigip:%s %s" % (
                     self.subcommand,
                     ",".join(self.hosts))
-                return True
             except KeyError:
                 raise BigipWorkerError(
                     'bigip:(In|OutOf)Rotation require a "hosts" parameter '
                     'but none was provided.')
 
+            # OutOfRotation can optionally wait for connections to
+            # drain, InRotation for the health monitors to mark the
+            # hosts available
+            self.drain = None
+            self.healthy = None
+            if self.subcommand == 'InRotation' and params.get(
+                    'wait_for_healthy', False):
+                try:
+                    self.healthy = {'timeout': float(params.get(
+                        'healthy_timeout',
+                        self._config_get('healthy_timeout', 300)))}
+                except (TypeError, ValueError):
+                    raise BigipWorkerError(
+                        'bigip:InRotation "healthy_timeout" must be a '
+                        'number')
+            if self.subcommand == 'OutOfRotation' and params.get(
+                    'wait_for_drain', False):
+                try:
+                    self.drain = {
+                        'threshold': int(params.get('drain_threshold', 0)),
+                        'timeout': float(params.get(
+                            'drain_timeout',
+                            self._config_get('drain_timeout', 300))),
+                    }
+                except (TypeError, ValueError):
+                    raise BigipWorkerError(
+                        'bigip:OutOfRotation "drain_threshold" and '
+                        '"drain_timeout" must be numbers')
+            return True
+        elif self.subcommand == 'Batch':
+            # Batch needs an ordered array of other subcommands'
+            # parameters, 'operations'
+            operations = params.get('operations', None)
+            if not isinstance(operations, list) or not operations:
+                raise BigipWorkerError(
+                    'bigip:Batch requires a non-empty array of '
+                    '"operations" but none was provided.')
+
+            validated = []
+            try:
+                for step, operation in enumerate(operations):
+                    if not isinstance(operation, dict):
+                        raise BigipWorkerError(
+                            'bigip:Batch operation %s of %s is not a '
+                            'dictionary of parameters' % (
+                                step + 1, len(operations)))
+                    if operation.get('subcommand', None) == 'Batch':
+                        raise BigipWorkerError(
+                            'bigip:Batch operations can not be batches')
+                    try:
+                        self.validate_inputs(operation)
+                    except BigipWorkerError, e:
+                        raise BigipWorkerError(
+                            'bigip:Batch operation %s of %s: %s' % (
+                                step + 1, len(operations), e))
+                    rotation = self.subcommand != 'ConfigSync'
+                    validated.append({
+                        'subcommand': self.subcommand,
+                        'hosts': self.hosts if rotation else None,
+                        'envs': None if rotation else self.envs,
+                        'drain': self.drain if rotation else None,
+                        'healthy': self.healthy if rotation else None,
+                        '_cmd_repr': self._cmd_repr,
+                    })
+            finally:
+                # Validating an operation sets the subcommand to its own
+                self.subcommand = 'Batch'
+
+            self.operations = validated
+            self._cmd_repr = "bigip:Batch %s" % "; ".join(
+                operation['_cmd_repr'] for operation in validated)
+            return True
+
     ##################################################################
     # Allow me to explain what this whole "mute()" thing is about.
     #
     # The 'bigip' command/library 'show' function does not return any
     # data. Rather, it prints the results directly to the screen. With
     # the use of 'mute()' (below) we are capturing everything that
-    # goes to stdout and returning it
-    def config_sync(self, parser):
-        _cmd = ['sync', '-e']
-        _cmd.extend(self.envs)
+    # goes to stdout and returning it. Capturing happens per thread
+    # (see capture.py) so concurrent jobs each get only their own
+    # output.
+    def _run_subcommand(self):
+        """
+        Run the validated self.subcommand and return its output.
+        """
+        if self.subcommand == 'ConfigSync':
+            self.config_sync()
+            return "Sync'd environment(s)"
+        elif self.subcommand == 'InRotation':
+            return self.in_rotation()
+        elif self.subcommand == 'OutOfRotation':
+            return self.out_of_rotation()
+        elif self.subcommand == 'Batch':
+            return self.batch()
+
+    def batch(self):
+        """
+        Run every operation in self.operations, in order, within this
+        one job and return their combined output.
+
+        The first failing operation stops the batch; the output of the
+        operations before it is logged and the error names the failed
+        and skipped operations.
+        """
+        with self.metrics.timer('subcommand.Batch'):
+            batch_repr = self._cmd_repr
+            results = []
+            try:
+                for step, operation in enumerate(self.operations):
+                    for key, value in operation.items():
+                        setattr(self, key, value)
+                    try:
+                        results.append("%s\n%s" % (
+                            self._cmd_repr, self._run_subcommand()))
+                    except BigipWorkerError, e:
+                        if results:
+                            self.app_logger.info("\n".join(results))
+                        skipped = [o['_cmd_repr']
+                                   for o in self.operations[step + 1:]]
+                        raise BigipWorkerError(
+                            'bigip:Batch step %s of %s failed: %s%s' % (
+                                step + 1, len(self.operations), e,
+                                skipped and '. Not run: %s' % (
+                                    "; ".join(skipped)) or ''))
+            finally:
+                self.subcommand = 'Batch'
+                self._cmd_repr = batch_repr
+            return "\n".join(results)
+
+    def config_sync(self):
+        """
+        Sync every environment in self.envs, in parallel.
+
+        A sync requested for an environment which is already being
+        synced by another job waits for that sync and then runs one
+        more, shared with every other job asking for the environment
+        in the meantime (see coalesce.SingleFlight). The running sync
+        may have started before this job's changes were made.
+        """
+        with self.metrics.timer('subcommand.ConfigSync'):
+            self._config_sync()
+
+    def _config_sync(self):
+        def _sync(env):
+            return self.syncs.run(
+                env, lambda: self._call('sync', environments=[env]))
+
+        results = fanout.fan_out(
+            self._in_job(_sync), self.envs,
+            concurrency=self._config_get(
+                'concurrency', fanout.DEFAULT_CONCURRENCY),
+            executor=self.executor)
+        failed = [(env, error) for (env, _, error) in results
+                  if error is not None]
+        if failed:
+            raise BigipWorkerError(
+                '%s failed for %s of %s environment(s): %s' % (
+                    self._cmd_repr, len(failed), len(self.envs),
+                    ", ".join("%s (%s)" % (env, error)
+                              for (env, error) in failed)))
+
+    def in_rotation(self):
+        with self.metrics.timer('subcommand.InRotation'):
+            if self.healthy is None:
+                return self._rotate('enabled_hosts')
+            self._rotate('enabled_hosts', readback=False)
+            return self._wait_for_healthy()
+
+    def _wait_for_healthy(self):
+        """
+        Wait until the health monitors report every host in self.hosts
+        available, polling all hosts not yet up in one 'show' per round
+        (see polling.wait_for). This replaces the usual readback: the
+        last status polled for each host is returned.
 
-        args = parser.parse_args(_cmd)
-        args.func(args)
+        Raises BigipWorkerError naming the hosts which did not come up
+        within self.healthy['timeout'] seconds. The job result lists
+        them as 'pending', with their last status (None when it could
+        not be read).
+        """
+        started = time.time()
+        last = {}
+
+        def _poll(hosts):
+            shown = self._poll_lines(hosts)
+            last.update(shown)
+            return dict((host, polling.availability(shown[host]))
+                        for host in hosts)
+
+        with self.metrics.timer('healthy'):
+            up, pending, rounds = polling.wait_for(
+                _poll, self.hosts,
+                lambda status: status == 'available',
+                self._time_left(self.healthy['timeout']),
+                interval=self._config_get('healthy_interval', 1.0),
+                max_interval=self._config_get('healthy_max_interval', 10.0))
+
+        shown = "\n".join(
+            line for host in self.hosts for line in last.get(host, []))
+        if pending:
+            if shown:
+                self.app_logger.info(shown)
+            if self.result is not None:
+                self.result['pending'] = dict(pending)
+            raise BigipWorkerError(
+                '%s: %s of %s host(s) did not become available within '
+                '%ss: %s' % (
+                    self._cmd_repr, len(pending), len(self.hosts),
+                    self.healthy['timeout'],
+                    ", ".join("%s (%s)" % (host, status or 'unknown')
+                              for (host, status) in sorted(pending.items()))))
+        return '%s\nAvailable: %s host(s) in %.1fs (%s poll(s))' % (
+            shown, len(up), time.time() - started, rounds)
+
+    def out_of_rotation(self):
+        with self.metrics.timer('subcommand.OutOfRotation'):
+            shown = self._rotate('disabled_hosts')
+            if self.drain is not None:
+                shown = "%s\n%s" % (shown, self._wait_for_drain())
+            return shown
+
+    def _wait_for_drain(self):
+        """
+        Wait until every host in self.hosts has no more than
+        self.drain['threshold'] current connections, polling all hosts
+        still draining in one 'show' per round (see polling.wait_for).
+
+        Raises BigipWorkerError naming the hosts which did not drain
+        within self.drain['timeout'] seconds. The job result lists them
+        as 'pending', with their last connection count (None when it
+        could not be read).
+        """
+        threshold = self.drain['threshold']
+        started = time.time()
+        with self.metrics.timer('drain'):
+            drained, pending, rounds = polling.wait_for(
+                self._poll_connections, self.hosts,
+                lambda count: count <= threshold,
+                self._time_left(self.drain['timeout']),
+                interval=self._config_get('drain_interval', 1.0),
+                max_interval=self._config_get('drain_max_interval', 10.0))
+
+        if pending:
+            if self.result is not None:
+                self.result['pending'] = dict(pending)
+            raise BigipWorkerError(
+                '%s: %s of %s host(s) did not drain to %s connection(s) '
+                'within %ss: %s' % (
+                    self._cmd_repr, len(pending), len(self.hosts),
+                    threshold, self.drain['timeout'],
+                    ", ".join("%s (%s)" % (host, 'unknown' if count is None
+                                           else count)
+                              for (host, count) in sorted(pending.items()))))
+        return 'Drained %s host(s) in %.1fs (%s poll(s))' % (
+            len(drained), time.time() - started, rounds)
+
+    def _poll_connections(self, hosts):
+        """
+        Return a dict of host -> current connection count for `hosts`.
+        """
+        shown = self._poll_lines(hosts)
+        return dict((host, polling.connection_count(shown[host]))
+                    for host in hosts)
 
-    def in_rotation(self, parser):
-        _cmd = ['state', '-e']
-        _cmd.extend(self.hosts)
+    def _poll_lines(self, hosts):
+        """
+        Return a dict of host -> 'show' lines for `hosts`, read from the
+        device in one call.
+        """
+        output = capture.capture_output(self._call, 'show', hosts=hosts)[1]
+        return capture.split_by_host(output, hosts)
+
+    def _rotate(self, target, readback=True):
+        """
+        Put self.hosts in the `target` ('enabled_hosts' or
+        'disabled_hosts') state argument of 'state' and return the
+        'show' output for them, or nothing without `readback`.
 
-        args = parser.parse_args(_cmd)
-        args.func(args)
-        return self._show(parser)
+        With the 'precheck' worker setting the current state of the
+        hosts is read from the device first, in one query,
+        and only hosts not already in the requested state are written.
+        The job result lists the 'changed' and 'skipped' hosts.
 
-    def out_of_rotation(self, parser):
-        _cmd = ['state', '-d']
-        _cmd.extend(self.hosts)
+        When hosts fail the others are still changed. The job result
+        then lists the 'changed' hosts, and the 'failed' ones with
+        their error.
+
+        With the 'coalesce_window' worker setting (seconds) jobs for the
+        same `target` arriving within that window share one device
+        operation over all of their hosts (see coalesce.Coalescer).
+        Each job still only reports on, and fails for, its own hosts.
+        Jobs only overlap with 'jobs' above 1 or 'lanes', the window is
+        ignored otherwise.
+
+        With the 'results' worker setting at 'diff' the hosts are
+        snapshot first, as with 'precheck' and sharing its query, for
+        _log_output to report what changed.
+        """
+        hosts = self.hosts
+        unchanged = ''
+        current = None
+        if self._config_get('results', 'text') == 'diff':
+            current = self._snapshot(self.hosts)
+            if self.before is None:
+                self.before = {}
+            # A host changed twice in a Batch is compared to its state
+            # before the first change
+            for host in self.hosts:
+                self.before.setdefault(host, current[host][1])
+        precheck = self._config_get('precheck', False)
+        if precheck:
+            hosts, unchanged = self._skip_unchanged(
+                target, readback, current)
+            if not hosts:
+                return unchanged
 
-        args = parser.parse_args(_cmd)
-        args.func(args)
-        return self._show(parser)
+        # Jobs run one at a time never overlap, waiting for others to
+        # join would only delay them
+        if self.coalescer.window and not self._inline_jobs():
+            batch = self.coalescer.submit(
+                (target, readback), hosts,
+                lambda batch_hosts, owners: self._apply_state(
+                    target, batch_hosts, readback, owners),
+                dict(vars(self._job)))
+            shown, failed = batch.result
+            if len(batch.items) > len(hosts):
+                shown = capture.split_by_host(shown, batch.items)
+                shown = "\n".join(
+                    line for host in hosts for line in shown[host])
+                failed = [(host, error) for (host, error) in failed
+                          if host in hosts]
+        else:
+            shown, failed = self._apply_state(target, hosts, readback)
+
+        if precheck or failed:
+            failed_hosts = [host for (host, _) in failed]
+            self._report('changed', [host for host in hosts
+                                     if host not in failed_hosts])
+        shown = "\n".join(part for part in (unchanged, shown) if part)
+        if not failed:
+            return shown
+        if self.result is not None:
+            self.result.setdefault('failed', {}).update(
+                (host, str(error)) for (host, error) in failed)
+        if shown:
+            self.app_logger.info(shown)
+        raise BigipWorkerError(
+            '%s failed for %s of %s host(s): %s' % (
+                self._cmd_repr, len(failed), len(self.hosts),
+                ", ".join("%s (%s)" % (host, error)
+                          for (host, error) in failed)))
+
+    def _skip_unchanged(self, target, readback, current=None):
+        """
+        Split self.hosts into those needing the `target` state change
+        and those already in that state. Returns the hosts to change
+        and the 'show' lines of the skipped hosts (when `readback`).
+
+        `current` - A _snapshot of self.hosts already taken.
+        """
+        state = target.split('_')[0]
+        if current is None:
+            current = self._snapshot(self.hosts)
 
-    def _show(self, parser):
-        _cmd = ['show']
-        _cmd.extend(self.hosts)
+        skipped = [host for host in self.hosts if current[host][0] == state]
+        self._report('skipped', skipped)
+        if self.progress is not None:
+            for host in skipped:
+                self.progress.host_done(host, state)
+        hosts = [host for host in self.hosts if host not in skipped]
+        unchanged = ''
+        if readback:
+            unchanged = "\n".join(
+                line for host in skipped for line in current[host][1])
+        return (hosts, unchanged)
 
-        args = parser.parse_args(_cmd)
-        return mute(returns_output=True)(args.func)(args)
+    def _snapshot(self, hosts):
+        """
+        Return a dict of host -> (state, 'show' lines) for `hosts`, read
+        from the device in one call.
+        """
+        shown = self._poll_lines(hosts)
+        return dict((host, (polling.member_state(shown[host]), shown[host]))
+                    for host in hosts)
+
+    def _apply_state(self, target, hosts, readback=True, owners=None):
+        """
+        Put `hosts` in the `target` state and, with `readback`, read
+        them back. Returns the 'show' output of the changed hosts and a
+        list of (host, error) for the hosts that failed.
+
+        `owners` - For a coalesced batch, a dict of host -> the job
+        attributes of every job asking for it. Progress and the journal
+        are reported to each of them, and each host is changed with the
+        deadline and result of the first. Defaults to this job.
+
+        Larger host lists are split into 'concurrency' chunks, one
+        'state' call each, fanned out across a bounded thread pool (see
+        fanout.chunks and fanout.fan_out). A failing chunk does not
+        stop the others, and its hosts are tried again one per call to
+        find which of them failed. With 'pool_concurrency' a chunk only
+        holds hosts of one pool, at most that many, and one chunk per
+        pool runs at a time. With the 'engine' worker setting at
+        'executor' the calls run on a worker-wide set of at most
+        'engine_workers' reused threads (see engine.Executor).
+        """
+        state = target.split('_')[0]
+        if owners is None:
+            job = dict(vars(self._job))
+            owners = dict((host, [job]) for host in hosts)
+
+        def _done(host, result, error):
+            for job in owners.get(host, []):
+                if job.get('progress') is not None:
+                    job['progress'].host_done(host, state, error is None)
+                if (self.journal is not None and job.get('job_id') and
+                        error is None):
+                    self.journal.host_done(job['job_id'], host, state)
+
+        concurrency = self._config_get(
+            'concurrency', fanout.DEFAULT_CONCURRENCY)
+        if len(hosts) <= 1 or concurrency <= 1:
+            printed = self._set_state(target, hosts)
+            for host in hosts:
+                _done(host, printed, None)
+            if not readback:
+                return ('', [])
+            return (self._readback(hosts, printed), [])
+
+        pool_concurrency = self._config_get('pool_concurrency', None)
+
+        def _state(chunk):
+            # Chunks only hold hosts of one job, changed with its state
+            return self._as_job(
+                owners[chunk[0]][0], self._set_state, target, list(chunk))
+
+        def _chunk_done(chunk, result, error):
+            # A failed chunk is tried again host by host, reported then
+            if error is None or len(chunk) == 1:
+                for host in chunk:
+                    _done(host, result, error)
+
+        def _fan_out(work, group_concurrency):
+            return fanout.fan_out(
+                _state, work,
+                concurrency=concurrency,
+                group_of=lambda chunk: self._pool_of(chunk[0]),
+                group_concurrency=group_concurrency,
+                on_result=_chunk_done,
+                executor=self.executor)
+
+        results = _fan_out(
+            fanout.chunks(
+                hosts, concurrency,
+                key=lambda host: (self._pool_of(host), id(owners[host][0])),
+                size=pool_concurrency),
+            pool_concurrency and 1)
+        retried = [(host,) for (chunk, _, error) in results
+                   if error is not None and len(chunk) > 1
+                   for host in chunk]
+        if retried:
+            results = [(chunk, result, error)
+                       for (chunk, result, error) in results
+                       if error is None or len(chunk) == 1]
+            results.extend(_fan_out(retried, pool_concurrency))
+
+        errors = dict((host, error) for (chunk, _, error) in results
+                      if error is not None for host in chunk)
+        failed = [(host, errors[host]) for host in hosts if host in errors]
+        printed = "\n".join(result for (_, result, error) in results
+                            if error is None)
+        changed = [host for host in hosts if host not in errors]
+        shown = ''
+        if changed and readback:
+            shown = self._readback(changed, printed)
+        return (shown, failed)
+
+    def _set_state(self, target, hosts):
+        """
+        Run 'state' for `hosts`. Returns what it printed when that is
+        going to be reused by _readback, otherwise an empty string.
+        """
+        if self._config_get('readback', 'all') != 'changed':
+            self._call('state', **{target: hosts})
+            return ''
+        return capture.capture_output(
+            self._call, 'state', **{target: hosts})[1]
+
+    def _readback(self, hosts, printed):
+        """
+        Return the final state of `hosts` after a 'state' call.
+
+        With the 'readback' worker setting at 'all' (the default) this
+        is a full 'show' of `hosts`. With 'changed' the lines the state
+        change already printed about each host are reused, and only the
+        hosts it said nothing about are read back, in one 'show' call.
+        """
+        if self._config_get('readback', 'all') != 'changed':
+            return self._show(hosts)
+
+        reported = capture.split_by_host(printed, hosts)
+        missing = [host for host in hosts if not reported[host]]
+        lines = []
+        for host in hosts:
+            lines.extend(reported[host])
+        if missing:
+            lines.append(self._show(missing))
+        return "\n".join(lines)
+
+    def _call(self, name, **kwargs):
+        """
+        Run bigip command `name` (see dispatch.call).
+
+        Transient errors are retried up to 'retry_attempts' (default 3)
+        times in all, after a jittered backoff starting at
+        'retry_delay' seconds, and never past the job deadline (see
+        retry.call). Fanned out calls are made per chunk of hosts, so
+        only the failed chunks are retried. The job result counts the 'attempts'
+        made for every host or environment which needed more than one.
+        """
+        targets = [target for key in ('enabled_hosts', 'disabled_hosts',
+                                      'hosts', 'environments')
+                   for target in kwargs.get(key) or []]
+
+        def _retrying(error, attempt, wait):
+            self.app_logger.warn(
+                'bigip: %s %s failed (attempt %s), retrying in %.2fs: %s' % (
+                    name, ",".join(targets), attempt, wait, error))
+            result = self.result
+            if result is not None:
+                with self._result_lock:
+                    attempts = result.setdefault('attempts', {})
+                    for target in targets:
+                        attempts[target] = attempt + 1
+
+        return retry.call(
+            lambda: self._limited_call(name, **kwargs),
+            attempts=self._config_get('retry_attempts', 3),
+            delay=self._config_get('retry_delay', 0.5),
+            max_delay=self._config_get('retry_max_delay', 10.0),
+            deadline=self.deadline,
+            on_retry=_retrying)
+
+    def _limited_call(self, name, **kwargs):
+        """
+        With the 'rate_limit' (calls per second) or 'device_concurrency'
+        worker settings wait for the device's limits first (see
+        ratelimit.DeviceLimiter). The seconds spent waiting add up in
+        the job result as 'throttled'.
+        """
+        if self.limiter is None:
+            return self._device_call(name, **kwargs)
+        with self.limiter.throttle(self._device_key()) as throttled:
+            self.metrics.record('throttle', throttled * 1000.0)
+            result = self.result
+            if result is not None:
+                with self._result_lock:
+                    result['throttled'] = round(
+                        result.get('throttled', 0.0) + throttled, 3)
+            return self._device_call(name, **kwargs)
+
+    def _device_call(self, name, **kwargs):
+        """
+        Run bigip command `name`, timing it.
+        """
+        tags = {}
+        for hosts in (kwargs.get('enabled_hosts'),
+                      kwargs.get('disabled_hosts'), kwargs.get('hosts')):
+            if hosts and len(hosts) == 1:
+                tags['host'] = hosts[0]
+
+        with self.metrics.timer('device.%s' % name, **tags):
+            return dispatch.call(name, **kwargs)
+
+    def _metrics_sink(self):
+        """
+        Return the timing sink named by the 'metrics_sink' worker
+        setting: 'memory' (default), 'log' or 'statsd'.
+        """
+        sink = self._config_get('metrics_sink', 'memory')
+        if sink == 'log':
+            return metrics.LogSink(self.app_logger)
+        elif sink == 'statsd':
+            return metrics.StatsdSink(
+                self._config_get('statsd_host', '127.0.0.1'),
+                self._config_get('statsd_port', 8125))
+        return metrics.MemorySink()
+
+    def _device_key(self):
+        """
+        Return the (device, partition) calls are made against.
+        """
+        return (self._config_get('device'), self._config_get('partition'))
+
+    def _config_get(self, key, default=None):
+        """
+        Return `key` from the worker configuration file, or `default`.
+        """
+        return (getattr(self, '_config', None) or {}).get(key, default)
+
+    def _pool_of(self, host):
+        """
+        Return the pool `host` is listed under in the 'pools' worker
+        configuration mapping ({pool: [host, ...]}), or None.
+        """
+        for pool, members in self._config_get('pools', {}).items():
+            if host in members:
+                return pool
+        return None
+
+    def _show(self, hosts=None):
+        """
+        Return the 'show' output for `hosts` (default self.hosts).
+        """
+        with self.metrics.timer('show'):
+            return mute(returns_output=True)(self._call)(
+                'show', hosts=hosts or self.hosts)
 
 
 def main():  # pragma: no cover
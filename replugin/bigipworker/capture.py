@@ -0,0 +1,134 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Thread safe capture of printed output.
+
+The 'bigip' library 'show' function prints its results instead of
+returning them. Swapping sys.stdout for the duration of the call works
+for one job at a time, but any other thread printing during the swap
+ends up in (or steals) the captured output.
+
+Instead sys.stdout is replaced once by a proxy which hands each write to
+the capture buffer of the writing thread, or to the real stream when
+that thread is not capturing.
+"""
+
+import cStringIO
+import sys
+import threading
+from contextlib import contextmanager
+
+
+_local = threading.local()
+_install_lock = threading.Lock()
+
+
+class _ThreadLocalStdout(object):
+    """
+    File-like stand-in for sys.stdout routing writes per thread.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def _target(self):
+        buf = getattr(_local, 'buffer', None)
+        if buf is None:
+            return self.stream
+        return buf
+
+    def write(self, data):
+        self._target().write(data)
+
+    def writelines(self, lines):
+        self._target().writelines(lines)
+
+    def flush(self):
+        self._target().flush()
+
+    # The print statement keeps its own bookkeeping on the file
+    # object, keep that per thread as well.
+    def _get_softspace(self):
+        return getattr(_local, 'softspace', 0)
+
+    def _set_softspace(self, value):
+        _local.softspace = value
+
+    softspace = property(_get_softspace, _set_softspace)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def install():
+    """
+    Put the capturing proxy in place as sys.stdout, wrapping whatever
+    sys.stdout currently is. Safe to call repeatedly.
+    """
+    with _install_lock:
+        if not isinstance(sys.stdout, _ThreadLocalStdout):
+            sys.stdout = _ThreadLocalStdout(sys.stdout)
+
+
+@contextmanager
+def capturing():
+    """
+    Collect everything the current thread prints inside the block.
+
+    Usage:
+
+    with capturing() as buf:
+        module.my_func(args)
+    text = buf.getvalue()
+    """
+    install()
+    previous = getattr(_local, 'buffer', None)
+    buf = cStringIO.StringIO()
+    _local.buffer = buf
+    try:
+        yield buf
+    finally:
+        _local.buffer = previous
+
+
+def capture_output(func, *args, **kwargs):
+    """
+    Call `func` and return a tuple of its return value and everything
+    it printed (stripped).
+    """
+    with capturing() as buf:
+        result = func(*args, **kwargs)
+    return (result, buf.getvalue().strip())
+
+
+def split_by_host(text, hosts):
+    """
+    Split captured 'show' output into a dict of host -> list of lines.
+
+    A line belongs to the last host named on or before it. Lines printed
+    before any host is mentioned are kept under the None key.
+    """
+    results = dict((host, []) for host in hosts)
+    # Longest first so 'web1' does not claim lines about 'web10'
+    candidates = sorted(hosts, key=len, reverse=True)
+    current = None
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        for host in candidates:
+            if host in line:
+                current = host
+                break
+        results.setdefault(current, []).append(line)
+    return results
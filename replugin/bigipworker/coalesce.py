@@ -0,0 +1,155 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Coalescing of duplicate requests arriving close together.
+
+During large deploys several jobs asking for the same action on
+overlapping host lists often arrive within a few hundred milliseconds.
+The first job for an action waits `window` seconds for others to join,
+then runs one device operation for the union of their hosts. Every
+job receives the result of that shared operation. Each job can hand in
+a context along with its hosts, for the operation to report back to
+the jobs which asked for each host.
+
+Operations which are expensive regardless of their arguments, such as
+a ConfigSync of an environment, use SingleFlight instead. A request
+for a key that is already running can not join that run, which may
+have started before the change the request is about. It waits for one
+follow-up run instead, shared with every request arriving in the
+meantime.
+"""
+
+import threading
+import time
+
+
+class Batch(object):
+    """
+    Requests for one action merged into a single operation.
+    """
+
+    def __init__(self):
+        self.items = []
+        self.contexts = {}
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class Coalescer(object):
+    """
+    Merge requests submitted for the same key within `window` seconds.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def submit(self, key, items, func, context=None):
+        """
+        Add `items` to the pending batch for `key`, starting one if
+        needed, and block until that batch has run.
+
+        The first caller of a batch waits out the window and then calls
+        `func(items, contexts)` with every item of the batch, without
+        duplicates, and a dict of item -> the `context` of every caller
+        which submitted it, in the order they did.
+        Returns the finished Batch; its `result` is what `func` returned.
+        If `func` raised, every caller re-raises that exception.
+        """
+        with self._lock:
+            batch = self._pending.get(key)
+            leader = batch is None
+            if leader:
+                batch = Batch()
+                self._pending[key] = batch
+            for item in items:
+                if item not in batch.items:
+                    batch.items.append(item)
+                batch.contexts.setdefault(item, []).append(context)
+
+        if leader:
+            time.sleep(self.window)
+            with self._lock:
+                del self._pending[key]
+            try:
+                batch.result = func(batch.items, batch.contexts)
+            except Exception, e:
+                batch.error = e
+            finally:
+                batch.done.set()
+        else:
+            batch.done.wait()
+
+        if batch.error is not None:
+            raise batch.error
+        return batch
+
+
+class SingleFlight(object):
+    """
+    Run at most one call per key at a time. Callers asking for a key
+    while it runs share a single follow-up call, started once the
+    running one is done.
+    """
+
+    def __init__(self):
+        self._running = {}
+        self._next = {}
+        self._lock = threading.Lock()
+
+    def run(self, key, func):
+        """
+        Return `func()` run for `key`, started no earlier than this
+        call. While a call for `key` runs, this waits for it and then
+        returns the result of the next one, which every caller arriving
+        meanwhile shares. If that call raised, the exception is raised
+        to every caller which shared it.
+        """
+        with self._lock:
+            running = self._running.get(key)
+            if running is None:
+                flight = Batch()
+                self._running[key] = flight
+                leader = True
+            else:
+                flight = self._next.get(key)
+                leader = flight is None
+                if leader:
+                    flight = Batch()
+                    self._next[key] = flight
+
+        if leader:
+            if running is not None:
+                # Handed the key by the running call once it is done
+                running.done.wait()
+            try:
+                flight.result = func()
+            except Exception, e:
+                flight.error = e
+            finally:
+                with self._lock:
+                    following = self._next.pop(key, None)
+                    if following is None:
+                        del self._running[key]
+                    else:
+                        self._running[key] = following
+                flight.done.set()
+        else:
+            flight.done.wait()
+
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
@@ -0,0 +1,100 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Direct calls into the BigIP library entry points.
+
+The BigIP entry points only read attributes off the argparse namespace
+they are given. Rather than rendering a command line and parsing it
+again for every job the namespace is built directly from a small
+registry of commands.
+
+New commands are added with register():
+
+    register('stats', 'stats', hosts=[])
+    call('stats', hosts=['web1.example.com'])
+
+The BigIP library itself is only imported by the first call (or by
+load()), so importing the worker stays cheap.
+"""
+
+import argparse
+import threading
+
+
+_registry = {}
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def load():
+    """
+    Import the BigIP library, once, and return it.
+    """
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                import BigIP
+                # The library reports errors through the module level
+                # parser of the bigip script. Give it a bare one unless
+                # something else already did.
+                if getattr(BigIP, 'parser', None) is None:
+                    BigIP.parser = argparse.ArgumentParser(prog='bigip')
+                _backend = BigIP
+    return _backend
+
+
+def register(name, entry_point, **defaults):
+    """
+    Make the BigIP function named `entry_point` callable as `name`.
+
+    `defaults` - Attributes the argument object gets unless overridden
+    in the call.
+    """
+    _registry[name] = (entry_point, defaults)
+
+
+def build_args(name, **kwargs):
+    """
+    Return the argument namespace for running command `name`, the
+    same as the bigip parser would produce for it.
+    """
+    try:
+        entry_point, defaults = _registry[name]
+    except KeyError:
+        raise ValueError('Unknown bigip command: %s' % name)
+
+    args = argparse.Namespace(
+        command=name, v=None, func=getattr(load(), entry_point))
+    for key, value in defaults.items():
+        if isinstance(value, list):
+            value = list(value)
+        setattr(args, key, value)
+    for key, value in kwargs.items():
+        setattr(args, key, value)
+    return args
+
+
+def call(name, **kwargs):
+    """
+    Run bigip command `name` with `kwargs` as its arguments.
+    """
+    args = build_args(name, **kwargs)
+    return args.func(args)
+
+
+register('state', 'state', enabled_hosts=[], disabled_hosts=[])
+register('sync', 'sync', environments=[])
+register('show', 'show', hosts=[])
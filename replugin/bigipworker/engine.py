@@ -0,0 +1,139 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Shared executor for blocking device calls.
+
+The BigIP library blocks for every call, so running calls concurrently
+takes threads. By default fan_out starts fresh threads for each fan
+out. An `Executor` keeps one worker-wide set of threads instead, reused
+across jobs and fan outs: threads are started as work arrives, up to
+`workers`, and then stay around for the next job. This also caps the
+threads the whole worker uses, however many jobs run at once.
+
+    executor = Executor(workers=64)
+    future = executor.submit(func, host)
+    future.result()
+"""
+
+import Queue
+import threading
+
+
+class Future(object):
+    """
+    The outcome of a call handed to an Executor.
+    """
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._error = None
+
+    def set_result(self, result):
+        self._result = result
+        self._done.set()
+
+    def set_error(self, error):
+        self._error = error
+        self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """
+        Wait for the call to finish and return what it returned, or
+        raise what it raised.
+        """
+        self._done.wait(timeout)
+        if not self._done.is_set():
+            raise RuntimeError('call did not finish within %ss' % timeout)
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+
+class Executor(object):
+    """
+    Thread safe pool of at most `workers` reusable daemon threads.
+    """
+
+    def __init__(self, workers=64):
+        self.workers = workers
+        self._queue = Queue.Queue()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._threads = []
+        self._idle = 0
+        self._stopped = False
+        self.submitted = 0
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Run `func(*args, **kwargs)` on a pool thread. Returns a Future.
+        """
+        future = Future()
+        with self._lock:
+            if self._stopped:
+                raise RuntimeError('executor is shut down')
+            self.submitted += 1
+            if self._idle == 0 and len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                self._threads.append(thread)
+                thread.start()
+            elif self._idle > 0:
+                self._idle -= 1
+        self._queue.put((future, func, args, kwargs))
+        return future
+
+    def in_worker(self):
+        """
+        Return True when called from one of the pool's threads. Work
+        submitted from there and waited on could wait for itself once
+        every thread is busy, so callers run it elsewhere.
+        """
+        return getattr(self._local, 'worker', False)
+
+    def _work(self):
+        self._local.worker = True
+        while True:
+            work = self._queue.get()
+            if work is None:
+                return
+            future, func, args, kwargs = work
+            try:
+                future.set_result(func(*args, **kwargs))
+            except Exception, e:
+                future.set_error(e)
+            with self._lock:
+                self._idle += 1
+
+    def shutdown(self):
+        """
+        Let the threads finish the calls already submitted, then exit.
+        """
+        with self._lock:
+            self._stopped = True
+            threads = len(self._threads)
+        for _ in range(threads):
+            self._queue.put(None)
+
+    def stats(self):
+        """
+        Return the threads started and calls submitted so far.
+        """
+        with self._lock:
+            return {'threads': len(self._threads), 'idle': self._idle,
+                    'submitted': self.submitted}
@@ -0,0 +1,159 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Bounded concurrency fan-out of per-host device calls.
+
+Rolling a large tier in or out of rotation one host at a time spends
+most of its time waiting on device round trips. `fan_out` spreads
+those calls over a small thread pool, optionally capping how many
+hosts of the same device/pool are worked on at once. `chunks` splits
+the hosts into about one call per thread, so fanning out does not
+multiply the number of device calls.
+"""
+
+import threading
+from collections import OrderedDict
+
+
+DEFAULT_CONCURRENCY = 8
+
+_DONE = object()
+
+
+def _interleave(hosts, group_of):
+    """
+    Order `hosts` round-robin across their groups so a group limit
+    does not park every pool thread on the same busy group.
+    """
+    groups = {}
+    order = []
+    for host in hosts:
+        key = group_of(host)
+        if key not in groups:
+            groups[key] = []
+            order.append(key)
+        groups[key].append(host)
+
+    interleaved = []
+    while len(interleaved) < len(hosts):
+        for key in order:
+            if groups[key]:
+                interleaved.append(groups[key].pop(0))
+    return interleaved
+
+
+def chunks(hosts, count, key=None, size=None):
+    """
+    Split `hosts` into about `count` tuples of hosts of equal size, in
+    order, each to be handled by one call.
+
+    `key` - Optional callable mapping a host to a value which all hosts
+    of a tuple share, such as the pool they are in.
+
+    `size` - Optional cap on the number of hosts per tuple.
+    """
+    hosts = list(hosts)
+    count = max(int(count or 1), 1)
+    per = max(-(-len(hosts) // count), 1)
+    if size:
+        per = min(per, size)
+    groups = OrderedDict()
+    for host in hosts:
+        groups.setdefault(key(host) if key else None, []).append(host)
+    return [tuple(group[start:start + per])
+            for group in groups.values()
+            for start in range(0, len(group), per)]
+
+
+def fan_out(func, hosts, concurrency=DEFAULT_CONCURRENCY, group_of=None,
+            group_concurrency=None, on_result=None, executor=None):
+    """
+    Call `func(host)` for every host in `hosts` using at most
+    `concurrency` threads.
+
+    `group_of` - Optional callable mapping a host to the device or pool
+    it belongs to. Combined with `group_concurrency` no more than that
+    many hosts of one group are in flight at the same time.
+
+    `on_result` - Optional callable, called as on_result(host, result,
+    error) as soon as each host is done, from the thread that ran it.
+
+    `executor` - Optional engine.Executor whose threads run the calls,
+    instead of threads started for this fan out. A fan out from within
+    one of its threads starts its own threads.
+
+    Returns a list of (host, result, error) tuples in the order of
+    `hosts`. A host whose call raised has a result of None and the
+    exception as error. One failing host never stops the others.
+    """
+    hosts = list(hosts)
+    results = {}
+
+    semaphores = {}
+    if group_of is not None and group_concurrency:
+        for host in hosts:
+            key = group_of(host)
+            if key not in semaphores:
+                semaphores[key] = threading.BoundedSemaphore(
+                    group_concurrency)
+        work = _interleave(hosts, group_of)
+    else:
+        work = hosts
+
+    def _run(host):
+        semaphore = semaphores.get(group_of(host)) if semaphores else None
+        if semaphore is not None:
+            semaphore.acquire()
+        try:
+            results[host] = (host, func(host), None)
+        except Exception, e:
+            results[host] = (host, None, e)
+        finally:
+            if semaphore is not None:
+                semaphore.release()
+        if on_result is not None:
+            on_result(*results[host])
+
+    workers = min(max(int(concurrency or 1), 1), len(work))
+    if workers <= 1:
+        for host in work:
+            _run(host)
+        return [results[host] for host in hosts]
+
+    queue = iter(work)
+    queue_lock = threading.Lock()
+
+    def _worker():
+        while True:
+            with queue_lock:
+                host = next(queue, _DONE)
+            if host is _DONE:
+                return
+            _run(host)
+
+    if executor is not None and not executor.in_worker():
+        for future in [executor.submit(_worker) for _ in range(workers)]:
+            future.result()
+        return [results[host] for host in hosts]
+
+    # Plain threads rather than multiprocessing.pool.ThreadPool, whose
+    # close()/join() polls its handler thread every 100ms.
+    threads = [threading.Thread(target=_worker) for _ in range(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return [results[host] for host in hosts]
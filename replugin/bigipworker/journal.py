@@ -0,0 +1,238 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Write-ahead journal of jobs and the hosts they finished.
+
+Messages are acked before their job runs, so a worker dying halfway
+through loses the job. The journal keeps one JSON record per line for
+every job, keyed by its correlation id:
+
+    {"id": "...", "op": "start", "job": {...}}
+    {"id": "...", "op": "host", "host": "web1", "state": "disabled"}
+    {"id": "...", "op": "finish"}
+
+Jobs started but not finished are returned by pending() when the
+journal is opened again, along with the hosts they already finished.
+A job started again under the same id, as when the broker redelivers
+its message, keeps the hosts it already finished.
+
+The file is memory mapped and grown in `chunk` sized steps, so an
+append is a copy into memory. Appends are flushed to disk in batches
+by sync(), called every `sync_interval` seconds by the background
+thread. Start records are flushed right away: a lost host record only
+means a host is changed again, but a lost start record loses the job.
+compact() rewrites the file with only the unfinished jobs.
+"""
+
+import json
+import mmap
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class Journal(object):
+    """
+    Thread safe append-only journal at `path`.
+    """
+
+    def __init__(self, path, chunk=1 << 20):
+        self.path = path
+        self.chunk = chunk
+        self._lock = threading.Lock()
+        self._live = OrderedDict()
+        self._dirty = False
+        self._closed = False
+        self._stopped = threading.Event()
+        self._thread = None
+        self.syncs = 0
+        self.compactions = 0
+        self._open()
+
+    def _open(self):
+        if not os.path.exists(self.path):
+            open(self.path, 'wb').close()
+        self._file = open(self.path, 'r+b')
+        size = os.fstat(self._file.fileno()).st_size
+        if size < self.chunk:
+            self._file.truncate(self.chunk)
+            size = self.chunk
+        self._map = mmap.mmap(self._file.fileno(), size)
+
+        data = self._map[:]
+        end = data.find('\0')
+        if end == -1:
+            end = len(data)
+        # A record cut short by a crash is dropped and overwritten
+        self._offset = data.rfind('\n', 0, end) + 1
+        if self._offset < end:
+            self._map[self._offset:end] = '\0' * (end - self._offset)
+
+        self._live = OrderedDict()
+        for line in data[:self._offset].splitlines():
+            try:
+                self._track(json.loads(line), line)
+            except (ValueError, KeyError, TypeError):
+                continue
+
+    def _track(self, record, line):
+        op = record['op']
+        if op == 'start':
+            lines = self._live.get(record['id'])
+            if lines:
+                lines[0] = line
+            else:
+                self._live[record['id']] = [line]
+        elif op == 'finish':
+            self._live.pop(record['id'], None)
+        elif record['id'] in self._live:
+            self._live[record['id']].append(line)
+
+    def append(self, record, sync=False):
+        """
+        Append `record` (a dict with 'id' and 'op'), flushing it to
+        disk right away with `sync`.
+        """
+        line = json.dumps(record, separators=(',', ':'))
+        data = line + '\n'
+        with self._lock:
+            end = self._offset + len(data)
+            if end > len(self._map):
+                size = max(end + self.chunk, len(self._map) * 2)
+                self._map.flush()
+                self._map.close()
+                self._file.truncate(size)
+                self._map = mmap.mmap(self._file.fileno(), size)
+            self._map[self._offset:end] = data
+            self._offset = end
+            self._track(record, line)
+            self._dirty = True
+        if sync:
+            self.sync()
+
+    def start(self, job_id, job):
+        """
+        Record that job `job_id` started. `job` is what is needed to
+        run it again.
+        """
+        self.append({'id': job_id, 'op': 'start', 'job': job}, sync=True)
+
+    def host_done(self, job_id, host, state):
+        """
+        Record that job `job_id` put `host` in `state`.
+        """
+        self.append({'id': job_id, 'op': 'host', 'host': host,
+                     'state': state})
+
+    def finish(self, job_id):
+        """
+        Record that job `job_id` is done with, one way or the other.
+        """
+        self.append({'id': job_id, 'op': 'finish'})
+
+    def pending(self):
+        """
+        Return an OrderedDict of job id -> {'job': ..., 'done': {host:
+        state}} for every job started but not finished.
+        """
+        with self._lock:
+            live = [(job_id, list(lines))
+                    for (job_id, lines) in self._live.items()]
+        return OrderedDict((job_id, self._entry(lines))
+                           for (job_id, lines) in live)
+
+    def entry(self, job_id):
+        """
+        Return {'job': ..., 'done': {host: state}} for job `job_id` when
+        it is started but not finished, else None.
+        """
+        with self._lock:
+            lines = list(self._live.get(job_id) or [])
+        if not lines:
+            return None
+        return self._entry(lines)
+
+    def _entry(self, lines):
+        records = [json.loads(line) for line in lines]
+        return {
+            'job': records[0]['job'],
+            'done': dict((r['host'], r['state'])
+                         for r in records[1:] if r['op'] == 'host'),
+        }
+
+    def sync(self):
+        """
+        Flush appended records to disk.
+        """
+        with self._lock:
+            if self._closed or not self._dirty:
+                return
+            self._map.flush()
+            self._dirty = False
+            self.syncs += 1
+
+    def compact(self):
+        """
+        Rewrite the journal with only the records of unfinished jobs.
+        """
+        with self._lock:
+            lines = [line for records in self._live.values()
+                     for line in records]
+            temp = '%s.tmp' % self.path
+            with open(temp, 'wb') as compacted:
+                compacted.write(''.join(line + '\n' for line in lines))
+                compacted.flush()
+                os.fsync(compacted.fileno())
+            self._map.close()
+            self._file.close()
+            os.rename(temp, self.path)
+            self._open()
+            self._dirty = False
+            self.compactions += 1
+
+    def start_background(self, sync_interval=0.1, compact_interval=3600):
+        """
+        Sync every `sync_interval` seconds and compact every
+        `compact_interval` seconds from a daemon thread.
+        """
+        def _loop():
+            compacted = time.time()
+            while not self._stopped.wait(sync_interval):
+                self.sync()
+                if time.time() - compacted >= compact_interval:
+                    self.compact()
+                    compacted = time.time()
+
+        if self._thread is None:
+            self._thread = threading.Thread(target=_loop)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def close(self):
+        """
+        Stop the background thread, if any, and close the journal.
+        Closing it again does nothing.
+        """
+        self._stopped.set()
+        if (self._thread is not None and
+                self._thread is not threading.current_thread()):
+            self._thread.join()
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._map.flush()
+            self._map.close()
+            self._file.close()
@@ -0,0 +1,184 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Latency instrumentation.
+
+Timings are recorded in milliseconds into per-name histograms, which
+can be read back with Metrics.snapshot() and are logged at debug level
+after every job, and every sample is also handed to a sink:
+
+* MemorySink - Keeps nothing beyond the histograms (the default).
+* LogSink - Logs one line per sample.
+* StatsdSink - Sends each sample as a statsd timer over UDP, with its
+  tags appended to the name (device.state.host.web1_example_com).
+
+Names used by the worker:
+
+* job.<subcommand> - A whole job, from delivery to final reply.
+* phase.<phase> - validate, run and reply phases of a job.
+* subcommand.<subcommand> - The config_sync/in_rotation/out_of_rotation
+  call.
+* show - Reading back host state.
+* device.<command> - Every BigIP call, tagged with the host when it
+  was made for a single host.
+* drain, healthy - Waiting for hosts to drain or to become available.
+* warm_up - Loading the BigIP library before the first job.
+"""
+
+import re
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+
+# Upper bounds of the histogram buckets, in milliseconds
+BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000,
+           20000, 60000, 120000, 300000, float('inf'))
+
+
+class Histogram(object):
+    """
+    Fixed bucket latency histogram.
+    """
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, q):
+        """
+        Return the upper bound of the bucket holding the `q`th
+        percentile, capped at the largest value seen.
+        """
+        if not self.count:
+            return 0.0
+        rank = q / 100.0 * self.count
+        seen = 0
+        for i, bound in enumerate(BUCKETS):
+            seen += self.counts[i]
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0.0,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'max': self.max,
+        }
+
+
+class MemorySink(object):
+    """
+    Sink which does nothing, use Metrics.snapshot() to read timings.
+    """
+
+    def emit(self, name, value, tags):
+        pass
+
+
+class LogSink(object):
+    """
+    Log every timing on `logger`.
+    """
+
+    def __init__(self, logger):
+        self.logger = logger
+
+    def emit(self, name, value, tags):
+        self.logger.info('bigip: Timing %s %.1fms%s' % (
+            name, value,
+            ''.join(' %s=%s' % item for item in sorted(tags.items()))))
+
+
+# Characters statsd reads as separators in a metric name
+_STATSD_UNSAFE = re.compile(r'[.:|@\s/]')
+
+
+class StatsdSink(object):
+    """
+    Send every timing to a statsd daemon at `host`:`port`. Statsd has no
+    tags, so each tag becomes part of the name as `.<tag>.<value>`.
+    """
+
+    def __init__(self, host='127.0.0.1', port=8125, prefix='bigip.'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def emit(self, name, value, tags):
+        name += ''.join(
+            '.%s.%s' % (tag, _STATSD_UNSAFE.sub('_', str(tag_value)))
+            for (tag, tag_value) in sorted(tags.items()))
+        try:
+            self.socket.sendto(
+                '%s%s:%.3f|ms' % (self.prefix, name, value), self.address)
+        except socket.error:
+            pass
+
+
+class Metrics(object):
+    """
+    Thread safe collection of named latency histograms.
+    """
+
+    def __init__(self, sink=None, clock=time.time):
+        self.sink = sink or MemorySink()
+        self._clock = clock
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def record(self, name, value, **tags):
+        """
+        Record a timing of `value` milliseconds for `name`.
+        """
+        with self._lock:
+            if name not in self._histograms:
+                self._histograms[name] = Histogram()
+            self._histograms[name].add(value)
+        self.sink.emit(name, value, tags)
+
+    @contextmanager
+    def timer(self, name, **tags):
+        """
+        Record how long the block takes as `name`, also when it raises.
+        """
+        start = self._clock()
+        try:
+            yield
+        finally:
+            self.record(name, (self._clock() - start) * 1000.0, **tags)
+
+    def snapshot(self):
+        """
+        Return a dict of name -> count, mean, p50, p90, p99 and max.
+        """
+        with self._lock:
+            return dict((name, histogram.summary())
+                        for name, histogram in self._histograms.items())
@@ -0,0 +1,124 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Batched polling of member status until a condition holds.
+
+Rather than polling every host on its own, each round queries all hosts
+still being waited on in one call. The delay between rounds starts at
+`interval` and grows by `backoff` up to `max_interval` while no host
+finishes, dropping back to `interval` as soon as one does.
+"""
+
+import re
+import time
+
+
+_CONNECTIONS = re.compile(
+    r'\b(?:cur(?:rent)?[_ ]?conn\w*|conn(?:ection)?s?)'
+    r'(?:\s*[:=]\s*|\s+)(\d+)\b',
+    re.IGNORECASE)
+
+
+def connection_count(lines):
+    """
+    Return the total current connection count found in the 'show'
+    `lines` of one host (summed over its pools), or None if none of the
+    lines report one.
+    """
+    counts = [int(match.group(1)) for match in
+              (_CONNECTIONS.search(line) for line in lines) if match]
+    if not counts:
+        return None
+    return sum(counts)
+
+
+_AVAILABILITY = re.compile(
+    r'\b(available|unavailable|offline|unknown)\b', re.IGNORECASE)
+
+
+def availability(lines):
+    """
+    Return the monitor status found in the 'show' `lines` of one host:
+    'available' when every line that reports a status says available,
+    otherwise the first other status seen ('offline', 'unavailable' or
+    'unknown'). None if no line reports a status.
+    """
+    statuses = [match.group(1).lower() for match in
+                (_AVAILABILITY.search(line) for line in lines) if match]
+    if not statuses:
+        return None
+    for status in statuses:
+        if status != 'available':
+            return status
+    return 'available'
+
+
+_MEMBER_STATE = re.compile(r'\b(enabled|disabled)\b', re.IGNORECASE)
+
+
+def member_state(lines):
+    """
+    Return 'enabled' or 'disabled' when every 'show' line of one host
+    that reports a member state agrees on it, otherwise None.
+    """
+    states = set(match.group(1).lower() for match in
+                 (_MEMBER_STATE.search(line) for line in lines) if match)
+    if len(states) != 1:
+        return None
+    return states.pop()
+
+
+def wait_for(poll, hosts, done, timeout, interval=1.0, max_interval=10.0,
+             backoff=2.0, clock=time.time, sleep=time.sleep):
+    """
+    Poll until `done(value)` is true for every host or `timeout`
+    seconds passed.
+
+    `poll` - Callable taking the list of hosts still pending and
+    returning a dict of host -> value in one query. Hosts missing from
+    the dict get a value of None.
+
+    `done` - Callable deciding from a value whether a host is finished.
+    A value of None is never finished.
+
+    Returns a tuple of (finished, pending, rounds). `finished` and
+    `pending` are dicts of host -> last value polled.
+    """
+    deadline = clock() + timeout
+    delay = interval
+    finished = {}
+    pending = dict((host, None) for host in hosts)
+    rounds = 0
+
+    while pending:
+        values = poll(sorted(pending))
+        rounds += 1
+        progressed = False
+        for host in list(pending):
+            value = values.get(host)
+            pending[host] = value
+            if value is not None and done(value):
+                finished[host] = pending.pop(host)
+                progressed = True
+
+        remaining = deadline - clock()
+        if not pending or remaining <= 0:
+            break
+        if progressed:
+            delay = interval
+        sleep(min(delay, remaining))
+        if not progressed:
+            delay = min(delay * backoff, max_interval)
+
+    return (finished, pending, rounds)
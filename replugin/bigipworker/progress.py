@@ -0,0 +1,75 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Streaming per-host progress replies.
+
+Hosts finishing their state change are buffered and published
+together as one message:
+
+    {'status': 'progress', 'state': 'disabled',
+     'completed': ['web1', ...], 'failed': ['web7', ...]}
+
+A message goes out at most every `interval` seconds, or sooner once
+`batch_size` hosts are waiting. Whatever is left is published by
+flush(), before the final completed/failed reply.
+"""
+
+import threading
+import time
+
+
+class ProgressPublisher(object):
+    """
+    Buffer host transitions and publish them through `publish(message)`.
+    """
+
+    def __init__(self, publish, interval=1.0, batch_size=50,
+                 clock=time.time):
+        self.publish = publish
+        self.interval = interval
+        self.batch_size = batch_size
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._last = 0
+        self.sent = 0
+
+    def host_done(self, host, state, ok=True):
+        """
+        Record that `host` finished changing to `state`, or failed to.
+        """
+        with self._lock:
+            pending = self._pending.setdefault(
+                state, {'completed': [], 'failed': []})
+            pending['completed' if ok else 'failed'].append(host)
+            waiting = sum(len(p['completed']) + len(p['failed'])
+                          for p in self._pending.values())
+            due = (waiting >= self.batch_size or
+                   self._clock() - self._last >= self.interval)
+        if due:
+            self.flush()
+
+    def flush(self):
+        """
+        Publish everything buffered so far.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last = self._clock()
+        for state, hosts in sorted(pending.items()):
+            message = {'status': 'progress', 'state': state}
+            message.update(hosts)
+            self.publish(message)
+            with self._lock:
+                self.sent += 1
@@ -0,0 +1,197 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Per-device rate limiting and adaptive concurrency.
+
+The F5 management plane starts timing out well before the worker runs
+out of threads. Every device call can be made to go through a
+`DeviceLimiter`, which per device key holds:
+
+* a `TokenBucket` capping calls per second, with bursts of up to
+  `burst` calls, and
+* an `AdaptiveLimit` capping calls in flight. The limit grows by one
+  per limit's worth of calls answered within `latency_target` seconds
+  and is halved (at most once per `cooldown` seconds) when a call
+  fails or is slower than that (AIMD).
+
+The time callers spend waiting on either is returned so it can be
+reported.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+
+class TokenBucket(object):
+    """
+    Thread safe token bucket refilling at `rate` tokens per second.
+    """
+
+    def __init__(self, rate, burst=None, clock=time.time, sleep=time.sleep):
+        self.rate = float(rate)
+        self.burst = float(burst or max(1, rate))
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._tokens = self.burst
+        self._updated = clock()
+
+    def take(self):
+        """
+        Take one token, sleeping until it is available. Returns the
+        seconds slept.
+
+        Callers reserve their token up front, so concurrent callers
+        queue up one 1/rate apart rather than racing for each refill.
+        """
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(
+                self.burst,
+                self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            wait = max(0.0, -self._tokens / self.rate)
+        if wait:
+            self._sleep(wait)
+        return wait
+
+
+class AdaptiveLimit(object):
+    """
+    Thread safe cap on calls in flight, adjusted by AIMD.
+    """
+
+    def __init__(self, limit, minimum=1, maximum=None, latency_target=1.0,
+                 backoff=0.5, cooldown=1.0, clock=time.time):
+        self.limit = float(limit)
+        self.minimum = minimum
+        self.maximum = maximum or limit
+        self.latency_target = latency_target
+        self.backoff = backoff
+        self.cooldown = cooldown
+        self._clock = clock
+        self._cond = threading.Condition()
+        self._decreased = None
+        self.in_flight = 0
+
+    def acquire(self):
+        """
+        Wait for a free slot. Returns the seconds waited.
+        """
+        started = self._clock()
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+        return self._clock() - started
+
+    def release(self, latency, ok=True):
+        """
+        Free a slot, adjusting the limit by how the call went.
+        """
+        with self._cond:
+            self.in_flight -= 1
+            if ok and latency <= self.latency_target:
+                self.limit = min(self.maximum,
+                                 self.limit + 1.0 / self.limit)
+            else:
+                now = self._clock()
+                if (self._decreased is None or
+                        now - self._decreased >= self.cooldown):
+                    self._decreased = now
+                    self.limit = max(self.minimum,
+                                     self.limit * self.backoff)
+            self._cond.notify_all()
+
+
+class DeviceLimiter(object):
+    """
+    Rate and concurrency limits per device key.
+
+    `rate` - Calls per second per device, 0 for no rate limit.
+
+    `concurrency` - Initial and maximum calls in flight per device, 0
+    for no concurrency limit. The rest of the keyword arguments go to
+    AdaptiveLimit.
+    """
+
+    def __init__(self, rate=0, burst=None, concurrency=0,
+                 clock=time.time, sleep=time.sleep, **adaptive):
+        self.rate = rate
+        self.burst = burst
+        self.concurrency = concurrency
+        self.adaptive = adaptive
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._devices = {}
+        self.throttled = 0.0
+
+    def _for(self, key):
+        with self._lock:
+            if key not in self._devices:
+                bucket = limit = None
+                if self.rate:
+                    bucket = TokenBucket(self.rate, self.burst,
+                                         self._clock, self._sleep)
+                if self.concurrency:
+                    limit = AdaptiveLimit(self.concurrency,
+                                          clock=self._clock, **self.adaptive)
+                self._devices[key] = (bucket, limit)
+            return self._devices[key]
+
+    @contextmanager
+    def throttle(self, key):
+        """
+        Context manager around one call to device `key`. Yields the
+        seconds the call was held back.
+        """
+        bucket, limit = self._for(key)
+        waited = 0.0
+        if limit is not None:
+            waited += limit.acquire()
+        try:
+            if bucket is not None:
+                waited += bucket.take()
+        except:
+            if limit is not None:
+                limit.release(0.0)
+            raise
+        with self._lock:
+            self.throttled += waited
+
+        started = self._clock()
+        ok = False
+        try:
+            yield waited
+            ok = True
+        finally:
+            if limit is not None:
+                limit.release(self._clock() - started, ok)
+
+    def stats(self):
+        """
+        Return a dict of device key -> current concurrency limit and
+        calls in flight, plus the total seconds throttled.
+        """
+        with self._lock:
+            devices = dict(self._devices)
+            stats = {'throttled': round(self.throttled, 3)}
+        for key, (_, limit) in devices.items():
+            if limit is not None:
+                stats[key] = {'limit': int(limit.limit),
+                              'in_flight': limit.in_flight}
+        return stats
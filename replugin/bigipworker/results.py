@@ -0,0 +1,192 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Structured pool member results.
+
+The BigIP entry points only print what they find. `parse_show` turns
+that printed 'show' output back into a list of `Member` objects, one
+per pool member line, which serialize to plain dicts for the JSON
+reply body:
+
+    {'host': 'web1', 'pool': 'pool_a', 'member': 'web1:80',
+     'enabled': True, 'availability': 'available', 'connections': 3}
+
+Fields which a line does not report are None.
+
+`diff` compares the members shown before and after a state change and
+keeps only those that changed, for replies and logs which would
+otherwise repeat every member of every host.
+"""
+
+import re
+
+from replugin.bigipworker import capture
+from replugin.bigipworker import polling
+
+
+_MEMBER = re.compile(r'^\S+:\d+$')
+
+# Fields diff() compares. Connection counts change all the time, so a
+# member is not taken as changed for them.
+DIFFED = ('enabled', 'availability')
+
+# Tokens which never name a pool
+_KEYWORDS = set(['enabled', 'disabled', 'available', 'unavailable',
+                 'offline', 'unknown'])
+
+
+class Member(object):
+    """
+    One pool member of one host.
+    """
+
+    __slots__ = ('host', 'pool', 'member', 'enabled', 'availability',
+                 'connections')
+
+    def __init__(self, host, pool=None, member=None, enabled=None,
+                 availability=None, connections=None):
+        self.host = host
+        self.pool = pool
+        self.member = member
+        self.enabled = enabled
+        self.availability = availability
+        self.connections = connections
+
+    def to_dict(self):
+        """
+        Return the member as a dict ready for JSON serialization.
+        """
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+    def __eq__(self, other):
+        return (isinstance(other, Member) and
+                self.to_dict() == other.to_dict())
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'Member(%s)' % ", ".join(
+            "%s=%r" % (name, getattr(self, name)) for name in self.__slots__)
+
+
+def parse_line(line, host):
+    """
+    Return a Member for one 'show' `line` about `host`, or None when
+    the line reports neither a member state nor a host:port member.
+    """
+    state = polling.member_state([line])
+    tokens = line.split()
+    member = None
+    for token in tokens:
+        if _MEMBER.match(token):
+            member = token
+            break
+    if state is None and member is None:
+        return None
+
+    pool = None
+    for token in tokens:
+        if (token not in (host, member) and '=' not in token and
+                ':' not in token and token.lower() not in _KEYWORDS):
+            pool = token
+            break
+
+    return Member(
+        host, pool=pool, member=member,
+        enabled=None if state is None else state == 'enabled',
+        availability=polling.availability([line]),
+        connections=polling.connection_count([line]))
+
+
+def parse_show(text, hosts=None):
+    """
+    Convert printed 'show' `text` into a list of Members.
+
+    `hosts` - The hosts the output is about. Lines are attributed to
+    the host they mention (see capture.split_by_host) and returned in
+    the order of `hosts`. Without it the first word of every line is
+    taken as its host.
+    """
+    if hosts is None:
+        members = (parse_line(line, line.split()[0])
+                   for line in text.splitlines() if line.strip())
+    else:
+        shown = capture.split_by_host(text, hosts)
+        members = (parse_line(line, host)
+                   for host in hosts for line in shown[host])
+    return [member for member in members if member is not None]
+
+
+def summary(members):
+    """
+    Return a one line summary of `members`.
+    """
+    enabled = len([m for m in members if m.enabled])
+    disabled = len([m for m in members if m.enabled is False])
+    hosts = len(set(m.host for m in members))
+    return '%s member(s) of %s host(s): %s enabled, %s disabled' % (
+        len(members), hosts, enabled, disabled)
+
+
+def diff(before, after):
+    """
+    Return a list of dicts for the Members in `after` whose DIFFED
+    fields differ from the same member (same host, pool and member) in
+    `before`, followed by those only `before` has:
+
+        {'host': 'web1', 'pool': 'pool_a', 'member': 'web1:80',
+         'changes': {'enabled': [False, True]}}
+
+    Fields of a member missing on one side count as None there.
+    """
+    def _key(member):
+        return (member.host, member.pool, member.member)
+
+    old = dict((_key(member), member) for member in before)
+    seen = set()
+    changes = []
+    for member in after:
+        key = _key(member)
+        seen.add(key)
+        changes.append(_changes(old.get(key), member, key))
+    for member in before:
+        if _key(member) not in seen:
+            changes.append(_changes(member, None, _key(member)))
+    return [change for change in changes if change['changes']]
+
+
+def _changes(old, new, key):
+    changed = {}
+    for name in DIFFED:
+        was = getattr(old, name, None)
+        now = getattr(new, name, None)
+        if was != now:
+            changed[name] = [was, now]
+    return {'host': key[0], 'pool': key[1], 'member': key[2],
+            'changes': changed}
+
+
+def format_diff(changes, total):
+    """
+    Return `changes` (see diff) as text, one line per member, after a
+    line saying how many of `total` members changed.
+    """
+    lines = ['%s of %s member(s) changed' % (len(changes), total)]
+    for change in changes:
+        lines.append('%s %s %s %s' % (
+            change['host'], change['pool'] or '-', change['member'] or '-',
+            ", ".join('%s %s -> %s' % (name, was, now) for (name, (was, now))
+                      in sorted(change['changes'].items()))))
+    return "\n".join(lines)
@@ -0,0 +1,111 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Retrying transient device errors within a deadline.
+
+A call failing with a transient error (see `retryable`) is tried again
+after a jittered, exponentially growing delay: a random time between 0
+and `delay` * 2 ** (attempt - 1), capped at `max_delay`. Retrying stops
+after `attempts` tries, on the first fatal error, or when the next try
+would start after the `Deadline`.
+"""
+
+import random
+import re
+import socket
+import time
+
+
+# Programming errors, never worth another try
+FATAL = (AssertionError, AttributeError, ImportError, KeyError, NameError,
+         TypeError, ValueError)
+
+_TRANSIENT = re.compile(
+    r'time[ds]? ?out|temporar|try again|connection (?:reset|refused|'
+    r'aborted)|broken pipe|unavailable|\b50[234]\b',
+    re.IGNORECASE)
+
+
+class DeadlineExceeded(Exception):
+    """
+    Raised instead of making a call after the deadline passed.
+    """
+    pass
+
+
+class Deadline(object):
+    """
+    A point in time, `at` (seconds since the epoch), work has to be
+    done by.
+    """
+
+    def __init__(self, at, clock=time.time):
+        self.at = at
+        self._clock = clock
+
+    def remaining(self):
+        """
+        Return the seconds left, negative once the deadline passed.
+        """
+        return self.at - self._clock()
+
+    def expired(self):
+        return self.remaining() <= 0
+
+
+def retryable(error):
+    """
+    Return True if `error` looks transient: a socket or other I/O
+    error, or any error whose type or message speaks of a timeout, a
+    temporary failure, a reset connection or an unavailable service.
+    """
+    if isinstance(error, FATAL + (DeadlineExceeded,)):
+        return False
+    if isinstance(error, (socket.error, EnvironmentError)):
+        return True
+    return bool(_TRANSIENT.search(
+        '%s %s' % (type(error).__name__, error)))
+
+
+def call(func, attempts=3, delay=0.5, max_delay=10.0, deadline=None,
+         is_retryable=retryable, on_retry=None, sleep=time.sleep,
+         jitter=random.random):
+    """
+    Return `func()`, retrying transient errors.
+
+    `deadline` - Optional Deadline. No try is started after it, and
+    no retry whose delay would end after it.
+
+    `on_retry` - Optional callable, called as on_retry(error, attempt,
+    wait) before sleeping `wait` seconds to retry after the failed try
+    number `attempt`.
+
+    The error of the last try is raised when all of them failed.
+    """
+    attempt = 0
+    while True:
+        if deadline is not None and deadline.expired():
+            raise DeadlineExceeded('deadline exceeded')
+        attempt += 1
+        try:
+            return func()
+        except Exception, e:
+            if attempt >= attempts or not is_retryable(e):
+                raise
+            wait = jitter() * min(max_delay, delay * 2 ** (attempt - 1))
+            if deadline is not None and wait >= deadline.remaining():
+                raise
+            if on_retry is not None:
+                on_retry(e, attempt, wait)
+            sleep(wait)
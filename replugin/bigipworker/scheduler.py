@@ -0,0 +1,187 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Priority lanes with admission control.
+
+Jobs are sorted into lanes by subcommand, as in the 'lanes' worker
+setting:
+
+    "lanes": [
+        {"name": "rotation", "subcommands": ["InRotation", "OutOfRotation"],
+         "concurrency": 4, "backlog": 200},
+        {"name": "sync", "subcommands": ["ConfigSync"],
+         "concurrency": 1, "backlog": 10, "overflow": "defer"}
+    ]
+
+Every lane runs its jobs on its own `concurrency` threads, so a burst
+in one lane never holds up another. Within a lane the job with the
+highest priority goes first, oldest first among equals. A lane
+without 'subcommands' takes every other subcommand; without one a
+'default' lane is added.
+
+Once `backlog` jobs wait in a lane, submit() turns new ones away with
+the lane's `overflow` policy: 'reject' (the default) or 'defer'.
+"""
+
+import heapq
+import itertools
+import threading
+import time
+from collections import OrderedDict
+
+
+class Lane(object):
+    """
+    One queue of waiting jobs, and the threads working it off.
+    """
+
+    def __init__(self, name, subcommands=None, concurrency=1, backlog=100,
+                 overflow='reject'):
+        if overflow not in ('reject', 'defer'):
+            raise ValueError('Unknown lane overflow policy: %s' % overflow)
+        self.name = name
+        self.subcommands = subcommands
+        self.concurrency = concurrency
+        self.backlog = backlog
+        self.overflow = overflow
+        self.cond = threading.Condition()
+        self.heap = []
+        self.running = 0
+        self.admitted = 0
+        self.turned_away = 0
+        self.started = 0
+        self.waited = 0.0
+        self.max_wait = 0.0
+
+
+class Scheduler(object):
+    """
+    Run submitted jobs through their lane, calling `run(job, lane,
+    waited)` from a lane thread for each, with `waited` the seconds
+    the job sat in the lane.
+    """
+
+    def __init__(self, lanes, run, clock=time.time):
+        self.run = run
+        self._clock = clock
+        self._seq = itertools.count()
+        self.lanes = OrderedDict()
+        for lane in lanes:
+            lane = dict(lane)
+            self.lanes[lane['name']] = Lane(**lane)
+        if not [l for l in self.lanes.values() if l.subcommands is None]:
+            self.lanes['default'] = Lane('default')
+        self._threads = []
+        self._stopped = False
+
+    def lane_for(self, subcommand):
+        """
+        Return the name of the lane jobs of `subcommand` go to.
+        """
+        fallback = None
+        for lane in self.lanes.values():
+            if lane.subcommands is None:
+                fallback = fallback or lane.name
+            elif subcommand in lane.subcommands:
+                return lane.name
+        return fallback
+
+    def submit(self, lane, job, priority=0):
+        """
+        Queue `job` in `lane`. Returns 'queued', or the lane's overflow
+        policy ('reject' or 'defer') when its backlog is full or the
+        scheduler is stopped, in which case the job is not queued.
+        """
+        lane = self.lanes[lane]
+        with lane.cond:
+            if self._stopped or len(lane.heap) >= lane.backlog:
+                lane.turned_away += 1
+                return lane.overflow
+            heapq.heappush(lane.heap, (
+                -priority, next(self._seq), self._clock(), job))
+            lane.admitted += 1
+            lane.cond.notify()
+        return 'queued'
+
+    def start(self):
+        """
+        Start the lane threads.
+        """
+        if self._threads:
+            return
+        for lane in self.lanes.values():
+            for _ in range(lane.concurrency):
+                thread = threading.Thread(target=self._work, args=(lane,))
+                thread.daemon = True
+                self._threads.append(thread)
+                thread.start()
+
+    def stop(self):
+        """
+        Turn new jobs away and let the lane threads exit once the jobs
+        already queued are done.
+        """
+        for lane in self.lanes.values():
+            with lane.cond:
+                self._stopped = True
+                lane.cond.notify_all()
+
+    def _work(self, lane):
+        while True:
+            with lane.cond:
+                while not lane.heap:
+                    if self._stopped:
+                        return
+                    lane.cond.wait()
+                _, _, queued, job = heapq.heappop(lane.heap)
+                waited = self._clock() - queued
+                lane.running += 1
+                lane.started += 1
+                lane.waited += waited
+                lane.max_wait = max(lane.max_wait, waited)
+            try:
+                self.run(job, lane.name, waited)
+            except Exception:
+                pass
+            finally:
+                with lane.cond:
+                    lane.running -= 1
+
+    def capacity(self):
+        """
+        Return how many jobs all lanes together can hold, running or
+        waiting.
+        """
+        return sum(lane.concurrency + lane.backlog
+                   for lane in self.lanes.values())
+
+    def stats(self):
+        """
+        Return a dict of lane name -> depth (jobs waiting), running,
+        admitted and turned away counts, and the mean and longest
+        seconds jobs waited before they started.
+        """
+        stats = {}
+        for name, lane in self.lanes.items():
+            with lane.cond:
+                stats[name] = {
+                    'depth': len(lane.heap),
+                    'running': lane.running,
+                    'admitted': lane.admitted,
+                    'turned_away': lane.turned_away,
+                    'mean_wait': lane.waited / lane.started
+                    if lane.started else 0.0,
+                    'max_wait': lane.max_wait,
+                }
+        return stats
@@ -19,12 +19,12 @@ Unittests for the BigIP Worker
 import pika
 import mock
 import copy
+import threading
 
 from contextlib import nested
 from . import TestCase
 from replugin import bigipworker
 from replugin.bigipworker import BigipWorkerError
-import replugin.bigipworker.parser
 
 MQ_CONF = {
     'server': '127.0.0.1',
@@ -43,6 +43,22 @@ _base_params = {
     }
 }
 
+def _recorder(fake_call=None):
+    """
+    Return a list and a dispatch.call side effect appending every call
+    to it, as a mock.call of (name, args, kwargs), before running
+    `fake_call`. A mock's own call records can lose calls made from
+    several fan out threads at once.
+    """
+    calls = []
+
+    def _call(name, **kwargs):
+        calls.append(mock.call(name, **kwargs))
+        if fake_call is not None:
+            return fake_call(name, **kwargs)
+    return calls, _call
+
+
 class TestBigipWorker(TestCase):
 
     def setUp(self):
@@ -104,6 +120,7 @@ class TestBigipWorker(TestCase):
         ##############################################################
         # Other random stuff
         self.channel = mock.MagicMock('pika.spec.Channel')
+        self.channel.connection = mock.MagicMock()
         self.channel.basic_consume = mock.Mock('basic_consume')
         self.channel.basic_ack = mock.Mock('basic_ack')
         self.channel.basic_publish = mock.Mock('basic_publish')
@@ -120,8 +137,6 @@ class TestBigipWorker(TestCase):
         self.logger = mock.MagicMock('logging.Logger').__call__()
         self.connection = mock.MagicMock('pika.SelectConnection')
 
-        self.parser = replugin.bigipworker.parser.parser
-
     def _assert_error_conditions(self, worker, error_msg):
         """
         Common asserts for handled errors.
@@ -188,12 +203,10 @@ call can be made.
         """
         _params = self.configsync_params_good['parameters']
 
-        namespace = mock.Mock('argparse.Namespace', name="parse_args result")
-        namespace.func = mock.MagicMock(name="namespace default function")
-        parser = mock.MagicMock('argparse.ArgumentParser').__call__()
-        parser.parse_args.__call__().return_value = namespace
-
-        with mock.patch('pika.SelectConnection'):
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.bigipworker.dispatch.call')) as (
+                    _, call):
             worker = bigipworker.BigipWorker(
                 MQ_CONF,
                 logger=self.app_logger,
@@ -202,10 +215,9 @@ call can be made.
             worker._on_open(self.connection)
             worker._on_channel_open(self.channel)
             worker.validate_inputs(_params)
-            worker.config_sync(parser)
+            worker.config_sync()
 
-            parser.parse_args.assert_called_with(
-                ['sync', '-e', _params['envs'][0]])
+            call.assert_called_with('sync', environments=_params['envs'])
 
     ##################################################################
     # Rotation tests
@@ -240,11 +252,11 @@ call can be made.
     def test_run_inrotation_good(self):
         """InRotation works correctly"""
         _params = self.inrotation_params_good['parameters']
-        namespace = mock.Mock('argparse.Namespace')
-        parser = mock.MagicMock('argparse.ArgumentParser').__call__()
-        parser.parse_args.__call__().return_value = namespace
 
-        with mock.patch('pika.SelectConnection'):
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.bigipworker.dispatch.call')) as (
+                    _, call):
             worker = bigipworker.BigipWorker(
                 MQ_CONF,
                 logger=self.app_logger,
@@ -254,22 +266,26 @@ call can be made.
             worker._on_channel_open(self.channel)
             worker.validate_inputs(_params)
 
-            worker.in_rotation(parser)
+            worker.in_rotation()
 
-            self.assertEqual(parser.parse_args.call_count, 3)
-            parser.parse_args.mock_calls[1].assert_called_with(
-                ['state', '-e', _params['hosts'][0]])
+            self.assertEqual(call.call_count, 2)
+            self.assertEqual(
+                call.call_args_list[0],
+                mock.call('state', enabled_hosts=_params['hosts']))
+            self.assertEqual(
+                call.call_args_list[1],
+                mock.call('show', hosts=_params['hosts']))
 
     ##################################################################
     # Out Of Rotation tests
     def test_run_outofrotation_good(self):
         """OutOfRotation works correctly"""
         _params = self.outofrotation_params_good['parameters']
-        namespace = mock.Mock('argparse.Namespace')
-        parser = mock.MagicMock('argparse.ArgumentParser').__call__()
-        parser.parse_args.__call__().return_value = namespace
 
-        with mock.patch('pika.SelectConnection'):
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.bigipworker.dispatch.call')) as (
+                    _, call):
             worker = bigipworker.BigipWorker(
                 MQ_CONF,
                 logger=self.app_logger,
@@ -279,12 +295,12 @@ call can be made.
             worker._on_channel_open(self.channel)
             worker.validate_inputs(_params)
 
-            worker.out_of_rotation(parser)
+            worker.out_of_rotation()
 
-            self.assertEqual(parser.parse_args.call_count, 3)
-            print parser.parse_args.mock_calls[1]
-            parser.parse_args.mock_calls[1].assert_called_with(
-                ['state', '-d', _params['hosts'][0]])
+            self.assertEqual(call.call_count, 2)
+            self.assertEqual(
+                call.call_args_list[0],
+                mock.call('state', disabled_hosts=_params['hosts']))
 
     ##################################################################
     # Running the worker from the main process() entry-point
@@ -342,3 +358,1489 @@ call can be made.
                     print mocked_method.call_args
                     assert worker.subcommand == params['parameters']['subcommand']
                     assert mocked_method.call_count == 1
+
+    ##################################################################
+    # Fan-out of larger host lists
+    def test_rotation_fan_out(self):
+        """Hosts are changed in one call per chunk and shown together"""
+        _params = copy.deepcopy(self.outofrotation_params_good['parameters'])
+        _params['hosts'] = ['host1', 'host2', 'host3', 'host4']
+
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.bigipworker.dispatch.call')) as (
+                    _, call):
+            calls, call.side_effect = _recorder()
+            worker = bigipworker.BigipWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                output_dir='/tmp/logs/')
+            worker._config = {'concurrency': 2}
+            worker.validate_inputs(_params)
+
+            worker.out_of_rotation()
+
+            assert mock.call(
+                'state', disabled_hosts=['host1', 'host2']) in calls
+            assert mock.call(
+                'state', disabled_hosts=['host3', 'host4']) in calls
+            assert calls[-1] == mock.call(
+                'show', hosts=_params['hosts'])
+            self.assertEqual(len(calls), 3)
+
+    def test_rotation_fan_out_partial_failure(self):
+        """A failing host is reported without stopping the others"""
+        _params = copy.deepcopy(self.inrotation_params_good['parameters'])
+        _params['hosts'] = ['host1', 'host2', 'host3']
+
+        def fake_call(name, **kwargs):
+            if kwargs.get('enabled_hosts') == ['host2']:
+                raise Exception('timed out')
+
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.bigipworker.dispatch.call')) as (
+                    _, call):
+            calls, call.side_effect = _recorder(fake_call)
+            worker = bigipworker.BigipWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                output_dir='/tmp/logs/')
+            worker._config = {'concurrency': 3}
+            worker.validate_inputs(_params)
+
+            with self.assertRaises(BigipWorkerError) as ctx:
+                worker.in_rotation()
+
+            assert 'host2 (timed out)' in str(ctx.exception)
+            assert '1 of 3' in str(ctx.exception)
+            assert mock.call('state', enabled_hosts=['host3']) in calls
+            assert calls[-1] == mock.call(
+                'show', hosts=['host1', 'host3'])
+
+    def test_process_fan_out_partial_failure(self):
+        """A failed chunk is retried per host and the reply names them"""
+        params = copy.deepcopy(self.inrotation_params_good)
+        params['parameters']['hosts'] = ['host1', 'host2', 'host3', 'host4']
+
+        def fake_call(name, **kwargs):
+            if 'host2' in kwargs.get('enabled_hosts', []):
+                raise ValueError('No such pool member')
+
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.bigipworker.BigipWorker.notify'),
+                mock.patch('replugin.bigipworker.BigipWorker.send'),
+                mock.patch('replugin.bigipworker.dispatch.call')) as (
+                    _, _, send, call):
+            calls, call.side_effect = _recorder(fake_call)
+            worker = bigipworker.BigipWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                output_dir='/tmp/logs/')
+            worker._config = {'concurrency': 2}
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            worker.process(self.channel,
+                           self.basic_deliver,
+                           self.properties,
+                           params,
+                           self.logger)
+
+            self.assertEqual(send.call_args[0][2], {
+                'status': 'failed',
+                'changed': ['host1', 'host3', 'host4'],
+                'failed': {'host2': 'No such pool member'}})
+            for host in ('host1', 'host2'):
+                assert mock.call('state', enabled_hosts=[host]) in calls
+            assert calls[-1] == mock.call(
+                'show', hosts=['host1', 'host3', 'host4'])
+            self.assertEqual(len(calls), 5)
+
+    ##################################################################
+    # Concurrent jobs
+    def test_job_state_per_thread(self):
+        """Validated arguments are kept per job thread"""
+        import threading
+
+        seen = {}
+
+        with mock.patch('pika.SelectConnection'):
+            worker = bigipworker.BigipWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                output_dir='/tmp/logs/')
+
+            def job(host):
+                _params = copy.deepcopy(
+                    self.inrotation_params_good['parameters'])
+                _params['hosts'] = [host]
+                worker.validate_inputs(_params)
+                seen[host] = (worker.hosts, worker._cmd_repr)
+
+            worker.validate_inputs(self.configsync_params_good['parameters'])
+            threads = [threading.Thread(target=job, args=(h,))
+                       for h in ('host1', 'host2')]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            assert seen['host1'] == (['host1'], 'bigip:InRotation host1')
+            assert seen['host2'] == (['host2'], 'bigip:InRotation host2')
+            assert worker.subcommand == 'ConfigSync'
+
+    def test_job_state_reset(self):
+        """A job never sees the arguments of the job run before it"""
+        params = copy.deepcopy(self.outofrotation_params_good)
+        params['parameters']['hosts'] = ['web1', 'web2']
+        invalid = copy.deepcopy(self.outofrotation_params_good)
+        invalid['parameters']['hosts'] = None
+
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.bigipworker.BigipWorker.notify'),
+                mock.patch('replugin.bigipworker.BigipWorker.send'),
+                mock.patch('replugin.bigipworker.dispatch.call')) as (
+                    _, notify, send, _):
+            worker = bigipworker.BigipWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                output_dir='/tmp/logs/')
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            worker.process(self.channel, self.basic_deliver,
+                           self.properties, params, self.logger)
+            self.assertEqual(notify.call_args[0][2], 'completed')
+            worker.process(self.channel, self.basic_deliver,
+                           self.properties, invalid, self.logger)
+            self.assertEqual(notify.call_args[0][2], 'failed')
+            assert 'web1' not in notify.call_args[0][1]
+            self.assertEqual(worker.hosts, None)
+
+    def test_process_job_pool(self):
+        """Pooled jobs queue their acks and replies for the ioloop"""
+        channel = mock.MagicMock()
+
+        with mock.patch('pika.SelectConnection'):
+            worker = bigipworker.BigipWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                output_dir='/tmp/logs/')
+            worker._config = {'jobs': 4, 'prefetch': 8}
+
+            worker._on_open(self.connection)
+            worker._on_channel_open(channel)
+            channel.basic_qos.assert_called_with(prefetch_count=8)
+            assert channel.connection.add_timeout.call_count == 1
+
+            with mock.patch.object(worker, 'in_rotation') as in_rotation:
+                in_rotation.return_value = 'shown'
+                worker.process(channel,
+                               self.basic_deliver,
+                               self.properties,
+                               self.inrotation_params_good,
+                               self.logger)
+                worker._jobs.close()
+                worker._jobs.join()
+                assert in_rotation.call_count == 1
+
+            queued = []
+            while not worker._outbox.empty():
+                queued.append(worker._outbox.get_nowait())
+            self.assertEqual(
+                [func.__name__ for (func, _, _) in queued],
+                ['send', 'send', 'notify', 'ack'])
+            self.assertEqual(queued[1][1][2], {'status': 'completed'})
+            self.assertEqual(queued[3][1][0], self.basic_deliver)
+
+    ##################################################################
+    # Reusing the state change output
+    def test_rotation_readback_changed(self):
+        """Only hosts the state change said nothing about are shown"""
+        _params = copy.deepcopy(self.outofrotation_params_good['parameters'])
+        _params['hosts'] = ['host1', 'host2', 'host3']
+
+        def fake_call(name, **kwargs):
+            if name == 'state':
+                for host in kwargs['disabled_hosts']:
+                    if host != 'host2':
+                        print "%s pool_a disabled" % host
+            else:
+                print "\n".join("%s pool_a disabled (shown)" % host
+                                for host in kwargs['hosts'])
+
+        for concurrency in (1, 3):
+            with nested(
+                    mock.patch('pika.SelectConnection'),
+                    mock.patch('replugin.bigipworker.dispatch.call')) as (
+                        _, call):
+                calls, call.side_effect = _recorder(fake_call)
+                worker = bigipworker.BigipWorker(
+                    MQ_CONF,
+                    logger=self.app_logger,
+                    output_dir='/tmp/logs/')
+                worker._config = {
+                    'concurrency': concurrency, 'readback': 'changed'}
+                worker.validate_inputs(_params)
+
+                result = worker.out_of_rotation()
+
+                assert calls[-1] == mock.call(
+                    'show', hosts=['host2'])
+                self.assertEqual(result.splitlines(), [
+                    'host1 pool_a disabled',
+                    'host3 pool_a disabled',
+                    'host2 pool_a disabled (shown)'])
+
+    def test_rotation_readback_no_show(self):
+        """No show call is made when the state change covered every host"""
+        _params = self.inrotation_params_good['parameters']
+
+        def fake_call(name, **kwargs):
+            print "localhost pool_a enabled"
+
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.bigipworker.dispatch.call')) as (
+                    _, call):
+            call.side_effect = fake_call
+            worker = bigipworker.BigipWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                output_dir='/tmp/logs/')
+            worker._config = {'readback': 'changed'}
+            worker.validate_inputs(_params)
+
+            self.assertEqual(worker.in_rotation(), 'localhost pool_a enabled')
+            self.assertEqual(call.call_count, 1)
+
+    ##################################################################
+    # Coalescing
+    def test_rotation_coalesced(self):
+        """Overlapping jobs in the window share one device operation"""
+        import threading
+
+        def fake_call(name, **kwargs):
+            if kwargs.get('disabled_hosts') == ['host3']:
+                raise Exception('timed out')
+            if name == 'show':
+                print "\n".join("%s pool_a disabled" % host
+                                for host in kwargs['hosts'])
+
+        results = {}
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.bigipworker.dispatch.call')) as (
+                    _, call):
+            calls, call.side_effect = _recorder(fake_call)
+            worker = bigipworker.BigipWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                output_dir='/tmp/logs/')
+            worker._config = {'retry_attempts': 1, 'jobs': 2}
+            worker.coalescer.window = 0.2
+
+            def job(name, hosts):
+                _params = copy.deepcopy(
+                    self.outofrotation_params_good['parameters'])
+                _params['hosts'] = hosts
+                worker.validate_inputs(_params)
+                try:
+                    results[name] = worker.out_of_rotation()
+                except BigipWorkerError, e:
+                    results[name] = e
+
+            threads = [
+                threading.Thread(target=job, args=('a', ['host1', 'host2'])),
+                threading.Thread(target=job, args=('b', ['host2', 'host3']))]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            shows = [c for c in calls if c[1][0] == 'show']
+            self.assertEqual(len(shows), 1)
+            self.assertEqual(sorted(shows[0][2]['hosts']), ['host1', 'host2'])
+            self.assertEqual(len(calls), 4)
+            self.assertEqual(
+                results['a'], 'host1 pool_a disabled\nhost2 pool_a disabled')
+            assert isinstance(results['b'], BigipWorkerError)
+            assert '1 of 2' in str(results['b'])
+
+    def test_rotation_coalesced_per_job(self):
+        """Coalesced jobs keep their own progress, deadline and result"""
+        import time
+        from replugin.bigipworker import retry
+
+        timeouts = ['host3']
+
+        def fake_call(name, **kwargs):
+            if name == 'state' and kwargs['disabled_hosts'] == timeouts[:1]:
+                timeouts.pop()
+                raise Exception('timed out')
+            if name == 'show':
+                print "\n".join("%s pool_a disabled" % host
+                                for host in kwargs['hosts'])
+
+        for expired in (False, True):
+            timeouts[:] = ['host3']
+            jobs = {}
+            with nested(
+                    mock.patch('pika.SelectConnection'),
+                    mock.patch('replugin.bigipworker.dispatch.call')) as (
+                        _, call):
+                calls, call.side_effect = _recorder(fake_call)
+                worker = bigipworker.BigipWorker(
+                    MQ_CONF,
+                    logger=self.app_logger,
+                    output_dir='/tmp/logs/')
+                worker._config = {'retry_attempts': 2, 'retry_delay': 0,
+                                  'jobs': 2}
+                worker.coalescer.window = 0.2
+
+                def job(name, hosts, deadline):
+                    _params = copy.deepcopy(
+                        self.outofrotation_params_good['parameters'])
+                    _params['hosts'] = hosts
+                    worker.validate_inputs(_params)
+                    # Reported to from the fan out threads, a MagicMock
+                    # could lose calls made at the same time
+                    progress = []
+                    worker.progress = mock.Mock()
+                    worker.progress.host_done = (
+                        lambda *args: progress.append(args))
+                    worker.result = {}
+                    worker.deadline = deadline
+                    jobs[name] = {'progress': progress,
+                                  'result': worker.result}
+                    try:
+                        jobs[name]['shown'] = worker.out_of_rotation()
+                    except BigipWorkerError, e:
+                        jobs[name]['shown'] = e
+
+                leader = threading.Thread(
+                    target=job, args=('a', ['host1', 'host2'], None))
+                leader.start()
+                while not worker.coalescer._pending:
+                    time.sleep(0.001)
+                job('b', ['host2', 'host3'],
+                    retry.Deadline(time.time() - 1 if expired
+                                   else time.time() + 60))
+                leader.join()
+
+                self.assertEqual(len(calls), 3 if expired else 5)
+                done = sorted(args[0] for args in jobs['a']['progress'])
+                self.assertEqual(done, ['host1', 'host2'])
+                done = dict((args[0], args[2])
+                            for args in jobs['b']['progress'])
+                self.assertEqual(done, {'host2': True, 'host3': not expired})
+                assert 'attempts' not in jobs['a']['result']
+                if expired:
+                    assert isinstance(jobs['b']['shown'], BigipWorkerError)
+                    assert 'host3' in str(jobs['b']['shown'])
+                else:
+                    self.assertEqual(jobs['b']['result']['attempts'],
+                                     {'host3': 2})
+
+    ##################################################################
+    # ConfigSync scheduling
+    def test_configsync_per_environment(self):
+        """Environments are synced separately and failures collected"""
+        _params = copy.deepcopy(self.configsync_params_good['parameters'])
+        _params['envs'] = ['qa', 'stage', 'prod']
+
+        def fake_call(name, **kwargs):
+            if kwargs['environments'] == ['stage']:
+                raise Exception('sync refused')
+
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.bigipworker.dispatch.call')) as (
+                    _, call):
+            calls, call.side_effect = _recorder(fake_call)
+            worker = bigipworker.BigipWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                output_dir='/tmp/logs/')
+            worker.validate_inputs(_params)
+
+            with self.assertRaises(BigipWorkerError) as ctx:
+                worker.config_sync()
+
+            self.assertEqual(len(calls), 3)
+            for env in _params['envs']:
+                assert mock.call('sync', environments=[env]) in calls
+            assert 'stage (sync refused)' in str(ctx.exception)
+
+    ##################################################################
+    # Latency instrumentation
+    def test_process_timings(self):
+        """Every phase of a job is timed"""
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.bigipworker.dispatch.call')):
+            worker = bigipworker.BigipWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                output_dir='/tmp/logs/')
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+            worker.metrics.sink = mock.MagicMock()
+
+            worker.process(self.channel,
+                           self.basic_deliver,
+                           self.properties,
+                           self.outofrotation_params_good,
+                           self.logger)
+
+            snapshot = worker.metrics.snapshot()
+            for name in ('job.OutOfRotation', 'phase.validate', 'phase.run',
+                         'phase.reply', 'subcommand.OutOfRotation', 'show',
+                         'device.state', 'device.show'):
+                self.assertEqual(snapshot[name]['count'], 1)
+            worker.metrics.sink.emit.assert_any_call(
+                'device.state', mock.ANY, {'host': 'localhost'})
+            timings = [c[0][0] for c in self.app_logger.debug.call_args_list
+                       if c[0][0].startswith('bigip: Timings ')]
+            self.assertEqual(len(timings), 1)
+            assert "'job.OutOfRotation': {" in timings[0]
+            assert "'p99': " in timings[0]
+
+    ##################################################################
+    # Batch tests
+    def _batch_params(self):
+        _params = copy.deepcopy(_base_params)
+        _params['parameters'].update({
+            'subcommand': 'Batch',
+            'operations': [
+                {'subcommand': 'OutOfRotation', 'hosts': ['host1']},
+                {'subcommand': 'InRotation', 'hosts': ['host2']},
+                {'subcommand': 'ConfigSync', 'envs': ['prod']},
+            ]
+        })
+        return _params
+
+    def test_batch_validation(self):
+        """Batch operations are each validated"""
+        with mock.patch('pika.SelectConnection'):
+            worker = bigipworker.BigipWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                output_dir='/tmp/logs/')
+
+            assert worker.validate_inputs(
+                self._batch_params()['parameters']) == True
+            assert worker.subcommand == 'Batch'
+            self.assertEqual(
+                [(o['subcommand'], o['hosts'], o['envs'])
+                 for o in worker.operations],
+                [('OutOfRotation', ['host1'], None),
+                 ('InRotation', ['host2'], None),
+                 ('ConfigSync', None, ['prod'])])
+
+            for operations in ([], None, [{'subcommand': 'InRotation'}],
+                               [{'subcommand': 'Batch', 'operations': []}]):
+                _params = self._batch_params()['parameters']
+                _params['operations'] = operations
+                with self.assertRaises(BigipWorkerError):
+                    worker.validate_inputs(_params)
+
+            # Failing steps are named, and leave the subcommand a Batch
+            for operations, error in (
+                    (['OutOfRotation'], 'operation 1 of 1 is not a'),
+                    ([{'subcommand': 'InRotation', 'hosts': ['host1']},
+                      {'subcommand': 'OutOfRotation'}],
+                     'operation 2 of 2: bigip:(In|OutOf)Rotation require')):
+                _params = self._batch_params()['parameters']
+                _params['operations'] = operations
+                with self.assertRaises(BigipWorkerError) as raised:
+                    worker.validate_inputs(_params)
+                assert error in str(raised.exception)
+                assert worker.subcommand == 'Batch'
+
+    def test_process_batch_invalid_operation(self):
+        """Invalid Batch operations fail the job under the Batch name"""
+        params = self._batch_params()
+        params['parameters']['operations'] = ['OutOfRotation']
+
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.bigipworker.BigipWorker.notify'),
+                mock.patch('replugin.bigipworker.BigipWorker.send')) as (
+                    _, _, send):
+            worker = bigipworker.BigipWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                output_dir='/tmp/logs/')
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            worker.process(self.channel,
+                           self.basic_deliver,
+                           self.properties,
+                           params,
+                           self.logger)
+
+            self.assertEqual(send.call_args[0][2], {'status': 'failed'})
+            self.assertEqual(
+                worker.metrics.snapshot()['job.Batch']['count'], 1)
+
+    def test_batch_runs_in_order(self):
+        """Batch operations run in order in one job"""
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.bigipworker.BigipWorker.notify'),
+                mock.patch('replugin.bigipworker.BigipWorker.send'),
+                mock.patch('replugin.bigipworker.dispatch.call')) as (
+                    _, _, send, call):
+            worker = bigipworker.BigipWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                output_dir='/tmp/logs/')
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            worker.process(self.channel,
+                           self.basic_deliver,
+                           self.properties,
+                           self._batch_params(),
+                           self.logger)
+
+            self.assertEqual(call.call_args_list, [
+                mock.call('state', disabled_hosts=['host1']),
+                mock.call('show', hosts=['host1']),
+                mock.call('state', enabled_hosts=['host2']),
+                mock.call('show', hosts=['host2']),
+                mock.call('sync', environments=['prod'])])
+            self.assertEqual(send.call_count, 2)
+            self.assertEqual(send.call_args[0][2], {'status': 'completed'})
+
+    def test_batch_stops_on_failure(self):
+        """A failing operation stops the batch"""
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.bigipworker.dispatch.call')) as (
+                    _, call):
+            worker = bigipworker.BigipWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                output_dir='/tmp/logs/')
+            worker.validate_inputs(self._batch_params()['parameters'])
+
+            with mock.patch.object(worker, 'in_rotation') as in_rotation:
+                in_rotation.side_effect = BigipWorkerError('host2 is gone')
+                with self.assertRaises(BigipWorkerError) as ctx:
+                    worker.batch()
+
+            assert 'step 2 of 3 failed: host2 is gone' in str(ctx.exception)
+            assert 'Not run: bigip:ConfigSync prod' in str(ctx.exception)
+            assert mock.call('sync', environments=['prod']) not in \
+                call.call_args_list
+            assert worker.subcommand == 'Batch'
+
+    ##################################################################
+    # Streaming progress
+    def test_process_streams_progress(self):
+        """Opted in jobs publish host progress before the final reply"""
+        params = copy.deepcopy(self.outofrotation_params_good)
+        params['parameters'].update({
+            'hosts': ['host1', 'host2', 'host3'], 'progress': True})
+        channel = mock.MagicMock()
+
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch.object(bigipworker.Worker, 'notify'),
+                mock.patch.object(bigipworker.Worker, 'send'),
+                mock.patch('replugin.bigipworker.dispatch.call')) as (
+                    _, _, send, call):
+            worker = bigipworker.BigipWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                output_dir='/tmp/logs/')
+            worker._config = {'progress_interval': 60, 'jobs': 2}
+            worker._on_open(self.connection)
+            worker._on_channel_open(channel)
+
+            worker.process(channel,
+                           self.basic_deliver,
+                           self.properties,
+                           params,
+                           self.logger)
+            worker._jobs.close()
+            worker._jobs.join()
+            # Nothing leaves but through the outbox, drained by the
+            # connection ioloop
+            self.assertEqual(send.call_count, 0)
+            worker._drain_outbox()
+            assert worker._outbox.empty()
+
+            replies = [c[0][2] for c in send.call_args_list]
+            self.assertEqual(replies[0], {'status': 'started'})
+            self.assertEqual(replies[-1], {'status': 'completed'})
+            progress = replies[1:-1]
+            self.assertEqual(len(progress), 2)
+            self.assertEqual(
+                sorted(progress[0]['completed'] + progress[1]['completed']),
+                ['host1', 'host2', 'host3'])
+            assert all(p['status'] == 'progress' for p in progress)
+            assert all(p['state'] == 'disabled' for p in progress)
+
+    def test_process_progress_inline(self):
+        """Jobs run on the connection thread do not stream progress"""
+        params = copy.deepcopy(self.outofrotation_params_good)
+        params['parameters'].update({
+            'hosts': ['host1', 'host2', 'host3'], 'progress': True})
+        channel = mock.MagicMock()
+
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch.object(bigipworker.Worker, 'notify'),
+                mock.patch.object(bigipworker.Worker, 'send'),
+                mock.patch('replugin.bigipworker.dispatch.call')) as (
+                    _, _, send, call):
+            worker = bigipworker.BigipWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                output_dir='/tmp/logs/')
+            worker._config = {'progress_interval': 0}
+            worker._on_open(self.connection)
+            worker._on_channel_open(channel)
+            channel.connection.add_timeout.assert_called_once_with(
+                bigipworker.OUTBOX_INTERVAL, worker._drain_outbox)
+
+            worker.process(channel,
+                           self.basic_deliver,
+                           self.properties,
+                           params,
+                           self.logger)
+
+            self.assertEqual([c[0][2] for c in send.call_args_list], [
+                {'status': 'started'}, {'status': 'completed'}])
+            assert worker._outbox.empty()
+            assert 'Progress needs jobs' in \
+                self.app_logger.warn.call_args[0][0]
+
+    ##################################################################
+    # Wait for drain
+    def test_outofrotation_wait_for_drain(self):
+        """OutOfRotation waits until connections drained"""
+        _params = copy.deepcopy(self.outofrotation_params_good['parameters'])
+        _params.update({'hosts': ['host1', 'host2'],
+                        'wait_for_drain': True, 'drain_threshold': 1})
+        counts = {'host1': [4, 1], 'host2': [0]}
+
+        def fake_call(name, **kwargs):
+            if name == 'show':
+                for host in kwargs['hosts']:
+                    count = counts[host][0]
+                    if len(counts[host]) > 1:
+                        counts[host].pop(0)
+                    print "%s pool_a disabled connections=%s" % (host, count)
+
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.bigipworker.dispatch.call'),
+                mock.patch('time.sleep')) as (_, call, sleep):
+            call.side_effect = fake_call
+            worker = bigipworker.BigipWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                output_dir='/tmp/logs/')
+            worker._config = {'concurrency': 1}
+            worker.validate_inputs(_params)
+            self.assertEqual(worker.drain, {'threshold': 1, 'timeout': 300})
+
+            # The readback show consumes the first counts
+            counts['host1'].insert(0, 9)
+            result = worker.out_of_rotation()
+
+            assert 'Drained 2 host(s)' in result
+            shows = [c[1]['hosts'] for c in call.call_args_list
+                     if c[0][0] == 'show']
+            self.assertEqual(
+                shows, [['host1', 'host2'], ['host1', 'host2'], ['host1']])
+
+    def test_outofrotation_drain_timeout(self):
+        """Hosts still busy at the timeout fail the job"""
+        _params = copy.deepcopy(self.outofrotation_params_good['parameters'])
+        _params.update({'hosts': ['host1', 'host2'],
+                        'wait_for_drain': True, 'drain_timeout': 0})
+
+        def fake_call(name, **kwargs):
+            if name == 'show':
+                print "host1 pool_a disabled connections=4"
+
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.bigipworker.dispatch.call')) as (
+                    _, call):
+            call.side_effect = fake_call
+            worker = bigipworker.BigipWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                output_dir='/tmp/logs/')
+            worker._config = {'concurrency': 1}
+            worker.validate_inputs(_params)
+            worker.result = {}
+
+            with self.assertRaises(BigipWorkerError) as ctx:
+                worker.out_of_rotation()
+            assert 'host1 (4), host2 (unknown)' in str(ctx.exception)
+            self.assertEqual(worker.result['pending'],
+                             {'host1': 4, 'host2': None})
+
+    ##################################################################
+    # Wait for healthy
+    def test_inrotation_wait_for_healthy(self):
+        """InRotation polls all hosts until the monitors mark them up"""
+        _params = copy.deepcopy(self.inrotation_params_good['parameters'])
+        _params.update({'hosts': ['host1', 'host2'],
+                        'wait_for_healthy': True})
+        status = {'host1': ['offline', 'available'],
+                  'host2': ['available']}
+
+        def fake_call(name, **kwargs):
+            if name == 'show':
+                for host in kwargs['hosts']:
+                    print "%s pool_a enabled %s" % (
+                        host, status[host].pop(0))
+
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.bigipworker.dispatch.call'),
+                mock.patch('time.sleep')) as (_, call, sleep):
+            call.side_effect = fake_call
+            worker = bigipworker.BigipWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                output_dir='/tmp/logs/')
+            worker._config = {'concurrency': 1}
+            worker.validate_inputs(_params)
+
+            result = worker.in_rotation()
+
+            self.assertEqual(call.call_args_list, [
+                mock.call('state', enabled_hosts=['host1', 'host2']),
+                mock.call('show', hosts=['host1', 'host2']),
+                mock.call('show', hosts=['host1'])])
+            self.assertEqual(result.splitlines()[:2], [
+                'host1 pool_a enabled available',
+                'host2 pool_a enabled available'])
+            assert 'Available: 2 host(s)' in result
+
+    def test_inrotation_healthy_timeout(self):
+        """Hosts not up by the timeout fail the job"""
+        _params = copy.deepcopy(self.inrotation_params_good['parameters'])
+        _params.update({'wait_for_healthy': True, 'healthy_timeout': 0})
+
+        def fake_call(name, **kwargs):
+            if name == 'show':
+                print "localhost pool_a enabled offline"
+
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.bigipworker.dispatch.call')) as (
+                    _, call):
+            call.side_effect = fake_call
+            worker = bigipworker.BigipWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                output_dir='/tmp/logs/')
+            worker.validate_inputs(_params)
+            worker.result = {}
+
+            with self.assertRaises(BigipWorkerError) as ctx:
+                worker.in_rotation()
+            assert 'localhost (offline)' in str(ctx.exception)
+            self.assertEqual(worker.result['pending'],
+                             {'localhost': 'offline'})
+
+    ##################################################################
+    # Skipping hosts already in the requested state
+    def test_rotation_precheck_skips_unchanged(self):
+        """Only hosts not already in the requested state are written"""
+        params = copy.deepcopy(self.outofrotation_params_good)
+        params['parameters']['hosts'] = ['host1', 'host2', 'host3']
+        current = {'host1': 'disabled', 'host2': 'enabled',
+                   'host3': 'disabled'}
+
+        def fake_call(name, **kwargs):
+            if name == 'state':
+                for host in kwargs['disabled_hosts']:
+                    current[host] = 'disabled'
+            else:
+                for host in kwargs['hosts']:
+                    print "%s pool_a %s" % (host, current[host])
+
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.bigipworker.BigipWorker.notify'),
+                mock.patch('replugin.bigipworker.BigipWorker.send'),
+                mock.patch('replugin.bigipworker.dispatch.call')) as (
+                    _, _, send, call):
+            calls, call.side_effect = _recorder(fake_call)
+            worker = bigipworker.BigipWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                output_dir='/tmp/logs/')
+            worker._config = {'precheck': True}
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            worker.process(self.channel,
+                           self.basic_deliver,
+                           self.properties,
+                           params,
+                           self.logger)
+
+            self.assertEqual(calls, [
+                mock.call('show', hosts=['host1', 'host2', 'host3']),
+                mock.call('state', disabled_hosts=['host2']),
+                mock.call('show', hosts=['host2'])])
+            self.assertEqual(send.call_args[0][2], {
+                'status': 'completed',
+                'changed': ['host2'],
+                'skipped': ['host1', 'host3']})
+
+    ##################################################################
+    # Structured results
+    def test_process_structured_results(self):
+        """Structured results reply with the members instead of text"""
+        params = copy.deepcopy(self.inrotation_params_good)
+
+        def fake_call(name, **kwargs):
+            if name == 'show':
+                print "localhost pool_a localhost:80 enabled available " \
+                    "connections=2"
+
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.bigipworker.BigipWorker.notify'),
+                mock.patch('replugin.bigipworker.BigipWorker.send'),
+                mock.patch('replugin.bigipworker.dispatch.call')) as (
+                    _, _, send, call):
+            call.side_effect = fake_call
+            worker = bigipworker.BigipWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                output_dir='/tmp/logs/')
+            worker._config = {'results': 'structured'}
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            worker.process(self.channel,
+                           self.basic_deliver,
+                           self.properties,
+                           params,
+                           self.logger)
+
+            self.assertEqual(send.call_args[0][2], {
+                'status': 'completed',
+                'members': [{
+                    'host': 'localhost', 'pool': 'pool_a',
+                    'member': 'localhost:80', 'enabled': True,
+                    'availability': 'available', 'connections': 2}]})
+            self.logger.info.assert_called_once_with(
+                '1 member(s) of 1 host(s): 1 enabled, 0 disabled')
+
+    def test_process_diff_results(self):
+        """Diff results reply with and log only the changed members"""
+        params = copy.deepcopy(self.outofrotation_params_good)
+        params['parameters']['hosts'] = ['host1', 'host2']
+        states = {'host1': 'enabled', 'host2': 'disabled'}
+
+        def fake_call(name, **kwargs):
+            if name == 'state':
+                for host in kwargs['disabled_hosts']:
+                    states[host] = 'disabled'
+            else:
+                for host in kwargs['hosts']:
+                    print "%s pool_a %s:80 %s available connections=1" % (
+                        host, host, states[host])
+
+        for verbose in (False, True):
+            states['host1'] = 'enabled'
+            params['parameters']['verbose'] = verbose
+            self.logger.reset_mock()
+            with nested(
+                    mock.patch('pika.SelectConnection'),
+                    mock.patch('replugin.bigipworker.BigipWorker.notify'),
+                    mock.patch('replugin.bigipworker.BigipWorker.send'),
+                    mock.patch('replugin.bigipworker.dispatch.call')) as (
+                        _, _, send, call):
+                call.side_effect = fake_call
+                worker = bigipworker.BigipWorker(
+                    MQ_CONF,
+                    logger=self.app_logger,
+                    output_dir='/tmp/logs/')
+                worker._config = {'results': 'diff'}
+                worker._on_open(self.connection)
+                worker._on_channel_open(self.channel)
+
+                worker.process(self.channel,
+                               self.basic_deliver,
+                               self.properties,
+                               params,
+                               self.logger)
+
+                self.assertEqual(send.call_args[0][2], {
+                    'status': 'completed',
+                    'changes': [{
+                        'host': 'host1', 'pool': 'pool_a',
+                        'member': 'host1:80',
+                        'changes': {'enabled': [True, False]}}]})
+                summary = ('1 of 2 member(s) changed\n'
+                           'host1 pool_a host1:80 enabled True -> False')
+                dump = ('host1 pool_a host1:80 disabled available '
+                        'connections=1\nhost2 pool_a host2:80 disabled '
+                        'available connections=1')
+                if verbose:
+                    self.assertEqual(self.logger.info.call_args_list, [
+                        mock.call(dump), mock.call(summary)])
+                else:
+                    self.logger.info.assert_called_once_with(summary)
+                    self.logger.debug.assert_any_call(dump)
+
+    ##################################################################
+    # Warm up
+    def test_warm_up(self):
+        """The warm up loads BigIP before consuming"""
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.bigipworker.dispatch.load')) as (
+                    _, load):
+            worker = bigipworker.BigipWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                output_dir='/tmp/logs/')
+            worker._config = {'warm_up': True}
+            worker._configure()
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            load.assert_called_once_with()
+            self.assertEqual(
+                worker.metrics.snapshot()['warm_up']['count'], 1)
+
+    def test_warm_up_failure(self):
+        """A failing warm up is logged and the worker still starts"""
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.bigipworker.dispatch.load')) as (
+                    _, load):
+            load.side_effect = ImportError('No module named BigIP')
+            worker = bigipworker.BigipWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                output_dir='/tmp/logs/')
+            worker._config = {'warm_up': True}
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            self.app_logger.warn.assert_called_once_with(
+                'bigip: Warm up failed: No module named BigIP')
+
+    ##################################################################
+    # Rate limiting
+    def test_rate_limit_reports_throttled(self):
+        """Rate limited device calls report the time throttled"""
+        params = copy.deepcopy(self.outofrotation_params_good)
+        params['parameters']['hosts'] = ['host1', 'host2', 'host3']
+
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.bigipworker.BigipWorker.notify'),
+                mock.patch('replugin.bigipworker.BigipWorker.send'),
+                mock.patch('replugin.bigipworker.dispatch.call')) as (
+                    _, _, send, call):
+            calls, call.side_effect = _recorder()
+            worker = bigipworker.BigipWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                output_dir='/tmp/logs/')
+            worker._config = {'rate_limit': 1000, 'rate_burst': 1,
+                              'device_concurrency': 2}
+            worker._configure()
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            worker.process(self.channel,
+                           self.basic_deliver,
+                           self.properties,
+                           params,
+                           self.logger)
+
+            self.assertEqual(len(calls), 4)
+            reply = send.call_args[0][2]
+            self.assertEqual(reply['status'], 'completed')
+            assert 0 < reply['throttled'] < 1
+            self.assertEqual(
+                worker.metrics.snapshot()['throttle']['count'], 4)
+
+    ##################################################################
+    # Retries and deadlines
+    def test_rotation_retries_failed_hosts(self):
+        """Only the hosts failing transiently are retried"""
+        params = copy.deepcopy(self.outofrotation_params_good)
+        params['parameters']['hosts'] = ['host1', 'host2', 'host3']
+        errors = [Exception('Connection timed out')]
+
+        def fake_call(name, **kwargs):
+            if kwargs.get('disabled_hosts') == ['host2'] and errors:
+                raise errors.pop()
+
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.bigipworker.BigipWorker.notify'),
+                mock.patch('replugin.bigipworker.BigipWorker.send'),
+                mock.patch('replugin.bigipworker.dispatch.call')) as (
+                    _, _, send, call):
+            calls, call.side_effect = _recorder(fake_call)
+            worker = bigipworker.BigipWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                output_dir='/tmp/logs/')
+            worker._config = {'retry_delay': 0.01}
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            worker.process(self.channel,
+                           self.basic_deliver,
+                           self.properties,
+                           params,
+                           self.logger)
+
+            self.assertEqual(send.call_args[0][2], {
+                'status': 'completed', 'attempts': {'host2': 2}})
+            states = [c for c in calls if c[1][0] == 'state']
+            self.assertEqual(len(states), 4)
+            self.assertEqual(
+                states.count(mock.call('state', disabled_hosts=['host2'])),
+                2)
+
+    def test_process_deadline(self):
+        """Jobs past their deadline fail without touching the device"""
+        for deadline, error in ((1, 'deadline passed'),
+                                ('soon', 'must be a UNIX timestamp')):
+            params = copy.deepcopy(self.outofrotation_params_good)
+            params['parameters']['deadline'] = deadline
+
+            with nested(
+                    mock.patch('pika.SelectConnection'),
+                    mock.patch('replugin.bigipworker.BigipWorker.notify'),
+                    mock.patch('replugin.bigipworker.BigipWorker.send'),
+                    mock.patch('replugin.bigipworker.dispatch.call')) as (
+                        _, _, send, call):
+                worker = bigipworker.BigipWorker(
+                    MQ_CONF,
+                    logger=self.app_logger,
+                    output_dir='/tmp/logs/')
+                worker._on_open(self.connection)
+                worker._on_channel_open(self.channel)
+
+                worker.process(self.channel,
+                               self.basic_deliver,
+                               self.properties,
+                               params,
+                               self.logger)
+
+                self.assertEqual(send.call_args[0][2], {'status': 'failed'})
+                assert error in self.logger.error.call_args[0][0]
+                self.assertEqual(call.call_count, 0)
+
+    def test_process_device_error(self):
+        """Device errors fail the job instead of escaping process"""
+        params = copy.deepcopy(self.outofrotation_params_good)
+        params['parameters']['hosts'] = ['h1']
+
+        for failing in ('state', 'show'):
+            def fake_call(name, **kwargs):
+                if name == failing:
+                    raise Exception('SOAP fault: no such member')
+
+            with nested(
+                    mock.patch('pika.SelectConnection'),
+                    mock.patch('replugin.bigipworker.BigipWorker.notify'),
+                    mock.patch('replugin.bigipworker.BigipWorker.send'),
+                    mock.patch('replugin.bigipworker.dispatch.call')) as (
+                        _, notify, send, call):
+                call.side_effect = fake_call
+                worker = bigipworker.BigipWorker(
+                    MQ_CONF,
+                    logger=self.app_logger,
+                    output_dir='/tmp/logs/')
+                worker._on_open(self.connection)
+                worker._on_channel_open(self.channel)
+
+                worker.process(self.channel,
+                               self.basic_deliver,
+                               self.properties,
+                               params,
+                               self.logger)
+
+                self.assertEqual(send.call_args[0][2], {'status': 'failed'})
+                self.assertEqual(notify.call_args[0][2], 'failed')
+                assert 'SOAP fault' in self.logger.error.call_args[0][0]
+
+    ##################################################################
+    # Executor engine
+    def test_rotation_on_executor(self):
+        """The executor engine runs the fan out on its own threads"""
+        _params = copy.deepcopy(self.inrotation_params_good['parameters'])
+        _params['hosts'] = ['host1', 'host2', 'host3']
+
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.bigipworker.dispatch.call')) as (
+                    _, call):
+            calls, call.side_effect = _recorder()
+            worker = bigipworker.BigipWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                output_dir='/tmp/logs/')
+            worker._config = {'engine': 'executor', 'engine_workers': 2}
+            worker._configure()
+            worker.validate_inputs(_params)
+            worker.result = {}
+
+            worker.in_rotation()
+
+            self.assertEqual(len(calls), 4)
+            # Quick calls may all finish on the first thread started
+            assert 1 <= worker.executor.stats()['threads'] <= 2
+            self.assertEqual(worker.executor.stats()['submitted'], 3)
+
+    def test_configure_stops_previous_helpers(self):
+        """Configuring again stops the threads of the previous helpers"""
+        with mock.patch('pika.SelectConnection'):
+            worker = bigipworker.BigipWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                output_dir='/tmp/logs/')
+            worker._config = {'engine': 'executor',
+                              'lanes': [{'name': 'a'}]}
+            worker._configure()
+            old = worker.scheduler, worker.executor
+            worker.executor.submit(lambda: None).result(1)
+
+            worker._configure()
+            assert worker.scheduler is not old[0]
+            for thread in old[0]._threads + old[1]._threads:
+                thread.join(1)
+                assert not thread.is_alive()
+
+    ##################################################################
+    # Journal
+    def test_process_journals_hosts(self):
+        """Jobs and the hosts they changed are journaled"""
+        import os
+        import tempfile
+        from replugin.bigipworker import journal
+
+        path = tempfile.mktemp()
+        params = copy.deepcopy(self.outofrotation_params_good)
+        params['parameters']['hosts'] = ['host1', 'host2']
+
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.bigipworker.BigipWorker.notify'),
+                mock.patch('replugin.bigipworker.BigipWorker.send'),
+                mock.patch('replugin.bigipworker.dispatch.call'),
+                mock.patch('replugin.bigipworker.journal.Journal.finish')
+        ) as (_, _, send, call, finish):
+            worker = bigipworker.BigipWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                output_dir='/tmp/logs/')
+            try:
+                worker._config = {'journal': path}
+                worker._configure()
+                worker._on_open(self.connection)
+                worker._on_channel_open(self.channel)
+
+                worker.process(self.channel,
+                               self.basic_deliver,
+                               self.properties,
+                               params,
+                               self.logger)
+                worker.journal.close()
+
+                finish.assert_called_once_with(
+                    str(self.properties.correlation_id))
+                pending = journal.Journal(path).pending()
+                entry = pending[str(self.properties.correlation_id)]
+                self.assertEqual(entry['job']['body'], params)
+                self.assertEqual(entry['done'], {
+                    'host1': 'disabled', 'host2': 'disabled'})
+            finally:
+                if worker.journal is not None:
+                    worker.journal.close()
+                os.remove(path)
+
+    def test_resume_unfinished_hosts(self):
+        """Journaled jobs are resumed for their unfinished hosts only"""
+        import os
+        import tempfile
+        from replugin.bigipworker import journal
+
+        path = tempfile.mktemp()
+        log = journal.Journal(path)
+        body = copy.deepcopy(self.outofrotation_params_good)
+        body['parameters']['hosts'] = ['host1', 'host2', 'host3']
+        log.start('job1', {'reply_to': 'fsm', 'body': body, 'acked': True})
+        log.host_done('job1', 'host1', 'disabled')
+        log.host_done('job1', 'host3', 'disabled')
+        log.start('job2', {'reply_to': 'fsm', 'body': body, 'acked': True})
+        for host in body['parameters']['hosts']:
+            log.host_done('job2', host, 'disabled')
+        # Not acked, so their message is redelivered by the broker
+        for job_id in ('job3', 'job4'):
+            log.start(job_id, {'reply_to': 'fsm', 'body': body,
+                               'acked': False, 'started': 1.0})
+        log.close()
+
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.bigipworker.BigipWorker.notify'),
+                mock.patch('replugin.bigipworker.BigipWorker.send'),
+                mock.patch('replugin.bigipworker.dispatch.call')) as (
+                    _, _, send, call):
+            worker = bigipworker.BigipWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                output_dir='/tmp/logs/')
+            try:
+                worker._config = {'journal': path}
+                worker._configure()
+                worker._on_open(self.connection)
+                worker._on_channel_open(self.channel)
+
+                self.assertEqual(call.call_args_list, [
+                    mock.call('state', disabled_hosts=['host2']),
+                    mock.call('show', hosts=['host2'])])
+                self.assertEqual(
+                    [c[0][1:3] for c in send.call_args_list], [
+                        ('job1', {'status': 'started'}),
+                        ('job1', {'status': 'completed'}),
+                        ('job2', {'status': 'completed'})])
+                self.assertEqual(
+                    worker.journal.pending().keys(), ['job3', 'job4'])
+
+                # Resuming happens once, not on every channel open
+                worker._on_channel_open(self.channel)
+                self.assertEqual(call.call_count, 2)
+
+                # Unacked jobs not redelivered here in time are dropped
+                expire, = [
+                    c[0][1] for c in
+                    self.channel.connection.add_timeout.call_args_list
+                    if c[0][0] == 300]
+                worker.journal.start('job4', {
+                    'reply_to': 'fsm', 'body': body, 'acked': False,
+                    'started': 2.0})
+                expire()
+                self.assertEqual(worker.journal.pending().keys(), ['job4'])
+            finally:
+                if worker.journal is not None:
+                    worker.journal.close()
+                os.remove(path)
+
+    def test_redelivered_job_skips_done_hosts(self):
+        """Redelivered journaled jobs only change their unfinished hosts"""
+        import os
+        import tempfile
+        from replugin.bigipworker import journal
+
+        path = tempfile.mktemp()
+        corr_id = str(self.properties.correlation_id)
+        body = copy.deepcopy(self.outofrotation_params_good)
+        body['parameters']['hosts'] = ['host1', 'host2']
+        log = journal.Journal(path)
+        log.start(corr_id, {'reply_to': 'fsm', 'body': body, 'acked': False})
+        log.host_done(corr_id, 'host1', 'disabled')
+        log.close()
+
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.bigipworker.BigipWorker.notify'),
+                mock.patch('replugin.bigipworker.BigipWorker.send'),
+                mock.patch('replugin.bigipworker.BigipWorker.ack'),
+                mock.patch('replugin.bigipworker.dispatch.call')) as (
+                    _, _, send, ack, call):
+            worker = bigipworker.BigipWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                output_dir='/tmp/logs/')
+            try:
+                worker._config = {'journal': path, 'jobs': 2}
+                worker._configure()
+                worker._on_open(self.connection)
+                worker._on_channel_open(mock.MagicMock())
+                # Left for the broker to redeliver
+                self.assertEqual(call.call_count, 0)
+                self.assertEqual(send.call_count, 0)
+
+                worker.process(self.channel,
+                               self.basic_deliver,
+                               self.properties,
+                               body,
+                               self.logger)
+                worker._jobs.close()
+                worker._jobs.join()
+                self.assertEqual(call.call_args_list, [
+                    mock.call('state', disabled_hosts=['host2']),
+                    mock.call('show', hosts=['host2'])])
+                self.assertEqual(send.call_args[0][2], {'status': 'completed'})
+                ack.assert_called_once_with(self.basic_deliver)
+                self.assertEqual(worker.journal.pending().keys(), [])
+
+                # A redelivered job with every host done only replies
+                log = worker.journal
+                log.start(corr_id, {'reply_to': 'fsm', 'body': body})
+                for host in body['parameters']['hosts']:
+                    log.host_done(corr_id, host, 'disabled')
+                worker.process(self.channel,
+                               self.basic_deliver,
+                               self.properties,
+                               body,
+                               self.logger)
+                self.assertEqual(call.call_count, 2)
+                self.assertEqual(send.call_args[0][2], {'status': 'completed'})
+                self.assertEqual(ack.call_count, 2)
+                self.assertEqual(worker.journal.pending().keys(), [])
+            finally:
+                if worker.journal is not None:
+                    worker.journal.close()
+                os.remove(path)
+
+    def test_resume_through_lanes(self):
+        """Resumed jobs are admitted through their lane"""
+        import os
+        import tempfile
+        from replugin.bigipworker import journal
+
+        path = tempfile.mktemp()
+        log = journal.Journal(path)
+        for job_id in ('job1', 'job2'):
+            log.start(job_id, {'reply_to': 'fsm', 'acked': True,
+                               'body': self.configsync_params_good})
+        log.close()
+
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.bigipworker.BigipWorker.notify'),
+                mock.patch('replugin.bigipworker.BigipWorker.send'),
+                mock.patch('replugin.bigipworker.BigipWorker.ack')) as (
+                    _, _, send, ack):
+            worker = bigipworker.BigipWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                output_dir='/tmp/logs/')
+            try:
+                worker._config = {'journal': path, 'lanes': [
+                    {'name': 'sync', 'subcommands': ['ConfigSync'],
+                     'backlog': 0}]}
+                worker._configure()
+                worker._on_open(self.connection)
+                worker._on_channel_open(mock.MagicMock())
+
+                self.assertEqual(
+                    worker.scheduler.stats()['sync']['turned_away'], 2)
+                self.assertEqual(
+                    [c[0][1:3] for c in send.call_args_list], [
+                        ('job1', {'status': 'failed', 'lane': 'sync'}),
+                        ('job2', {'status': 'failed', 'lane': 'sync'})])
+                self.assertEqual(ack.call_count, 0)
+                self.assertEqual(worker.journal.pending().keys(), [])
+            finally:
+                if worker.journal is not None:
+                    worker.journal.close()
+                os.remove(path)
+
+    ##################################################################
+    # Lanes
+    def test_lanes_run_job(self):
+        """With lanes jobs run from their lane and report their wait"""
+        done = threading.Event()
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.bigipworker.BigipWorker.notify'),
+                mock.patch('replugin.bigipworker.BigipWorker.send'),
+                mock.patch('replugin.bigipworker.BigipWorker.ack'),
+                mock.patch('replugin.bigipworker.dispatch.call')) as (
+                    _, _, send, ack, call):
+            ack.side_effect = lambda *args: done.set()
+            worker = bigipworker.BigipWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                output_dir='/tmp/logs/')
+            worker._config = {'lanes': [
+                {'name': 'rotation', 'subcommands': ['InRotation'],
+                 'concurrency': 2}]}
+            worker._configure()
+            body = copy.deepcopy(self.inrotation_params_good)
+            body['parameters']['priority'] = 'high'
+            worker.process(self.channel,
+                           self.basic_deliver,
+                           self.properties,
+                           body,
+                           self.logger)
+            assert done.wait(1)
+            ack.assert_called_once_with(self.basic_deliver)
+            reply = send.call_args_list[-1][0][2]
+            self.assertEqual(reply['status'], 'completed')
+            self.assertEqual(reply['lane']['name'], 'rotation')
+            assert reply['lane']['wait'] >= 0
+            stats = worker.scheduler.stats()
+            self.assertEqual(stats['rotation']['admitted'], 1)
+            self.assertEqual(stats['default']['admitted'], 0)
+
+    def test_lanes_overflow(self):
+        """Jobs for a full lane are rejected or deferred"""
+        for overflow in ('reject', 'defer'):
+            with nested(
+                    mock.patch('pika.SelectConnection'),
+                    mock.patch('replugin.bigipworker.BigipWorker.notify'),
+                    mock.patch('replugin.bigipworker.BigipWorker.send'),
+                    mock.patch('replugin.bigipworker.BigipWorker.ack')) as (
+                        _, notify, send, ack):
+                worker = bigipworker.BigipWorker(
+                    MQ_CONF,
+                    logger=self.app_logger,
+                    output_dir='/tmp/logs/')
+                worker._config = {'lanes': [
+                    {'name': 'sync', 'subcommands': ['ConfigSync'],
+                     'backlog': 0, 'overflow': overflow}],
+                    'defer_delay': 2}
+                worker._configure()
+                channel = mock.MagicMock()
+                worker._on_open(self.connection)
+                worker._on_channel_open(channel)
+                channel.basic_qos.assert_called_with(prefetch_count=102)
+                channel.connection.add_timeout.reset_mock()
+
+                worker.process(channel,
+                               self.basic_deliver,
+                               self.properties,
+                               self.configsync_params_good,
+                               self.logger)
+                if overflow == 'reject':
+                    ack.assert_called_once_with(self.basic_deliver)
+                    self.assertEqual(send.call_args[0][2],
+                                     {'status': 'failed', 'lane': 'sync'})
+                    self.assertEqual(notify.call_args[0][2], 'failed')
+                    assert channel.connection.add_timeout.call_count == 0
+                else:
+                    assert ack.call_count == 0
+                    assert send.call_count == 0
+                    delay, nack = channel.connection.add_timeout.call_args[0]
+                    self.assertEqual(delay, 2)
+                    nack()
+                    channel.basic_nack.assert_called_once_with(
+                        delivery_tag=self.basic_deliver.delivery_tag,
+                        requeue=True)
+                stats = worker.scheduler.stats()['sync']
+                self.assertEqual(stats['turned_away'], 1)
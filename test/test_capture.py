@@ -0,0 +1,75 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests for the thread safe output capture
+"""
+
+import threading
+import time
+
+from . import TestCase
+from replugin.bigipworker import capture
+
+
+def _chatty(name, count):
+    for i in range(count):
+        print "%s %s" % (name, i)
+        time.sleep(0.001)
+    return name
+
+
+class TestCapture(TestCase):
+
+    def test_capture_output(self):
+        """Return value and printed output are both returned"""
+        result, text = capture.capture_output(_chatty, 'one', 2)
+        self.assertEqual(result, 'one')
+        self.assertEqual(text, 'one 0\none 1')
+
+    def test_nested_capture(self):
+        """An inner capture does not leak into the outer one"""
+        with capture.capturing() as outer:
+            print "outer"
+            _, inner = capture.capture_output(_chatty, 'inner', 1)
+        self.assertEqual(outer.getvalue(), 'outer\n')
+        self.assertEqual(inner, 'inner 0')
+
+    def test_concurrent_capture(self):
+        """Threads capturing at the same time only see their own output"""
+        results = {}
+
+        def job(name):
+            results[name] = capture.capture_output(_chatty, name, 20)[1]
+
+        threads = [threading.Thread(target=job, args=('job%s' % i,))
+                   for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for name, text in results.items():
+            lines = text.splitlines()
+            self.assertEqual(len(lines), 20)
+            assert all(line.startswith(name + ' ') for line in lines)
+
+    def test_split_by_host(self):
+        """Show output is grouped by the host it is about"""
+        text = ("header\nweb1 pool_a enabled\n  detail\n"
+                "web10 pool_a disabled\n")
+        results = capture.split_by_host(text, ['web1', 'web10'])
+        self.assertEqual(results['web1'], ['web1 pool_a enabled', '  detail'])
+        self.assertEqual(results['web10'], ['web10 pool_a disabled'])
+        self.assertEqual(results[None], ['header'])
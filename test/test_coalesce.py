@@ -0,0 +1,172 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests for request coalescing
+"""
+
+import threading
+import time
+
+from . import TestCase
+from replugin.bigipworker import coalesce
+
+
+def _submit_all(coalescer, requests, func):
+    results = {}
+
+    def submit(name, key, items):
+        try:
+            results[name] = coalescer.submit(key, items, func)
+        except Exception, e:
+            results[name] = e
+
+    threads = [threading.Thread(target=submit, args=request)
+               for request in requests]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+class TestCoalescer(TestCase):
+
+    def test_merge_within_window(self):
+        """Requests for the same key share one call"""
+        calls = []
+
+        def func(items, contexts):
+            calls.append(list(items))
+            return len(items)
+
+        results = _submit_all(coalesce.Coalescer(0.2), [
+            ('a', 'disable', ['h1', 'h2']),
+            ('b', 'disable', ['h2', 'h3']),
+            ('c', 'enable', ['h4'])], func)
+
+        self.assertEqual(len(calls), 2)
+        assert ['h4'] in calls
+        self.assertEqual(results['a'].result, 3)
+        assert results['a'] is results['b']
+        self.assertEqual(sorted(results['b'].items), ['h1', 'h2', 'h3'])
+        self.assertEqual(results['c'].items, ['h4'])
+
+    def test_error_reaches_every_caller(self):
+        """An exception from the shared call is raised to all callers"""
+        def func(items, contexts):
+            raise ValueError('broken')
+
+        results = _submit_all(coalesce.Coalescer(0.1), [
+            ('a', 'disable', ['h1']),
+            ('b', 'disable', ['h2'])], func)
+        assert isinstance(results['a'], ValueError)
+        assert results['a'] is results['b']
+
+    def test_batches_after_window_are_new(self):
+        """A request after the batch ran starts a new batch"""
+        coalescer = coalesce.Coalescer(0)
+        first = coalescer.submit('k', ['h1'], lambda items, _: len(items))
+        second = coalescer.submit('k', ['h2'], lambda items, _: len(items))
+        assert first is not second
+        self.assertEqual(second.items, ['h2'])
+
+
+    def test_contexts(self):
+        """The call gets the contexts of the callers of every item"""
+        contexts = []
+
+        def submit(items, context):
+            coalescer.submit('k', items,
+                             lambda items, c: contexts.append(c), context)
+
+        coalescer = coalesce.Coalescer(0.2)
+        first = threading.Thread(target=submit, args=(['h1', 'h2'], 'a'))
+        first.start()
+        while 'k' not in coalescer._pending:
+            time.sleep(0.001)
+        submit(['h2', 'h3'], 'b')
+        first.join()
+        self.assertEqual(contexts, [
+            {'h1': ['a'], 'h2': ['a', 'b'], 'h3': ['b']}])
+
+
+class TestSingleFlight(TestCase):
+
+    def test_follow_up_run(self):
+        """Callers for a running key share one run started after it"""
+
+        flight = coalesce.SingleFlight()
+        calls = []
+        results = {}
+
+        def func(key):
+            run = len(calls) + 1
+            calls.append((key, 'start', run))
+            time.sleep(0.2)
+            calls.append((key, 'end', run))
+            return run
+
+        def run(name, key):
+            results[name] = flight.run(key, lambda: func(key))
+
+        threads = [threading.Thread(target=run, args=(name, key))
+                   for (name, key) in [('a', 'prod'), ('b', 'prod'),
+                                       ('c', 'qa'), ('d', 'prod')]]
+        for thread in threads:
+            thread.start()
+            time.sleep(0.02)
+        for thread in threads:
+            thread.join()
+
+        prod = [call for call in calls if call[0] == 'prod']
+        self.assertEqual([call[1] for call in prod],
+                         ['start', 'end', 'start', 'end'])
+        self.assertEqual(results['a'], prod[0][2])
+        self.assertEqual(results['b'], prod[2][2])
+        self.assertEqual(results['d'], prod[2][2])
+        self.assertEqual(len(calls), 6)
+        # Nothing is running anymore, the next call runs right away
+        flight.run('prod', lambda: func('prod'))
+        self.assertEqual(len(calls), 8)
+
+    def test_follow_up_error(self):
+        """A failing run fails only the callers which shared it"""
+
+        flight = coalesce.SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        errors = {}
+
+        def first():
+            started.set()
+            release.wait(1)
+            raise ValueError('sync refused')
+
+        def run(name, func):
+            try:
+                flight.run('prod', func)
+            except ValueError, e:
+                errors[name] = str(e)
+
+        a = threading.Thread(target=run, args=('a', first))
+        a.start()
+        started.wait(1)
+        b = threading.Thread(target=run, args=('b', lambda: 'synced'))
+        b.start()
+        time.sleep(0.02)
+        release.set()
+        a.join()
+        b.join()
+        self.assertEqual(errors, {'a': 'sync refused'})
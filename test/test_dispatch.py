@@ -0,0 +1,100 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests for the direct BigIP dispatch
+"""
+
+import argparse
+
+import mock
+
+from . import TestCase
+from replugin.bigipworker import dispatch
+
+
+def _bigip_parser():
+    """
+    Return the parts of the bigip script's (/bin/bigip) arg parser the
+    worker's commands use.
+    """
+    import BigIP
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-v', action='count')
+    subparsers = parser.add_subparsers(title='Commands', dest='command')
+    state = subparsers.add_parser('state')
+    state.add_argument('-e', nargs='+', default=[], dest='enabled_hosts')
+    state.add_argument('-d', nargs='+', default=[], dest='disabled_hosts')
+    state.set_defaults(func=BigIP.state)
+    sync = subparsers.add_parser('sync')
+    sync.add_argument('-e', nargs='+', default=[], dest='environments')
+    sync.set_defaults(func=BigIP.sync)
+    show = subparsers.add_parser('show')
+    show.add_argument('hosts', nargs='+')
+    show.set_defaults(func=BigIP.show)
+    return parser
+
+
+class TestDispatch(TestCase):
+
+    def test_args_match_parser(self):
+        """Built arguments match what the bigip parser produces"""
+        parser = _bigip_parser()
+        for cmd, name, kwargs in [
+                (['state', '-e', 'a', 'b'], 'state',
+                 {'enabled_hosts': ['a', 'b']}),
+                (['state', '-d', 'a'], 'state', {'disabled_hosts': ['a']}),
+                (['sync', '-e', 'prod'], 'sync', {'environments': ['prod']}),
+                (['show', 'a'], 'show', {'hosts': ['a']})]:
+            self.assertEqual(
+                vars(dispatch.build_args(name, **kwargs)),
+                vars(parser.parse_args(cmd)))
+
+    def test_defaults_not_shared(self):
+        """List defaults are copied for every call"""
+        args = dispatch.build_args('state')
+        args.enabled_hosts.append('a')
+        self.assertEqual(dispatch.build_args('state').enabled_hosts, [])
+
+    def test_call(self):
+        """Calling a command runs its BigIP entry point"""
+        with mock.patch('BigIP.sync') as sync:
+            dispatch.call('sync', environments=['prod'])
+            args = sync.call_args[0][0]
+            self.assertEqual(args.environments, ['prod'])
+            self.assertEqual(args.command, 'sync')
+
+    def test_register(self):
+        """New commands can be registered without argparse"""
+        with mock.patch('BigIP.stats', create=True) as stats:
+            dispatch.register('stats', 'stats', hosts=[])
+            try:
+                dispatch.call('stats', hosts=['a'])
+            finally:
+                del dispatch._registry['stats']
+            self.assertEqual(stats.call_args[0][0].hosts, ['a'])
+
+    def test_unknown_command(self):
+        """Unknown commands are refused"""
+        with self.assertRaises(ValueError):
+            dispatch.call('nope')
+
+    def test_load_imports_once(self):
+        """The BigIP library is imported on first use only"""
+        import BigIP
+        with mock.patch.object(dispatch, '_backend', None):
+            self.assertIs(dispatch.load(), BigIP)
+            self.assertIs(dispatch._backend, BigIP)
+            assert BigIP.parser is not None
@@ -0,0 +1,83 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests for the shared executor
+"""
+
+import threading
+
+from . import TestCase
+from replugin.bigipworker import engine
+
+
+class TestEngine(TestCase):
+
+    def test_submit(self):
+        """Futures return what the call returned or raise its error"""
+        executor = engine.Executor(workers=2)
+        self.assertEqual(executor.submit(lambda x: x + 1, 1).result(), 2)
+
+        def fail():
+            raise ValueError('nope')
+        future = executor.submit(fail)
+        with self.assertRaises(ValueError):
+            future.result()
+        assert future.done()
+
+    def test_threads_reused_and_capped(self):
+        """Threads are started as needed, up to workers, and reused"""
+        executor = engine.Executor(workers=3)
+        release = threading.Event()
+        futures = [executor.submit(release.wait) for _ in range(5)]
+        self.assertEqual(executor.stats()['threads'], 3)
+        release.set()
+        for future in futures:
+            future.result(1)
+
+        for _ in range(10):
+            executor.submit(lambda: None).result(1)
+        self.assertEqual(executor.stats()['threads'], 3)
+        self.assertEqual(executor.stats()['submitted'], 15)
+
+    def test_in_worker(self):
+        """Pool threads know they are pool threads"""
+        executor = engine.Executor(workers=1)
+        assert not executor.in_worker()
+        assert executor.submit(executor.in_worker).result(1)
+
+    def test_result_timeout(self):
+        """Waiting on an unfinished call can time out"""
+        executor = engine.Executor(workers=1)
+        release = threading.Event()
+        future = executor.submit(release.wait)
+        with self.assertRaises(RuntimeError):
+            future.result(0.01)
+        release.set()
+        future.result(1)
+
+    def test_shutdown(self):
+        """Shut down executors finish their calls and turn new ones away"""
+        executor = engine.Executor(workers=2)
+        release = threading.Event()
+        futures = [executor.submit(release.wait, 1) for _ in range(3)]
+        executor.shutdown()
+        with self.assertRaises(RuntimeError):
+            executor.submit(lambda: None)
+        release.set()
+        for future in futures:
+            future.result(1)
+        for thread in executor._threads:
+            thread.join(1)
+            assert not thread.is_alive()
@@ -0,0 +1,106 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests for the per-host fan-out
+"""
+
+import threading
+import time
+
+from . import TestCase
+from replugin.bigipworker import engine
+from replugin.bigipworker import fanout
+
+
+class TestFanOut(TestCase):
+
+    def test_results_in_host_order(self):
+        """Results come back in the order hosts were given"""
+        hosts = ['host%s' % i for i in range(10)]
+        results = fanout.fan_out(lambda h: h.upper(), hosts, concurrency=4)
+        self.assertEqual([r[0] for r in results], hosts)
+        self.assertEqual([r[1] for r in results], [h.upper() for h in hosts])
+        assert all(r[2] is None for r in results)
+
+    def test_failure_does_not_stop_others(self):
+        """One host raising is reported and the rest still run"""
+        def func(host):
+            if host == 'bad':
+                raise ValueError('nope')
+            return 'ok'
+
+        results = fanout.fan_out(func, ['a', 'bad', 'c'], concurrency=2)
+        self.assertEqual(results[0], ('a', 'ok', None))
+        self.assertEqual(results[2], ('c', 'ok', None))
+        assert results[1][1] is None
+        assert isinstance(results[1][2], ValueError)
+
+    def test_concurrency_limits(self):
+        """Neither the overall nor the per group limit is exceeded"""
+        lock = threading.Lock()
+        in_flight = {'all': 0, 'p1': 0, 'p2': 0}
+        peak = {'all': 0, 'p1': 0, 'p2': 0}
+
+        def group_of(host):
+            return host.split('-')[0]
+
+        def func(host):
+            group = group_of(host)
+            with lock:
+                for key in ('all', group):
+                    in_flight[key] += 1
+                    peak[key] = max(peak[key], in_flight[key])
+            time.sleep(0.01)
+            with lock:
+                for key in ('all', group):
+                    in_flight[key] -= 1
+
+        hosts = ['p1-%s' % i for i in range(6)] + ['p2-%s' % i for i in range(6)]
+        fanout.fan_out(func, hosts, concurrency=4, group_of=group_of,
+                       group_concurrency=2)
+        assert peak['all'] <= 4
+        assert peak['p1'] <= 2
+        assert peak['p2'] <= 2
+
+    def test_executor(self):
+        """An executor's threads run the calls, nested fan outs their own"""
+        executor = engine.Executor(workers=2)
+        seen = set()
+
+        def func(host):
+            seen.add(threading.current_thread())
+            inner = fanout.fan_out(lambda h: h * 2, [host, host],
+                                   concurrency=2, executor=executor)
+            return [r[1] for r in inner]
+
+        results = fanout.fan_out(func, ['a', 'b', 'c'], concurrency=2,
+                                 executor=executor)
+        self.assertEqual([r[1] for r in results],
+                         [['aa', 'aa'], ['bb', 'bb'], ['cc', 'cc']])
+        assert threading.current_thread() not in seen
+        assert len(seen) <= 2
+        self.assertEqual(executor.stats()['threads'], 2)
+
+    def test_chunks(self):
+        """Hosts are split into about count chunks, apart by key"""
+        hosts = ['p1-%s' % i for i in range(5)] + ['p2-0']
+        self.assertEqual(fanout.chunks(hosts, 3), [
+            ('p1-0', 'p1-1'), ('p1-2', 'p1-3'), ('p1-4', 'p2-0')])
+        self.assertEqual(
+            fanout.chunks(hosts, 3, key=lambda host: host.split('-')[0]), [
+                ('p1-0', 'p1-1'), ('p1-2', 'p1-3'), ('p1-4',), ('p2-0',)])
+        self.assertEqual(fanout.chunks(hosts, 2, size=2), [
+            ('p1-0', 'p1-1'), ('p1-2', 'p1-3'), ('p1-4', 'p2-0')])
+        self.assertEqual(fanout.chunks(['a'], 8), [('a',)])
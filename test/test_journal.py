@@ -0,0 +1,127 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests for the write-ahead job journal
+"""
+
+import os
+import shutil
+import tempfile
+
+from . import TestCase
+from replugin.bigipworker import journal
+
+
+class TestJournal(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'bigip.journal')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_pending_after_reopen(self):
+        """Unfinished jobs and their finished hosts survive a restart"""
+        log = journal.Journal(self.path, chunk=64)
+        log.start('job1', {'reply_to': 'fsm', 'body': {'hosts': ['a', 'b']}})
+        log.start('job2', {'reply_to': 'fsm', 'body': {}})
+        log.host_done('job1', 'a', 'disabled')
+        log.finish('job2')
+        log.close()
+
+        log = journal.Journal(self.path, chunk=64)
+        self.assertEqual(log.pending().items(), [
+            ('job1', {'job': {'reply_to': 'fsm',
+                              'body': {'hosts': ['a', 'b']}},
+                      'done': {'a': 'disabled'}})])
+        log.close()
+
+    def test_started_again_keeps_done_hosts(self):
+        """A job started again keeps the hosts it finished"""
+        log = journal.Journal(self.path)
+        log.start('job1', {'acked': False})
+        log.host_done('job1', 'a', 'disabled')
+        log.start('job1', {'acked': True})
+        self.assertEqual(log.entry('job1'), {
+            'job': {'acked': True}, 'done': {'a': 'disabled'}})
+        self.assertEqual(log.entry('job2'), None)
+        log.close()
+
+        log = journal.Journal(self.path)
+        self.assertEqual(log.pending()['job1']['done'], {'a': 'disabled'})
+        log.compact()
+        self.assertEqual(log.entry('job1'), {
+            'job': {'acked': True}, 'done': {'a': 'disabled'}})
+        log.close()
+
+    def test_torn_record_dropped(self):
+        """A record cut short by a crash is ignored and overwritten"""
+        log = journal.Journal(self.path)
+        log.start('job1', {})
+        log.host_done('job1', 'a', 'enabled')
+        log._map[log._offset:log._offset + 12] = '{"id":"job1"'
+        log.close()
+
+        log = journal.Journal(self.path)
+        log.host_done('job1', 'b', 'enabled')
+        log.close()
+        log = journal.Journal(self.path)
+        self.assertEqual(log.pending()['job1']['done'],
+                         {'a': 'enabled', 'b': 'enabled'})
+        log.close()
+
+    def test_sync_batches(self):
+        """Host records are flushed together, start records at once"""
+        log = journal.Journal(self.path)
+        log.start('job1', {})
+        self.assertEqual(log.syncs, 1)
+        for host in ('a', 'b', 'c'):
+            log.host_done('job1', host, 'disabled')
+        self.assertEqual(log.syncs, 1)
+        log.sync()
+        log.sync()
+        self.assertEqual(log.syncs, 2)
+        log.close()
+
+    def test_compact(self):
+        """Compaction keeps only the unfinished jobs"""
+        log = journal.Journal(self.path, chunk=64)
+        for i in range(20):
+            log.start('job%s' % i, {})
+            log.host_done('job%s' % i, 'a', 'enabled')
+            if i != 7:
+                log.finish('job%s' % i)
+        before = os.path.getsize(self.path)
+        log.compact()
+        self.assertEqual(log.pending().keys(), ['job7'])
+        log.host_done('job7', 'b', 'enabled')
+        log.close()
+
+        assert os.path.getsize(self.path) < before
+        log = journal.Journal(self.path, chunk=64)
+        self.assertEqual(log.pending()['job7']['done'],
+                         {'a': 'enabled', 'b': 'enabled'})
+        log.close()
+
+    def test_close_stops_background(self):
+        """Closing the journal stops its background thread"""
+        log = journal.Journal(self.path)
+        log.start_background(sync_interval=0.01)
+        log.host_done('job1', 'a', 'enabled')
+        log.close()
+        assert not log._thread.is_alive()
+        # Closing again does nothing
+        log.close()
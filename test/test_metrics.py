@@ -0,0 +1,74 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests for latency instrumentation
+"""
+
+import mock
+
+from . import TestCase
+from replugin.bigipworker import metrics
+
+
+class TestMetrics(TestCase):
+
+    def test_histogram_percentiles(self):
+        """Percentiles come from the bucket bounds, capped at the max"""
+        histogram = metrics.Histogram()
+        for value in [3] * 98 + [150, 180]:
+            histogram.add(value)
+        self.assertEqual(histogram.percentile(50), 5)
+        self.assertEqual(histogram.percentile(99), 180)
+        summary = histogram.summary()
+        self.assertEqual(summary['count'], 100)
+        self.assertEqual(summary['max'], 180)
+
+    def test_timer_records_on_error(self):
+        """Timers record and emit even when the block raises"""
+        now = [10.0]
+        sink = mock.MagicMock()
+        m = metrics.Metrics(sink, clock=lambda: now[0])
+        with self.assertRaises(ValueError):
+            with m.timer('device.state', host='web1'):
+                now[0] += 0.25
+                raise ValueError()
+        sink.emit.assert_called_once_with(
+            'device.state', 250.0, {'host': 'web1'})
+        self.assertEqual(m.snapshot()['device.state']['count'], 1)
+
+    def test_log_sink(self):
+        """The log sink logs one line per timing"""
+        logger = mock.MagicMock()
+        metrics.LogSink(logger).emit('show', 12.345, {'host': 'web1'})
+        logger.info.assert_called_once_with(
+            'bigip: Timing show 12.3ms host=web1')
+
+    def test_statsd_sink(self):
+        """The statsd sink sends a timer datagram"""
+        with mock.patch('socket.socket') as sock:
+            sink = metrics.StatsdSink('stats.example.com', 8125)
+            sink.emit('job.InRotation', 42.0, {})
+            sock.return_value.sendto.assert_called_once_with(
+                'bigip.job.InRotation:42.000|ms',
+                ('stats.example.com', 8125))
+
+    def test_statsd_sink_tags(self):
+        """Tags are part of the statsd name, made safe for statsd"""
+        with mock.patch('socket.socket') as sock:
+            sink = metrics.StatsdSink('stats.example.com', 8125)
+            sink.emit('device.state', 7.0, {'host': 'web1.example.com:80'})
+            sock.return_value.sendto.assert_called_once_with(
+                'bigip.device.state.host.web1_example_com_80:7.000|ms',
+                ('stats.example.com', 8125))
@@ -0,0 +1,101 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests for batched status polling
+"""
+
+from . import TestCase
+from replugin.bigipworker import polling
+
+
+class FakeTime(object):
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def clock(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class TestPolling(TestCase):
+
+    def test_connection_count(self):
+        """Connection counts are found in common show formats"""
+        self.assertEqual(polling.connection_count(
+            ['web1 pool_a web1:80 disabled available connections=3',
+             'web1 pool_b web1:443 disabled available connections=2']), 5)
+        self.assertEqual(polling.connection_count(
+            ['Current Connections: 12']), 12)
+        self.assertEqual(polling.connection_count(
+            ['conn5.example.com pool_a enabled']), None)
+        self.assertEqual(polling.connection_count([]), None)
+
+    def test_availability(self):
+        """A host is available only when all its pools say so"""
+        self.assertEqual(polling.availability(
+            ['web1 pool_a web1:80 enabled available connections=0',
+             'web1 pool_b web1:443 enabled available connections=0']),
+            'available')
+        self.assertEqual(polling.availability(
+            ['web1 pool_a web1:80 enabled available',
+             'web1 pool_b web1:443 enabled offline']), 'offline')
+        self.assertEqual(polling.availability(['web1 pool_a enabled']), None)
+
+    def test_member_state(self):
+        """A member state is only reported when all pools agree"""
+        self.assertEqual(polling.member_state(
+            ['web1 pool_a enabled available', 'web1 pool_b enabled']),
+            'enabled')
+        self.assertEqual(polling.member_state(
+            ['web1 pool_a enabled', 'web1 pool_b disabled']), None)
+        self.assertEqual(polling.member_state(['web1 pool_a']), None)
+
+    def test_wait_for_batches_and_backs_off(self):
+        """One poll per round for every pending host, with backoff"""
+        fake = FakeTime()
+        counts = {'web1': [5, 0], 'web2': [9, 9, 9, 9, 0]}
+        polled = []
+
+        def poll(hosts):
+            polled.append(hosts)
+            return dict((host, counts[host].pop(0)) for host in hosts)
+
+        finished, pending, rounds = polling.wait_for(
+            poll, ['web1', 'web2'], lambda count: count == 0, 60,
+            interval=1, max_interval=3, clock=fake.clock, sleep=fake.sleep)
+
+        self.assertEqual(finished, {'web1': 0, 'web2': 0})
+        self.assertEqual(pending, {})
+        self.assertEqual(rounds, 5)
+        self.assertEqual(polled[0], ['web1', 'web2'])
+        self.assertEqual(polled[2:], [['web2']] * 3)
+        # Reset to the interval after web1 finished in round 2
+        self.assertEqual(fake.sleeps, [1, 1, 1, 2])
+
+    def test_wait_for_timeout(self):
+        """Hosts not done by the timeout are returned as pending"""
+        fake = FakeTime()
+        finished, pending, rounds = polling.wait_for(
+            lambda hosts: {'web1': 4}, ['web1', 'web2'],
+            lambda count: count == 0, 5,
+            interval=1, max_interval=4, clock=fake.clock, sleep=fake.sleep)
+        self.assertEqual(finished, {})
+        self.assertEqual(pending, {'web1': 4, 'web2': None})
+        self.assertEqual(fake.now, 5)
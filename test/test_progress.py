@@ -0,0 +1,68 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests for streaming progress replies
+"""
+
+from . import TestCase
+from replugin.bigipworker import progress
+
+
+class TestProgressPublisher(TestCase):
+
+    def setUp(self):
+        self.now = [1000.0]
+        self.messages = []
+        self.publisher = progress.ProgressPublisher(
+            self.messages.append, interval=5, batch_size=3,
+            clock=lambda: self.now[0])
+
+    def test_first_host_goes_out_immediately(self):
+        """Nothing was sent yet, so the first host is not held back"""
+        self.publisher.host_done('web1', 'disabled')
+        self.assertEqual(self.messages, [{
+            'status': 'progress', 'state': 'disabled',
+            'completed': ['web1'], 'failed': []}])
+
+    def test_rate_limited_and_batched(self):
+        """Hosts are held until the interval passes or a batch is full"""
+        self.publisher.host_done('web1', 'disabled')
+        self.publisher.host_done('web2', 'disabled')
+        self.publisher.host_done('web3', 'disabled', ok=False)
+        self.assertEqual(len(self.messages), 1)
+
+        self.publisher.host_done('web4', 'disabled')
+        self.assertEqual(len(self.messages), 2)
+        self.assertEqual(self.messages[1]['completed'], ['web2', 'web4'])
+        self.assertEqual(self.messages[1]['failed'], ['web3'])
+
+        self.publisher.host_done('web5', 'disabled')
+        self.assertEqual(len(self.messages), 2)
+        self.now[0] += 5
+        self.publisher.host_done('web6', 'disabled')
+        self.assertEqual(self.messages[2]['completed'], ['web5', 'web6'])
+
+    def test_flush(self):
+        """flush() sends what is left, one message per state"""
+        self.now[0] = 0
+        self.publisher._last = 0
+        self.publisher.host_done('web1', 'enabled')
+        self.publisher.host_done('web2', 'disabled')
+        self.assertEqual(self.messages, [])
+        self.publisher.flush()
+        self.assertEqual([m['state'] for m in self.messages],
+                         ['disabled', 'enabled'])
+        self.publisher.flush()
+        self.assertEqual(self.publisher.sent, 2)
@@ -0,0 +1,100 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests for per-device rate limiting
+"""
+
+from . import TestCase
+from replugin.bigipworker import ratelimit
+
+
+class FakeTime(object):
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def clock(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class TestRateLimit(TestCase):
+
+    def test_token_bucket(self):
+        """Calls beyond the burst wait for the bucket to refill"""
+        fake = FakeTime()
+        bucket = ratelimit.TokenBucket(2, burst=2, clock=fake.clock,
+                                       sleep=fake.sleep)
+        self.assertEqual([bucket.take() for _ in range(4)],
+                         [0.0, 0.0, 0.5, 0.5])
+        fake.now += 10
+        self.assertEqual(bucket.take(), 0.0)
+
+    def test_adaptive_limit_aimd(self):
+        """The limit grows additively and is halved on trouble"""
+        fake = FakeTime()
+        limit = ratelimit.AdaptiveLimit(
+            8, minimum=1, maximum=16, latency_target=1.0, clock=fake.clock)
+        limit.limit = 4
+        for _ in range(4):
+            limit.acquire()
+            limit.release(0.1)
+        self.assertEqual(int(limit.limit), 4)
+        self.assertTrue(limit.limit > 4.9)
+
+        limit.acquire()
+        limit.release(0.1, ok=False)
+        self.assertTrue(limit.limit < 2.5)
+        # A second failure within the cooldown does not halve again
+        limit.acquire()
+        limit.release(5.0)
+        self.assertTrue(limit.limit > 2.4)
+        fake.now += 1
+        limit.acquire()
+        limit.release(5.0)
+        self.assertEqual(int(limit.limit), 1)
+        for _ in range(3):
+            limit.acquire()
+            limit.release(0.1, ok=False)
+            fake.now += 1
+        self.assertEqual(limit.limit, 1)
+        self.assertEqual(limit.in_flight, 0)
+
+    def test_device_limiter(self):
+        """Devices are limited separately and waits are reported"""
+        fake = FakeTime()
+        limiter = ratelimit.DeviceLimiter(
+            rate=1, concurrency=2, clock=fake.clock, sleep=fake.sleep)
+        waits = []
+        for key in ('a', 'a', 'b'):
+            with limiter.throttle(key) as waited:
+                waits.append(waited)
+        self.assertEqual(waits, [0.0, 1.0, 0.0])
+        self.assertEqual(limiter.stats()['throttled'], 1.0)
+        self.assertEqual(limiter.stats()['a'],
+                         {'limit': 2, 'in_flight': 0})
+
+    def test_device_limiter_failed_call(self):
+        """A failing call frees its slot and counts against the limit"""
+        limiter = ratelimit.DeviceLimiter(concurrency=4)
+        with self.assertRaises(ValueError):
+            with limiter.throttle('a'):
+                raise ValueError('timeout')
+        self.assertEqual(limiter.stats()['a'],
+                         {'limit': 2, 'in_flight': 0})
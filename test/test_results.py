@@ -0,0 +1,96 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests for structured pool member results
+"""
+
+import json
+
+from . import TestCase
+from replugin.bigipworker import results
+
+
+SHOWN = """web1 pool_a web1:80 enabled available connections=3
+web1 pool_b web1:443 disabled offline connections=0
+web2 pool_a web2:80 enabled available connections=1
+Drained 2 host(s) in 1.0s (1 poll(s))"""
+
+
+class TestResults(TestCase):
+
+    def test_parse_show(self):
+        """Printed show output converts into members"""
+        members = results.parse_show(SHOWN, ['web2', 'web1'])
+        self.assertEqual(members, [
+            results.Member('web2', 'pool_a', 'web2:80', True, 'available', 1),
+            results.Member('web1', 'pool_a', 'web1:80', True, 'available', 3),
+            results.Member('web1', 'pool_b', 'web1:443', False, 'offline',
+                           0)])
+
+    def test_parse_show_without_hosts(self):
+        """Without hosts the first word of a line is its host"""
+        members = results.parse_show(SHOWN)
+        self.assertEqual([m.host for m in members], ['web1', 'web1', 'web2'])
+
+    def test_parse_line_missing_fields(self):
+        """Fields a line does not report are None"""
+        member = results.parse_line('web1 pool_a disabled', 'web1')
+        self.assertEqual(member.to_dict(), {
+            'host': 'web1', 'pool': 'pool_a', 'member': None,
+            'enabled': False, 'availability': None, 'connections': None})
+        self.assertEqual(results.parse_line('Sync complete', 'web1'), None)
+
+    def test_members_serialize_to_json(self):
+        """Members are compact and serialize straight to JSON"""
+        member = results.Member('web1', 'pool_a', 'web1:80', True)
+        self.assertRaises(AttributeError, setattr, member, 'extra', 1)
+        self.assertEqual(json.loads(json.dumps(member.to_dict()))['member'],
+                         'web1:80')
+
+    def test_summary(self):
+        """The summary counts members, hosts and states"""
+        self.assertEqual(
+            results.summary(results.parse_show(SHOWN)),
+            '3 member(s) of 2 host(s): 2 enabled, 1 disabled')
+
+    def test_diff(self):
+        """Only members whose state changed are kept"""
+        before = results.parse_show(SHOWN)
+        after = results.parse_show(
+            SHOWN.replace('enabled available connections=3',
+                          'disabled available connections=0').replace(
+                'connections=1', 'connections=9').replace(
+                'web1 pool_b', 'web3 pool_b'))
+        changes = results.diff(before, after)
+        self.assertEqual(changes, [
+            {'host': 'web1', 'pool': 'pool_a', 'member': 'web1:80',
+             'changes': {'enabled': [True, False]}},
+            {'host': 'web3', 'pool': 'pool_b', 'member': 'web1:443',
+             'changes': {'enabled': [None, False],
+                         'availability': [None, 'offline']}},
+            {'host': 'web1', 'pool': 'pool_b', 'member': 'web1:443',
+             'changes': {'enabled': [False, None],
+                         'availability': ['offline', None]}}])
+        self.assertEqual(results.diff(before, before), [])
+
+    def test_format_diff(self):
+        """Changes format as one line per member"""
+        self.assertEqual(results.format_diff([
+            {'host': 'web1', 'pool': 'pool_a', 'member': None,
+             'changes': {'enabled': [True, False],
+                         'availability': ['available', 'offline']}}], 4),
+            '1 of 4 member(s) changed\n'
+            'web1 pool_a - availability available -> offline, '
+            'enabled True -> False')
@@ -0,0 +1,96 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests for retrying transient device errors
+"""
+
+import socket
+
+from . import TestCase
+from replugin.bigipworker import retry
+
+
+class FakeTime(object):
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def clock(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def failing(*errors):
+    """Return a callable raising `errors` in turn, then returning 'ok'"""
+    errors = list(errors)
+
+    def _func():
+        if errors:
+            raise errors.pop(0)
+        return 'ok'
+    return _func
+
+
+class TestRetry(TestCase):
+
+    def test_retryable(self):
+        """Transient errors are told apart from fatal ones"""
+        assert retry.retryable(socket.timeout('timed out'))
+        assert retry.retryable(IOError('connection reset by peer'))
+        assert retry.retryable(Exception('Server raised fault: timeout'))
+        assert retry.retryable(Exception('HTTP Error 503'))
+        assert not retry.retryable(Exception('No such pool member'))
+        assert not retry.retryable(ValueError('timed out'))
+        assert not retry.retryable(retry.DeadlineExceeded())
+
+    def test_retries_with_backoff(self):
+        """Transient errors are retried after growing, jittered delays"""
+        fake = FakeTime()
+        retried = []
+        self.assertEqual(retry.call(
+            failing(IOError('reset'), IOError('reset')), attempts=3,
+            delay=1, sleep=fake.sleep, jitter=lambda: 0.5,
+            on_retry=lambda e, attempt, wait: retried.append(
+                (attempt, wait))), 'ok')
+        self.assertEqual(fake.sleeps, [0.5, 1.0])
+        self.assertEqual(retried, [(1, 0.5), (2, 1.0)])
+
+    def test_gives_up(self):
+        """Fatal errors and the last attempt's error are raised"""
+        fake = FakeTime()
+        with self.assertRaises(KeyError):
+            retry.call(failing(KeyError('pool')), sleep=fake.sleep)
+        with self.assertRaises(IOError):
+            retry.call(failing(*[IOError('reset')] * 3), attempts=3,
+                       sleep=fake.sleep)
+        self.assertEqual(len(fake.sleeps), 2)
+
+    def test_deadline(self):
+        """Nothing is tried or waited for past the deadline"""
+        fake = FakeTime()
+        deadline = retry.Deadline(2.0, clock=fake.clock)
+        with self.assertRaises(IOError):
+            retry.call(failing(*[IOError('reset')] * 5), attempts=5,
+                       delay=1, deadline=deadline, sleep=fake.sleep,
+                       jitter=lambda: 1.0)
+        self.assertEqual(fake.sleeps, [1.0])
+
+        fake.now = 3.0
+        with self.assertRaises(retry.DeadlineExceeded):
+            retry.call(failing(), deadline=deadline)
@@ -0,0 +1,151 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests for the lane scheduler
+"""
+
+import threading
+
+from . import TestCase
+from replugin.bigipworker import scheduler
+
+
+class TestScheduler(TestCase):
+
+    def test_lane_for(self):
+        """Subcommands go to their lane, the rest to the catch-all"""
+        lanes = scheduler.Scheduler([
+            {'name': 'rotation', 'subcommands': ['InRotation']},
+            {'name': 'other'}], run=None)
+        self.assertEqual(lanes.lane_for('InRotation'), 'rotation')
+        self.assertEqual(lanes.lane_for('ConfigSync'), 'other')
+        self.assertEqual(lanes.lane_for(None), 'other')
+        self.assertEqual(lanes.lanes.keys(), ['rotation', 'other'])
+
+        # Without a catch-all lane one is added
+        lanes = scheduler.Scheduler([
+            {'name': 'rotation', 'subcommands': ['InRotation']}], run=None)
+        self.assertEqual(lanes.lane_for('ConfigSync'), 'default')
+        self.assertEqual(lanes.lanes.keys(), ['rotation', 'default'])
+
+    def test_bad_overflow(self):
+        """Unknown overflow policies are refused"""
+        with self.assertRaises(ValueError):
+            scheduler.Scheduler([{'name': 'a', 'overflow': 'drop'}], None)
+
+    def test_priority_order(self):
+        """Higher priorities run first, oldest first among equals"""
+        release = threading.Event()
+        ran = []
+        done = threading.Event()
+
+        def run(job, lane, waited):
+            if job == 'blocker':
+                release.wait(1)
+            ran.append((job, lane))
+            if len(ran) == 5:
+                done.set()
+
+        lanes = scheduler.Scheduler([{'name': 'a'}], run)
+        lanes.start()
+        lanes.submit('a', 'blocker')
+        while lanes.stats()['a']['running'] != 1:
+            release.wait(0.001)
+        lanes.submit('a', 'low', priority=-1)
+        lanes.submit('a', 'first')
+        lanes.submit('a', 'urgent', priority=10)
+        lanes.submit('a', 'second')
+        self.assertEqual(lanes.stats()['a']['depth'], 4)
+        release.set()
+        assert done.wait(1)
+        self.assertEqual([job for (job, _) in ran], [
+            'blocker', 'urgent', 'first', 'second', 'low'])
+        self.assertEqual(set(lane for (_, lane) in ran), set(['a']))
+
+    def test_lanes_independent(self):
+        """A busy lane does not hold up another"""
+        release = threading.Event()
+        ran = threading.Event()
+
+        def run(job, lane, waited):
+            if lane == 'slow':
+                release.wait(1)
+            else:
+                ran.set()
+
+        lanes = scheduler.Scheduler([
+            {'name': 'slow', 'subcommands': ['ConfigSync']},
+            {'name': 'fast'}], run)
+        lanes.start()
+        lanes.submit('slow', 1)
+        lanes.submit('slow', 2)
+        lanes.submit('fast', 3)
+        assert ran.wait(1)
+        release.set()
+
+    def test_backlog_overflow(self):
+        """Full lanes turn jobs away with their overflow policy"""
+        lanes = scheduler.Scheduler([
+            {'name': 'a', 'backlog': 2},
+            {'name': 'b', 'subcommands': [], 'backlog': 1,
+             'overflow': 'defer'}], run=None)
+        # Not started, so nothing leaves the lanes
+        self.assertEqual(
+            [lanes.submit('a', i) for i in range(3)],
+            ['queued', 'queued', 'reject'])
+        self.assertEqual(
+            [lanes.submit('b', i) for i in range(2)], ['queued', 'defer'])
+        stats = lanes.stats()
+        self.assertEqual(stats['a']['depth'], 2)
+        self.assertEqual(stats['a']['admitted'], 2)
+        self.assertEqual(stats['a']['turned_away'], 1)
+        self.assertEqual(stats['b']['turned_away'], 1)
+        self.assertEqual(lanes.capacity(), 5)
+
+    def test_wait_stats(self):
+        """The time jobs wait in their lane is reported"""
+        now = [100.0]
+        done = threading.Event()
+        waits = []
+
+        def run(job, lane, waited):
+            waits.append(waited)
+            done.set()
+
+        lanes = scheduler.Scheduler([{'name': 'a'}], run,
+                                    clock=lambda: now[0])
+        lanes.submit('a', 'job')
+        now[0] += 2.5
+        lanes.start()
+        assert done.wait(1)
+        self.assertEqual(waits, [2.5])
+        stats = lanes.stats()['a']
+        self.assertEqual(stats['mean_wait'], 2.5)
+        self.assertEqual(stats['max_wait'], 2.5)
+
+    def test_stop(self):
+        """Stopped lanes finish their queued jobs, then their threads exit"""
+        ran = []
+        lanes = scheduler.Scheduler(
+            [{'name': 'a', 'concurrency': 2}],
+            lambda job, lane, waited: ran.append(job))
+        lanes.submit('a', 'job1')
+        lanes.start()
+        lanes.stop()
+        for thread in lanes._threads:
+            thread.join(1)
+            assert not thread.is_alive()
+        self.assertEqual(ran, ['job1'])
+        self.assertEqual(lanes.submit('a', 'job2'), 'reject')